@@ -18,27 +18,92 @@ PAGE_CONFIG = {"page_title":"SwissADT",
 
 st.set_page_config(**PAGE_CONFIG)
 
-from cgdetr import CGDETRPredictor
-from swiss_adt import save_subclip, extract_frames, Translator, encode_images
+import time
+from swiss_adt.jobs import JobQueue, WorkerPool, DONE, FAILED
+from swiss_adt.tracing import tracer
+
+JOBS_ROOT = os.environ.get("SWISS_ADT_JOBS_DIR", "jobs")
 
 
 @st.cache_resource
-def get_moment_retriever():
-    return CGDETRPredictor(device="cpu")
+def get_job_queue():
+    return JobQueue(JOBS_ROOT)
 
 
 @st.cache_resource
-def get_translator():
-    api_key = os.environ.get("OPENAI_API_KEY")
-    if not api_key:
-        st.error(
-            "Please set the OPENAI_API_KEY environment variable to use the translation feature."
-        )
-        st.stop()
-    return Translator(api_key=api_key)
+def start_metrics_server():
+    # Expose the per-stage span histograms for Prometheus if a port is configured, on localhost
+    # unless SWISS_ADT_METRICS_ADDR says otherwise (e.g. 0.0.0.0 inside a container). The stages
+    # run in the worker processes, their spans are read back from the job queue.
+    port = os.environ.get("SWISS_ADT_METRICS_PORT")
+    if port:
+        addr = os.environ.get("SWISS_ADT_METRICS_ADDR", "127.0.0.1")
+        tracer.add_collector(get_job_queue().span_stats)
+        tracer.start_http_server(int(port), addr=addr)
+
+
+@st.cache_resource
+def start_worker_pool():
+    # SWISS_ADT_WORKERS=0 leaves the queue to workers started with `python -m swiss_adt.jobs`
+    n_workers = os.environ.get("SWISS_ADT_WORKERS")
+    if n_workers == "0":
+        return None
+    # finished jobs and their files are deleted after SWISS_ADT_JOBS_RETENTION_HOURS, 0 keeps them
+    retention_hours = float(os.environ.get("SWISS_ADT_JOBS_RETENTION_HOURS", 24))
+    return WorkerPool(
+        JOBS_ROOT,
+        int(n_workers) if n_workers else None,
+        retention=retention_hours * 3600 if retention_hours > 0 else None,
+    ).start()
+
+
+def show_job(queue, job_id):
+    # Render the state of the job, rerunning the script until it is finished
+    job = queue.get(job_id)
+    if job is None:
+        st.error("Unknown job.")
+        return
+    if job["status"] == FAILED:
+        st.error(f"The job failed: {job['error']}")
+        return
+    if job["status"] != DONE:
+        if job["status"] == "queued":
+            st.info(f"Waiting for a worker, {queue.position(job_id)} jobs ahead ...")
+        else:
+            st.progress(job["progress"], text=job["message"] or "Running ...")
+        time.sleep(1)
+        st.rerun()
+
+    result = job["result"]
+    params = job["params"]
+
+    # Display the moment
+    st.divider()
+    st.caption(f"Extracted Moment for Audio Description: {params['audio_description']}")
+    st.video(result["moment_file"])
+
+    # Display the frames
+    frames = result["frame_files"]
+    len_frames = len(frames)
+
+    st.divider()
+    st.caption(f"Sending the following frames to the model for translation:")
+
+    if len_frames < 6:
+        st.image(frames, width=200)
+    else:
+        for i in range(0, len_frames, 6):
+            st.image(frames[i : i + 6], width=200)
+
+    st.divider()
+    for target_language, translated_description in result["translations"].items():
+        st.success(f"Translated AD ({target_language}): {translated_description}")
 
 
 if __name__ == "__main__":
+    start_metrics_server()
+    start_worker_pool()
+
     # Set the title of the app
     st.title("SwissADT: Multimodal Audio Description Translation")
 
@@ -58,21 +123,53 @@ if __name__ == "__main__":
         ["EN"],
         help="Only English is supported at the moment",
     )
-    target_language = st.selectbox("Select the target language", ["FR", "DE", "IT"])
+    target_languages = st.multiselect(
+        "Select the target languages",
+        ["FR", "DE", "IT"],
+        default=["FR"],
+        help="All selected languages are translated with a single request",
+    )
 
     # Select if user wants number of frames or everny nth frame
     option = st.radio(
         "Select the type of extraction",
-        ("Number of frames", "Every nth frame"),
-        help="Number of frames will extract the specified number of frames (equally distributed) from the moment. Every nth frame will extract every nth frame from the moment, which results in variable number of frames.",
+        (
+            "Highest saliency clips",
+            "Number of frames",
+            "Every nth frame",
+            "Most diverse frames",
+            "Most relevant clips",
+        ),
+        help="Highest saliency clips will extract one frame from each of the specified number of 2-second clips of the moment that the retrieval model scores as most salient for the audio description. Number of frames will extract the specified number of frames (equally distributed) from the moment. Every nth frame will extract every nth frame from the moment, which results in variable number of frames. Most diverse frames will extract the specified number of frames that differ the most from each other. Most relevant clips will extract one frame from each of the specified number of 2-second clips that match the audio description best.",
     )
 
-    if option == "Every nth frame":
+    diverse_frames = None
+    relevant_clips = None
+    salient_clips = None
+    if option == "Highest saliency clips":
+        nth_frame = None
+        num_frames = None
+        salient_clips = st.number_input(
+            "Enter the number of clips to extract frames from:", min_value=1, max_value=20, value=2
+        )
+    elif option == "Every nth frame":
         # Get the nth frame to extract
         nth_frame = st.number_input(
             "Enter the nth frame to extract:", min_value=10, max_value=100, value=50
         )
         num_frames = None
+    elif option == "Most diverse frames":
+        nth_frame = None
+        num_frames = None
+        diverse_frames = st.number_input(
+            "Enter the number of frames to extract:", min_value=1, max_value=20, value=4
+        )
+    elif option == "Most relevant clips":
+        nth_frame = None
+        num_frames = None
+        relevant_clips = st.number_input(
+            "Enter the number of clips to extract frames from:", min_value=1, max_value=20, value=2
+        )
     else:
         nth_frame = None
         num_frames = st.number_input(
@@ -85,63 +182,43 @@ if __name__ == "__main__":
             st.error("Please upload a video file and enter the audio description.")
             st.stop()
 
-        if not nth_frame and not num_frames:
+        if (
+            not nth_frame
+            and not num_frames
+            and not diverse_frames
+            and not relevant_clips
+            and not salient_clips
+        ):
             st.error("Please select the type of extraction.")
             st.stop()
 
-        os.makedirs("tmp", exist_ok=True)
-
-        vid_file = "tmp/input.mp4"
-        moment_file = "tmp/moment.mp4"
-
-        with open(vid_file, "wb") as f:
-            f.write(video_file.getbuffer())
+        if not target_languages:
+            st.error("Please select at least one target language.")
+            st.stop()
 
-        with st.spinner("Retrieve moment ..."):
-            # Find the moment
-            model = get_moment_retriever()
-            predictions = model.localize_moment(
-                video_path=vid_file, query_list=[audio_description]
+        if not os.environ.get("OPENAI_API_KEY"):
+            st.error(
+                "Please set the OPENAI_API_KEY environment variable to use the translation feature."
             )
-            moment = predictions[0]["pred_relevant_windows"][0]
-            save_subclip(vid_file, moment_file, moment[0], moment[1])
-
-        # Display the moment
-        st.divider()
-        st.caption(f"Extracted Moment for Audio Description: {audio_description}")
-        st.video(moment_file)
-
-        # Extract the frames
-        if nth_frame and not num_frames:
-            # Extract the frames
-            frames = extract_frames(moment_file, nth_frame=nth_frame, num_frames=None)
-
-        else:
-            # Extract the frames
-            frames = extract_frames(moment_file, num_frames=num_frames, nth_frame=None)
-
-        # Display the frames
-        frames = list(frames)
-        len_frames = len(frames)
-
-        st.divider()
-        st.caption(f"Sending the following frames to the model for translation:")
-
-        if len_frames < 6:
-            st.image(frames, width=200)
-        else:
-            for i in range(0, len_frames, 6):
-                st.image(frames[i : i + 6], width=200)
+            st.stop()
 
-        # Translate the audio description
-        st.divider()
+        # Each job gets its own directory, so concurrent sessions do not overwrite each other
+        queue = get_job_queue()
+        job_id, work_dir = queue.create()
+        with open(os.path.join(work_dir, "input.mp4"), "wb") as f:
+            f.write(video_file.getbuffer())
 
-        with st.spinner("Translating the audio description..."):
-            translator = get_translator()
-            translated_description = translator.translate_segment(
-                text=audio_description,
-                images=encode_images(frames),
+        value = nth_frame or num_frames or diverse_frames or relevant_clips or salient_clips
+        queue.submit(
+            job_id,
+            dict(
+                audio_description=audio_description,
                 source_language=source_language,
-                target_language=target_language,
-            )
-        st.success(f"Translated AD: {translated_description}")
+                target_languages=target_languages,
+                extraction=dict(option=option, value=int(value)),
+            ),
+        )
+        st.session_state["job_id"] = job_id
+
+    if "job_id" in st.session_state:
+        show_job(get_job_queue(), st.session_state["job_id"])
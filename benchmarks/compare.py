@@ -0,0 +1,42 @@
+"""Compare two benchmark result files and flag p50 regressions.
+
+    python benchmarks/compare.py benchmarks/results/<old>.json benchmarks/results/<new>.json --threshold 1.2
+"""
+import argparse
+import json
+import sys
+
+
+def load_results(path):
+    with open(path, "r") as f:
+        report = json.load(f)
+    return report["commit"], {(e["benchmark"], e["case"]): e for e in report["results"]}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("baseline")
+    parser.add_argument("candidate")
+    parser.add_argument("--threshold", type=float, default=1.2,
+                        help="flag a regression when candidate p50 > threshold * baseline p50")
+    args = parser.parse_args()
+
+    base_commit, baseline = load_results(args.baseline)
+    cand_commit, candidate = load_results(args.candidate)
+    print(f"{'benchmark':<20} {'case':<20} {base_commit:>12} {cand_commit:>12} {'ratio':>8}")
+    regressions = 0
+    for key in sorted(baseline.keys() & candidate.keys()):
+        base_p50, cand_p50 = baseline[key]["p50_s"], candidate[key]["p50_s"]
+        ratio = cand_p50 / base_p50 if base_p50 > 0 else float("inf")
+        flag = ""
+        if ratio > args.threshold:
+            flag = "  REGRESSION"
+            regressions += 1
+        print(f"{key[0]:<20} {key[1]:<20} {base_p50:>12.4f} {cand_p50:>12.4f} {ratio:>8.2f}{flag}")
+    for key in sorted(baseline.keys() ^ candidate.keys()):
+        print(f"{key[0]:<20} {key[1]:<20} only in {'baseline' if key in baseline else 'candidate'}")
+    sys.exit(1 if regressions else 0)
+
+
+if __name__ == "__main__":
+    main()
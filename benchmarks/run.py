@@ -0,0 +1,148 @@
+"""Benchmark the retrieval and translation pipeline on synthetic videos.
+
+Videos are generated locally with ffmpeg test sources and translation requests go to a
+local mock of the chat completions endpoint, so runs are reproducible and offline
+(apart from the one-time CLIP download). Results are stored as JSON, keyed by the git
+commit, and can be compared with `compare.py`.
+
+    python benchmarks/run.py --lengths 10 60 140 --resolutions 640x360 1280x720
+    python benchmarks/compare.py benchmarks/results/<old>.json benchmarks/results/<new>.json
+"""
+import argparse
+import datetime
+import json
+import logging
+import os
+import platform
+import subprocess
+import time
+
+import ffmpeg
+import numpy as np
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+QUERY = (
+    "A man with short gray hair stands in a kitchen and stirs a pan of boiling water with a spatula."
+)
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=BENCHMARK_DIR, text=True
+        ).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def make_video(data_dir, length, resolution, fps=25):
+    # testsrc2 has moving content, so it exercises the decoder like real footage
+    path = os.path.join(data_dir, f"testsrc2_{length}s_{resolution}.mp4")
+    if not os.path.exists(path):
+        (
+            ffmpeg.input(f"testsrc2=size={resolution}:rate={fps}:duration={length}", f="lavfi")
+            .output(path, vcodec="libx264", pix_fmt="yuv420p")
+            .overwrite_output()
+            .run(quiet=True)
+        )
+    return path
+
+
+def measure(fn, repeats, warmup=1, n_items=1):
+    for _ in range(warmup):
+        fn()
+    latencies = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        fn()
+        latencies.append(time.perf_counter() - start)
+    latencies = np.array(latencies)
+    return dict(
+        repeats=repeats,
+        mean_s=float(latencies.mean()),
+        p50_s=float(np.percentile(latencies, 50)),
+        p95_s=float(np.percentile(latencies, 95)),
+        throughput_per_s=float(n_items / latencies.mean()),
+    )
+
+
+def run(args):
+    from cgdetr import CGDETRPredictor, set_tracer
+    from swiss_adt import Translator, encode_images, extract_frames
+    from swiss_adt.mock_server import MockChatServer
+    from swiss_adt.tracing import tracer
+
+    set_tracer(tracer)
+
+    data_dir = os.path.join(BENCHMARK_DIR, "data")
+    os.makedirs(data_dir, exist_ok=True)
+    predictor = CGDETRPredictor(device=args.device)
+    extractor = predictor.feature_extractor
+    server = MockChatServer(latency=args.mock_latency).start()
+    translator = Translator(api_key="mock", base_url=server.base_url)
+
+    results = []
+
+    def add(benchmark, case, stats):
+        logging.info(f"{benchmark} [{case}]: p50={stats['p50_s']:.4f}s p95={stats['p95_s']:.4f}s")
+        results.append(dict(benchmark=benchmark, case=case, **stats))
+
+    queries = [QUERY] * args.n_queries
+    add("encode_text", f"{len(queries)}_queries",
+        measure(lambda: extractor.encode_text(queries), args.repeats, n_items=len(queries)))
+
+    for length in args.lengths:
+        for resolution in args.resolutions:
+            video_path = make_video(data_dir, length, resolution)
+            case = f"{length}s_{resolution}"
+            n_clips = len(extractor.encode_video(video_path))
+            add("encode_video", case,
+                measure(lambda: extractor.encode_video(video_path), args.repeats, n_items=n_clips))
+            if n_clips <= 75:  # positional embedding limit of the pretrained CG-DETR
+                add("localize_moment", case,
+                    measure(lambda: predictor.localize_moment(video_path, [QUERY]), args.repeats))
+            add("extract_frames", case,
+                measure(lambda: list(extract_frames(video_path, num_frames=args.n_frames)),
+                        args.repeats, n_items=args.n_frames))
+
+            frames = list(extract_frames(video_path, num_frames=args.n_frames))
+            add("encode_images", case,
+                measure(lambda: list(encode_images(frames)), args.repeats, n_items=len(frames)))
+            images = list(encode_images(frames))
+            add("translate_segment", case,
+                measure(lambda: translator.translate_segment(QUERY, images, "EN", "FR"), args.repeats))
+
+    server.shutdown()
+    return dict(
+        commit=git_commit(),
+        timestamp=datetime.datetime.now().isoformat(timespec="seconds"),
+        machine=dict(platform=platform.platform(), processor=platform.processor(),
+                     cpu_count=os.cpu_count()),
+        config=vars(args),
+        results=results,
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--lengths", type=int, nargs="+", default=[10, 60, 140], help="video lengths in seconds")
+    parser.add_argument("--resolutions", nargs="+", default=["640x360", "1280x720"])
+    parser.add_argument("--repeats", type=int, default=5)
+    parser.add_argument("--n_queries", type=int, default=16, help="batch size for encode_text")
+    parser.add_argument("--n_frames", type=int, default=4, help="frames per moment for extraction and upload")
+    parser.add_argument("--mock_latency", type=float, default=0.0, help="seconds the mock endpoint waits")
+    parser.add_argument("--device", default="cpu")
+    parser.add_argument("--output", default=None, help="defaults to benchmarks/results/<commit>.json")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    report = run(args)
+    output = args.output or os.path.join(BENCHMARK_DIR, "results", f"{report['commit']}.json")
+    os.makedirs(os.path.dirname(output), exist_ok=True)
+    with open(output, "w") as f:
+        json.dump(report, f, indent=4)
+    logging.info(f"Saved results to {output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1 +1,3 @@
-from .moment_retrieval import CGDETRPredictor
\ No newline at end of file
+from .moment_retrieval import CGDETRPredictor
+from .archive import ArchiveSearcher, ClipIndex, load_feature_dir
+from .tracing import set_tracer
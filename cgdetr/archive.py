@@ -0,0 +1,204 @@
+import glob
+import logging
+import os
+
+import numpy as np
+import torch
+
+from .tracing import span
+
+MAX_WINDOW_CLIPS = 75  # positional embedding limit of the pretrained CG-DETR
+
+
+def load_feature_dir(feat_dir):
+    """Read a directory of `{vid}.npz` files with a `features` array of (#clips, d) CLIP features"""
+    video_feats = {}
+    for path in sorted(glob.glob(os.path.join(feat_dir, "*.npz"))):
+        vid = os.path.splitext(os.path.basename(path))[0]
+        with np.load(path) as data:
+            video_feats[vid] = data["features"]
+    return video_feats
+
+
+def _normalize(x):
+    x = np.asarray(x, dtype=np.float32)
+    return x / np.maximum(np.linalg.norm(x, axis=-1, keepdims=True), 1e-5)
+
+
+def _spherical_kmeans(x, k, n_iter=20, seed=0, chunk_size=65536):
+    # Lloyd iterations with cosine similarity on unit vectors; empty clusters are re-seeded
+    rng = np.random.default_rng(seed)
+    centroids = x[rng.choice(len(x), size=k, replace=False)].copy()
+    assign = np.zeros(len(x), dtype=np.int64)
+    for _ in range(n_iter):
+        for st in range(0, len(x), chunk_size):
+            assign[st : st + chunk_size] = (x[st : st + chunk_size] @ centroids.T).argmax(1)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assign, x)
+        counts = np.bincount(assign, minlength=k)
+        empty = counts == 0
+        sums[empty] = x[rng.choice(len(x), size=int(empty.sum()), replace=False)]
+        centroids = _normalize(sums)
+    return centroids, assign
+
+
+class ClipIndex:
+    """Clip-level vector index over the CLIP features of a video library.
+
+    Every 2-sec clip of every video is a unit vector; a query is matched by cosine similarity.
+    With `nlist=None` the search is an exact matrix product over all clips, otherwise an IVF index:
+    the clips are partitioned by spherical k-means and only the `nprobe` lists closest to the query
+    are scanned.
+    """
+
+    def __init__(self, vids, feats, clip_vid, clip_pos, centroids=None, list_order=None, list_offsets=None):
+        self.vids = list(vids)
+        self.feats = feats  # (#clips, d) float32, unit norm
+        self.clip_vid = clip_vid  # (#clips,) index into vids
+        self.clip_pos = clip_pos  # (#clips,) position of the clip in its video
+        self.centroids = centroids
+        self.list_order = list_order
+        self.list_offsets = list_offsets
+
+    @classmethod
+    def build(cls, video_feats, nlist=None, n_iter=20, seed=0):
+        """
+        Args:
+            video_feats: dict, vid -> (#clips, d) CLIP features
+            nlist: int or None, number of IVF lists, None for exact search
+        """
+        vids = list(video_feats.keys())
+        lengths = np.array([len(video_feats[vid]) for vid in vids], dtype=np.int64)
+        feats = _normalize(np.concatenate([np.asarray(video_feats[vid]) for vid in vids], axis=0))
+        clip_vid = np.repeat(np.arange(len(vids)), lengths)
+        clip_pos = np.arange(len(feats)) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+        if nlist is None:
+            return cls(vids, feats, clip_vid, clip_pos)
+        with span("index_build", n_clips=len(feats), nlist=nlist):
+            centroids, assign = _spherical_kmeans(feats, min(nlist, len(feats)), n_iter, seed)
+        list_order = np.argsort(assign, kind="stable")
+        list_offsets = np.searchsorted(assign[list_order], np.arange(len(centroids) + 1))
+        return cls(vids, feats, clip_vid, clip_pos, centroids, list_order, list_offsets)
+
+    def save(self, path):
+        arrays = dict(vids=np.array(self.vids), feats=self.feats, clip_vid=self.clip_vid, clip_pos=self.clip_pos)
+        if self.centroids is not None:
+            arrays.update(centroids=self.centroids, list_order=self.list_order, list_offsets=self.list_offsets)
+        np.savez(path, **arrays)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as data:
+            arrays = {k: data[k] for k in data.files}
+        arrays["vids"] = arrays["vids"].tolist()
+        return cls(**arrays)
+
+    def search(self, query, k=100, nprobe=8):
+        """
+        Args:
+            query: (d,) CLIP text embedding
+            k: int, number of clips to return
+            nprobe: int, number of IVF lists to scan, ignored for exact search
+        Returns:
+            list of (vid, clip position, cosine similarity), best first, empty if no clip was
+            scanned (k=0 or the probed lists are empty)
+        """
+        query = _normalize(query).reshape(-1)
+        if self.centroids is None:
+            candidates = np.arange(len(self.feats))
+            scores = self.feats @ query
+        else:
+            lists = np.argsort(-(self.centroids @ query))[:nprobe]
+            candidates = np.concatenate(
+                [np.zeros(0, dtype=np.int64)]
+                + [self.list_order[self.list_offsets[i] : self.list_offsets[i + 1]] for i in lists]
+            )
+            scores = self.feats[candidates] @ query
+        k = min(k, len(candidates))
+        if k <= 0:
+            return []
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+        return [
+            (self.vids[self.clip_vid[candidates[i]]], int(self.clip_pos[candidates[i]]), float(scores[i]))
+            for i in top
+        ]
+
+
+class ArchiveSearcher:
+    """Find which video of a library and where in it matches a query.
+
+    The clip index recalls candidate clips, which are grouped into windows of at most 75 clips
+    around the best hits; only these windows are reranked by CG-DETR, in batched forwards sharing
+    the query's text state (see `CGDETRPredictor.localize_in_videos`).
+    """
+
+    def __init__(self, predictor, video_feats, index=None):
+        """
+        Args:
+            predictor: CGDETRPredictor
+            video_feats: dict, vid -> (#clips, d) CLIP features, e.g. from `load_feature_dir`
+            index: ClipIndex over the same features, an exact one is built if None
+        """
+        self.predictor = predictor
+        self.video_feats = video_feats
+        self.index = index if index is not None else ClipIndex.build(video_feats)
+
+    def candidate_windows(self, hits, n_windows=20, window_clips=MAX_WINDOW_CLIPS):
+        # Greedily cover the best hits with windows centred on them, one window per hit not yet covered
+        windows = []
+        for vid, pos, score in hits:
+            if any(w_vid == vid and st <= pos < ed for w_vid, st, ed, _ in windows):
+                continue
+            n_clips = len(self.video_feats[vid])
+            length = min(window_clips, n_clips)
+            st = int(np.clip(pos - length // 2, 0, n_clips - length))
+            windows.append((vid, st, st + length, score))
+            if len(windows) == n_windows:
+                break
+        return windows
+
+    @torch.no_grad()
+    def search(self, query, k_clips=200, n_windows=20, top_n=10, nprobe=8, batch_size=32):
+        """
+        Args:
+            query: str
+            k_clips: int, number of clips recalled from the index
+            n_windows: int, number of candidate windows reranked by CG-DETR
+            top_n: int, number of moments returned
+        Returns:
+            list of dict(vid, start, end, score, clip_score, window), best first, with start/end
+            in seconds from the beginning of the video
+        """
+        encoded = self.predictor.encode_query(query)
+        with span("index_search", k=k_clips):
+            hits = self.index.search(encoded["pooled"][0].cpu().numpy(), k=k_clips, nprobe=nprobe)
+        windows = self.candidate_windows(hits, n_windows)
+        if not windows:
+            return []
+        logging.info(f"Reranking {len(windows)} windows from {len({h[0] for h in hits})} videos")
+
+        clip_len = self.predictor.clip_len
+        window_feats = {
+            (vid, st, ed): torch.from_numpy(np.asarray(self.video_feats[vid][st:ed], dtype=np.float32))
+            for vid, st, ed, _ in windows
+        }
+        predictions = self.predictor.localize_in_videos(encoded, window_feats, batch_size=batch_size)
+
+        results = []
+        for (vid, st, ed, clip_score), prediction in zip(windows, predictions):
+            # the best moment of each window, shifted to video coordinates
+            start, end, score = prediction["pred_relevant_windows"][0]
+            offset = st * clip_len
+            results.append(
+                dict(
+                    vid=vid,
+                    start=round(offset + start, 4),
+                    end=round(offset + end, 4),
+                    score=score,
+                    clip_score=round(clip_score, 4),
+                    window=[offset, ed * clip_len],
+                )
+            )
+        results.sort(key=lambda r: r["score"], reverse=True)
+        return results[:top_n]
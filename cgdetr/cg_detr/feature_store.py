@@ -0,0 +1,180 @@
+"""Packed, memory-mapped feature store.
+
+All the per-sample `.npz`/`.npy` feature files of a directory are concatenated row-wise into a
+single `.npy` array with an offsets index, L2-normalised at build time. Reading a sample is then a
+slice of a memory map instead of opening and decompressing one small file per sample. The index
+records the size and mtime of every source file, so a pack older than its sources is detected
+(`stale_reason`) and has to be rebuilt.
+
+    python cg_detr/feature_store.py --feat_dir features/clip --key features
+    python cg_detr/feature_store.py --feat_dir features/clip_text --key last_hidden_state
+"""
+import argparse
+import glob
+import json
+import logging
+import os
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+PACKED_DIR = "_packed"
+
+
+def _source_files(feat_dir):
+    files = {}
+    for path in sorted(glob.glob(os.path.join(feat_dir, "*.npy")) + glob.glob(os.path.join(feat_dir, "*.npz"))):
+        # like the dataset, prefer the .npz of a sample over its .npy
+        files[os.path.splitext(os.path.basename(path))[0]] = path
+    return files
+
+
+def _manifest(files):
+    # (size, mtime in ns) of the source file of every sample, in name order
+    stats = [os.stat(files[name]) for name in sorted(files)]
+    return np.array([[s.st_size, s.st_mtime_ns] for s in stats], dtype=np.int64).reshape(-1, 2)
+
+
+def _load_entry(path, key):
+    if path.endswith(".npz"):
+        with np.load(path) as data:
+            return data[key]
+    return np.load(path, mmap_mode="r")
+
+
+class PackedFeatureStore:
+    """One `(#rows, D)` array per feature directory and key, indexed by sample name.
+
+    A sample of shape (L, D) occupies L consecutive rows, a (D,) sample (e.g. pooler_output)
+    one row and is returned 1-d again.
+    """
+
+    def __init__(self, data, names, offsets, ndims, normalized, sources=None):
+        self.data = data
+        self.offsets = offsets
+        self.ndims = ndims
+        self.normalized = normalized
+        self.sources = sources
+        self._index = {name: i for i, name in enumerate(names)}
+
+    @staticmethod
+    def paths(feat_dir, key):
+        root = os.path.join(feat_dir, PACKED_DIR)
+        return os.path.join(root, f"{key}.npy"), os.path.join(root, f"{key}_index.npz")
+
+    @classmethod
+    def exists(cls, feat_dir, key):
+        return all(os.path.exists(p) for p in cls.paths(feat_dir, key))
+
+    @classmethod
+    def open(cls, feat_dir, key):
+        data_path, index_path = cls.paths(feat_dir, key)
+        # copy-on-write: slices are zero-copy and writable (torch.from_numpy wants that),
+        # writes stay private to the process
+        data = np.load(data_path, mmap_mode="c")
+        with np.load(index_path) as index:
+            # stores packed before the manifest have no sources
+            sources = index["sources"] if "sources" in index.files else None
+            return cls(data, index["names"].tolist(), index["offsets"], index["ndims"], bool(index["normalized"]),
+                       sources)
+
+    @classmethod
+    def build(cls, feat_dir, key="features", dtype=np.float32, normalize=True, eps=1e-5):
+        """Pack every `{name}.npz` (array `key`) and `{name}.npy` file of `feat_dir`.
+        `eps` matches `l2_normalize_np_array`, so packed and per-file features are identical.
+        """
+        files = _source_files(feat_dir)
+        names = sorted(files)
+        # before reading, so a file rewritten while packing makes the pack stale
+        sources = _manifest(files)
+        if not names:
+            raise FileNotFoundError(f"No .npz/.npy files in {feat_dir}")
+
+        # first pass for the shapes, second pass to fill the memory map
+        shapes = [_load_entry(files[name], key).shape for name in names]
+        dims = {shape[-1] for shape in shapes}
+        if len(dims) != 1:
+            raise ValueError(f"Features of {feat_dir} have different dimensions: {sorted(dims)}")
+        lengths = np.array([shape[0] if len(shape) == 2 else 1 for shape in shapes], dtype=np.int64)
+        offsets = np.concatenate([[0], np.cumsum(lengths)])
+
+        data_path, index_path = cls.paths(feat_dir, key)
+        os.makedirs(os.path.dirname(data_path), exist_ok=True)
+        tmp_data_path = data_path + ".tmp.npy"
+        data = np.lib.format.open_memmap(
+            tmp_data_path, mode="w+", dtype=dtype, shape=(int(offsets[-1]), dims.pop())
+        )
+        for i, name in enumerate(names):
+            feat = np.asarray(_load_entry(files[name], key), dtype=np.float32).reshape(lengths[i], -1)
+            if normalize:
+                feat = feat / (np.linalg.norm(feat, axis=-1, keepdims=True) + eps)
+            data[offsets[i] : offsets[i + 1]] = feat
+        data.flush()
+        del data
+        np.savez(
+            index_path + ".tmp.npz",
+            names=np.array(names),
+            offsets=offsets,
+            ndims=np.array([len(shape) for shape in shapes], dtype=np.int8),
+            normalized=np.array(normalize),
+            sources=sources,
+            meta=np.array(json.dumps(dict(key=key, dtype=np.dtype(dtype).name))),
+        )
+        os.replace(tmp_data_path, data_path)
+        os.replace(index_path + ".tmp.npz", index_path)
+        logger.info(f"Packed {len(names)} samples ({offsets[-1]} rows) of {feat_dir} into {data_path}")
+        return cls.open(feat_dir, key)
+
+    def __contains__(self, name):
+        return name in self._index
+
+    def __len__(self):
+        return len(self._index)
+
+    def names(self):
+        return list(self._index)
+
+    def length(self, name):
+        # number of rows of a sample, i.e. of clips for video features, without reading them
+        i = self._index[name]
+        return int(self.offsets[i + 1] - self.offsets[i])
+
+    def stale_reason(self, feat_dir):
+        """Why the pack no longer matches the feature files of `feat_dir` (samples added, removed or
+        rewritten since it was built), None if it is up to date"""
+        if self.sources is None:
+            return "it has no manifest of its source files"
+        files = _source_files(feat_dir)
+        if sorted(files) != self.names():
+            return f"the directory has {len(files)} samples, the pack {len(self)}"
+        if not np.array_equal(_manifest(files), self.sources):
+            return "feature files were modified after packing"
+        return None
+
+    def get(self, name, max_len=None):
+        i = self._index[name]
+        st, ed = self.offsets[i], self.offsets[i + 1]
+        if self.ndims[i] == 1:
+            return self.data[st]
+        if max_len is not None:
+            ed = min(ed, st + max_len)
+        return self.data[st:ed]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--feat_dir", required=True, nargs="+")
+    parser.add_argument("--key", default="features", help="array to pack from the .npz files")
+    parser.add_argument("--dtype", default="float32", choices=["float16", "float32"],
+                        help="float32 slices are zero-copy, float16 halves the size")
+    parser.add_argument("--no_norm", action="store_true", help="do not L2-normalise the features")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    for feat_dir in args.feat_dir:
+        PackedFeatureStore.build(feat_dir, args.key, dtype=np.dtype(args.dtype), normalize=not args.no_norm)
+
+
+if __name__ == "__main__":
+    main()
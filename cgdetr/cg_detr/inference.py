@@ -13,10 +13,12 @@ from torch.utils.data import DataLoader
 from cg_detr.config import TestOptions
 from cg_detr.model import build_model
 from cg_detr.span_utils import span_cxw_to_xx
-from cg_detr.start_end_dataset import StartEndDataset, start_end_collate, prepare_batch_inputs
+from cg_detr.start_end_dataset import StartEndDataset, LengthBucketBatchSampler, VidGroupedBatchSampler, \
+    start_end_collate, prepare_batch_inputs, video_cache_worker_init_fn
 from cg_detr.postprocessing_cg_detr import PostProcessorDETR
+from cg_detr.streaming_eval import StreamingMREval
 from standalone_eval.eval import eval_submission
-from utils.basic_utils import save_jsonl, save_json
+from utils.basic_utils import save_jsonl, save_json, JsonlWriter
 from utils.temporal_nms import temporal_nms
 
 import logging
@@ -215,74 +217,57 @@ def compute_hl_results(model, eval_loader, opt, epoch_i=None, criterion=None, tb
 
 
 
-@torch.no_grad()
-def compute_mr_results(model, eval_loader, opt, epoch_i=None, criterion=None, tb_writer=None):
-    model.eval()
-    if criterion:
-        assert eval_loader.dataset.load_labels
-        criterion.eval()
-
-    loss_meters = defaultdict(AverageMeter)
-    write_tb = tb_writer is not None and epoch_i is not None
-
-    mr_res = []
-    for batch in tqdm(eval_loader, desc="compute st ed scores"):
-        query_meta = batch[0]
-
-        model_inputs, targets = prepare_batch_inputs(batch[1], opt.device, non_blocking=opt.pin_memory)
-
-        outputs = model(**model_inputs)
-        prob = F.softmax(outputs["pred_logits"], -1)  # (batch_size, #queries, #classes=2)
+def compose_mr_predictions(outputs, model_inputs, query_meta, opt):
+    """list(dict), the ranked windows and saliency scores of each query of the batch"""
+    prob = F.softmax(outputs["pred_logits"], -1)  # (batch_size, #queries, #classes=2)
+    if opt.span_loss_type == "l1":
+        scores = prob[..., 0]  # * (batch_size, #queries)  foreground label is 0, we directly take it
+        pred_spans = outputs["pred_spans"]  # (bsz, #queries, 2)
+        _saliency_scores = outputs["saliency_scores"].half()  # (bsz, L)
+        saliency_scores = []
+        valid_vid_lengths = model_inputs["src_vid_mask"].sum(1).cpu().tolist()
+        for j in range(len(valid_vid_lengths)):
+            saliency_scores.append(_saliency_scores[j, :int(valid_vid_lengths[j])].tolist())
+    else:
+        bsz, n_queries = outputs["pred_spans"].shape[:2]  # # (bsz, #queries, max_v_l *2)
+        pred_spans_logits = outputs["pred_spans"].view(bsz, n_queries, 2, opt.max_v_l)
+        pred_span_scores, pred_spans = F.softmax(pred_spans_logits, dim=-1).max(-1)  # 2 * (bsz, #queries, 2)
+        scores = torch.prod(pred_span_scores, 2)  # (bsz, #queries)
+        pred_spans[:, 1] += 1
+        pred_spans *= opt.clip_length
+
+    # compose predictions
+    predictions = []
+    for idx, (meta, spans, score) in enumerate(zip(query_meta, pred_spans.cpu(), scores.cpu())):
         if opt.span_loss_type == "l1":
-            scores = prob[..., 0]  # * (batch_size, #queries)  foreground label is 0, we directly take it
-            pred_spans = outputs["pred_spans"]  # (bsz, #queries, 2)
-            _saliency_scores = outputs["saliency_scores"].half()  # (bsz, L)
-            saliency_scores = []
-            valid_vid_lengths = model_inputs["src_vid_mask"].sum(1).cpu().tolist()
-            for j in range(len(valid_vid_lengths)):
-                saliency_scores.append(_saliency_scores[j, :int(valid_vid_lengths[j])].tolist())
-        else:
-            bsz, n_queries = outputs["pred_spans"].shape[:2]  # # (bsz, #queries, max_v_l *2)
-            pred_spans_logits = outputs["pred_spans"].view(bsz, n_queries, 2, opt.max_v_l)
-            pred_span_scores, pred_spans = F.softmax(pred_spans_logits, dim=-1).max(-1)  # 2 * (bsz, #queries, 2)
-            scores = torch.prod(pred_span_scores, 2)  # (bsz, #queries)
-            pred_spans[:, 1] += 1
-            pred_spans *= opt.clip_length
-
-        # compose predictions
-        for idx, (meta, spans, score) in enumerate(zip(query_meta, pred_spans.cpu(), scores.cpu())):
-            if opt.span_loss_type == "l1":
-                spans = span_cxw_to_xx(spans) * meta["duration"]
-                spans = torch.clamp(spans, 0, meta["duration"])
-            # # (#queries, 3), [st(float), ed(float), score(float)]
-            cur_ranked_preds = torch.cat([spans, score[:, None]], dim=1).tolist()
-            if not opt.no_sort_results:
-                cur_ranked_preds = sorted(cur_ranked_preds, key=lambda x: x[2], reverse=True)
-            cur_ranked_preds = [[float(f"{e:.4f}") for e in row] for row in cur_ranked_preds]
-            cur_query_pred = dict(
-                qid=meta["qid"],
-                query=meta["query"],
-                vid=meta["vid"],
-                pred_relevant_windows=cur_ranked_preds,
-                pred_saliency_scores=saliency_scores[idx]
-            )
-            mr_res.append(cur_query_pred)
+            spans = span_cxw_to_xx(spans) * meta["duration"]
+            spans = torch.clamp(spans, 0, meta["duration"])
+        # # (#queries, 3), [st(float), ed(float), score(float)]
+        cur_ranked_preds = torch.cat([spans, score[:, None]], dim=1).tolist()
+        if not opt.no_sort_results:
+            cur_ranked_preds = sorted(cur_ranked_preds, key=lambda x: x[2], reverse=True)
+        cur_ranked_preds = [[float(f"{e:.4f}") for e in row] for row in cur_ranked_preds]
+        cur_query_pred = dict(
+            qid=meta["qid"],
+            query=meta["query"],
+            vid=meta["vid"],
+            pred_relevant_windows=cur_ranked_preds,
+            pred_saliency_scores=saliency_scores[idx]
+        )
+        predictions.append(cur_query_pred)
+    return predictions
 
-        if criterion:
-            loss_dict = criterion(outputs, targets)
-            weight_dict = criterion.weight_dict
-            losses = sum(loss_dict[k] * weight_dict[k] for k in loss_dict.keys() if k in weight_dict)
-            loss_dict["loss_overall"] = float(losses)  # for logging only
-            for k, v in loss_dict.items():
-                loss_meters[k].update(float(v) * weight_dict[k] if k in weight_dict else float(v))
 
-        if opt.debug:
-            break
+def update_loss_meters(criterion, outputs, targets, loss_meters):
+    loss_dict = criterion(outputs, targets)
+    weight_dict = criterion.weight_dict
+    losses = sum(loss_dict[k] * weight_dict[k] for k in loss_dict.keys() if k in weight_dict)
+    loss_dict["loss_overall"] = float(losses)  # for logging only
+    for k, v in loss_dict.items():
+        loss_meters[k].update(float(v) * weight_dict[k] if k in weight_dict else float(v))
 
-    if write_tb and criterion:
-        for k, v in loss_meters.items():
-            tb_writer.add_scalar("Eval/{}".format(k), v.avg, epoch_i + 1)
 
+def build_post_processor(opt):
     if opt.dset_name in ['hl']:
         post_processor = PostProcessorDETR(
             clip_length=opt.clip_length, min_ts_val=0, max_ts_val=150,
@@ -308,11 +293,134 @@ def compute_mr_results(model, eval_loader, opt, epoch_i=None, criterion=None, tb
             min_w_l=0, max_w_l=50000, move_window_method="left",
             process_func_names=(["round_multiple"])
         )
+    return post_processor
+
+
+@torch.no_grad()
+def compute_mr_results(model, eval_loader, opt, epoch_i=None, criterion=None, tb_writer=None):
+    model.eval()
+    if criterion:
+        assert eval_loader.dataset.load_labels
+        criterion.eval()
+
+    loss_meters = defaultdict(AverageMeter)
+    write_tb = tb_writer is not None and epoch_i is not None
+
+    mr_res = []
+    for batch in tqdm(eval_loader, desc="compute st ed scores"):
+        query_meta = batch[0]
+
+        model_inputs, targets = prepare_batch_inputs(batch[1], opt.device, non_blocking=opt.pin_memory)
+
+        outputs = model(**model_inputs)
+        mr_res.extend(compose_mr_predictions(outputs, model_inputs, query_meta, opt))
 
+        if criterion:
+            update_loss_meters(criterion, outputs, targets, loss_meters)
+
+        if opt.debug:
+            break
+
+    if write_tb and criterion:
+        for k, v in loss_meters.items():
+            tb_writer.add_scalar("Eval/{}".format(k), v.avg, epoch_i + 1)
+
+    post_processor = build_post_processor(opt)
     mr_res = post_processor(mr_res)
     return mr_res, loss_meters
 
 
+@torch.no_grad()
+def compute_mr_results_streaming(model, eval_loader, opt, gt_data, save_submission_filename,
+                                 epoch_i=None, criterion=None, tb_writer=None):
+    """compute_mr_results followed by eval_epoch_post_processing, in a single pass with bounded memory:
+    the predictions of each batch are post-processed, written to the submission files (before and after
+    nms) and scored, then dropped. The metrics are the moment retrieval ones of eval_submission, see
+    StreamingMREval; highlight detection metrics are not computed in this mode.
+    """
+    model.eval()
+    if criterion:
+        assert eval_loader.dataset.load_labels
+        criterion.eval()
+
+    loss_meters = defaultdict(AverageMeter)
+    write_tb = tb_writer is not None and epoch_i is not None
+
+    post_processor = build_post_processor(opt)
+    drop_saliency = opt.dset_name in ['charadesSTA', 'tacos', 'nlq']
+    do_eval = opt.eval_split_name in ["val"]  # since test_public has no GT
+    do_nms = opt.nms_thd != -1
+    qid2gt = {e["qid"]: e for e in gt_data} if do_eval else None
+    evaluator = StreamingMREval() if do_eval else None
+    evaluator_nms = StreamingMREval() if do_eval and do_nms else None
+
+    submission_path = os.path.join(opt.results_dir, save_submission_filename)
+    submission_nms_path = submission_path.replace(".jsonl", "_nms_thd_{}.jsonl".format(opt.nms_thd))
+    writer = JsonlWriter(submission_path)
+    writer_nms = JsonlWriter(submission_nms_path) if do_nms else None
+    try:
+        for batch in tqdm(eval_loader, desc="compute st ed scores"):
+            query_meta = batch[0]
+
+            model_inputs, targets = prepare_batch_inputs(batch[1], opt.device, non_blocking=opt.pin_memory)
+
+            outputs = model(**model_inputs)
+            for pred in compose_mr_predictions(outputs, model_inputs, query_meta, opt):
+                pred = post_processor.process_line(pred)
+                if drop_saliency:
+                    pred.pop('pred_saliency_scores', None)
+                writer.write(pred)
+                if do_eval:
+                    evaluator.update(pred, qid2gt[pred["qid"]])
+                if do_nms:
+                    pred["pred_relevant_windows"] = temporal_nms(
+                        pred["pred_relevant_windows"][:opt.max_before_nms],
+                        nms_thd=opt.nms_thd,
+                        max_after_nms=opt.max_after_nms
+                    )
+                    writer_nms.write(pred)
+                    if do_eval:
+                        evaluator_nms.update(pred, qid2gt[pred["qid"]])
+
+            if criterion:
+                update_loss_meters(criterion, outputs, targets, loss_meters)
+
+            if opt.debug:
+                break
+    finally:
+        writer.close()
+        if writer_nms is not None:
+            writer_nms.close()
+
+    if write_tb and criterion:
+        for k, v in loss_meters.items():
+            tb_writer.add_scalar("Eval/{}".format(k), v.avg, epoch_i + 1)
+
+    if do_eval and not opt.debug:
+        assert evaluator.qids == set(qid2gt), "qids in ground_truth and submission should match"
+
+    if do_eval:
+        metrics = evaluator.metrics()
+        save_metrics_path = submission_path.replace(".jsonl", "_metrics.json")
+        save_json(metrics, save_metrics_path, save_pretty=True, sort_keys=False)
+        latest_file_paths = [submission_path, save_metrics_path]
+    else:
+        metrics = None
+        latest_file_paths = [submission_path, ]
+
+    if do_nms and do_eval:
+        metrics_nms = evaluator_nms.metrics()
+        save_metrics_nms_path = submission_nms_path.replace(".jsonl", "_metrics.json")
+        save_json(metrics_nms, save_metrics_nms_path, save_pretty=True, sort_keys=False)
+        latest_file_paths += [submission_nms_path, save_metrics_nms_path]
+    elif do_nms:
+        metrics_nms = None
+        latest_file_paths = [submission_nms_path, ]
+    else:
+        metrics_nms = None
+    return metrics, metrics_nms, loss_meters, latest_file_paths
+
+
 def get_eval_res(model, eval_loader, opt, epoch_i, criterion, tb_writer):
     """compute and save query and video proposal embeddings"""
     eval_res, eval_loss_meters = compute_mr_results(model, eval_loader, opt, epoch_i, criterion, tb_writer)  # list(dict)
@@ -332,16 +440,45 @@ def eval_epoch(model, eval_dataset, opt, save_submission_filename, epoch_i=None,
     else:
         shuffle = False
 
-    eval_loader = DataLoader(
-        eval_dataset,
-        collate_fn=start_end_collate,
-        batch_size=opt.eval_bsz,
-        num_workers=opt.num_workers,
-        shuffle=shuffle,
-        pin_memory=opt.pin_memory
-    )
+    if getattr(opt, "group_by_vid", False) and getattr(opt, "bucket_by_length", False):
+        raise ValueError("group_by_vid and bucket_by_length both set the batch order, use only one of them")
+    if getattr(opt, "group_by_vid", False):
+        # queries of the same video in the same batch, to hit the per-worker video feature cache
+        batch_sampler = VidGroupedBatchSampler(eval_dataset, opt.eval_bsz, shuffle=shuffle)
+    elif getattr(opt, "bucket_by_length", False):
+        batch_sampler = LengthBucketBatchSampler(eval_dataset, opt.eval_bsz, shuffle=shuffle)
+    else:
+        batch_sampler = None
+    # the video cache counters live in the workers, which log them when they exit at the end of the epoch
+    worker_init_fn = video_cache_worker_init_fn if eval_dataset.video_cache_size > 0 else None
+    if batch_sampler is not None:
+        eval_loader = DataLoader(
+            eval_dataset,
+            collate_fn=start_end_collate,
+            batch_sampler=batch_sampler,
+            num_workers=opt.num_workers,
+            pin_memory=opt.pin_memory,
+            worker_init_fn=worker_init_fn
+        )
+    else:
+        eval_loader = DataLoader(
+            eval_dataset,
+            collate_fn=start_end_collate,
+            batch_size=opt.eval_bsz,
+            num_workers=opt.num_workers,
+            shuffle=shuffle,
+            pin_memory=opt.pin_memory,
+            worker_init_fn=worker_init_fn
+        )
+    try:
+        return _eval_epoch_results(
+            model, eval_dataset, eval_loader, opt, save_submission_filename, epoch_i, criterion, tb_writer)
+    finally:
+        if opt.num_workers == 0:
+            eval_dataset.log_video_cache_info()
 
 
+def _eval_epoch_results(model, eval_dataset, eval_loader, opt, save_submission_filename, epoch_i, criterion, tb_writer):
     # tvsum 
     if opt.dset_name in ['tvsum', 'youtube_uni']:
         metrics, eval_loss_meters = compute_hl_results(model, eval_loader, opt, epoch_i, criterion, tb_writer)
@@ -355,6 +492,12 @@ def eval_epoch(model, eval_dataset, opt, save_submission_filename, epoch_i=None,
 
         return submission[0], submission[0], eval_loss_meters, [submission_path]
 
+    elif getattr(opt, "streaming_eval", False):
+        if opt.no_sort_results:
+            save_submission_filename = save_submission_filename.replace(".jsonl", "_unsorted.jsonl")
+        return compute_mr_results_streaming(
+            model, eval_loader, opt, eval_dataset.data, save_submission_filename, epoch_i, criterion, tb_writer)
+
     else:
         submission, eval_loss_meters = get_eval_res(model, eval_loader, opt, epoch_i, criterion, tb_writer)
 
@@ -454,6 +597,7 @@ def start_inference(train_opt=None, split=None, splitfile=None):
         span_loss_type=opt.span_loss_type,
         txt_drop_ratio=0,
         dset_domain=opt.dset_domain,
+        video_cache_size=getattr(opt, "video_cache_size", 0),
     )
 
 
@@ -2,11 +2,41 @@
 """
 Modules to compute the matching cost and solve the corresponding LSAP.
 """
+import functools
+import itertools
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
 import torch
 from scipy.optimize import linear_sum_assignment
 from torch import nn
+from torch.nn.utils.rnn import pad_sequence
 import torch.nn.functional as F
-from .span_utils import generalized_temporal_iou, span_cxw_to_xx
+from .span_utils import batched_generalized_temporal_iou, generalized_temporal_iou, span_cxw_to_xx
+
+
+@functools.lru_cache(maxsize=None)
+def _ordered_choices(n_rows, k):
+    # (#choices, k): every way to give each of k columns its own row
+    return np.array(list(itertools.permutations(range(n_rows), k)), dtype=np.int64).reshape(-1, k)
+
+
+def brute_force_assignment(costs):
+    """ Exact linear sum assignment of a stack of small cost matrices by enumerating all assignments
+
+    Args:
+        costs: (n, #rows, k) np.ndarray with k <= #rows, the cost of matching each row to each column
+
+    Returns:
+        rows, cols: (n, k) np.ndarray, the assigned rows in increasing order and their columns,
+            as linear_sum_assignment returns them for each matrix
+    """
+    n, n_rows, k = costs.shape
+    choices = _ordered_choices(n_rows, k)  # (#choices, k)
+    total = costs[:, choices, np.arange(k)].sum(-1)  # (n, #choices)
+    rows = choices[total.argmin(1)]  # (n, k), the row of each column
+    cols = rows.argsort(1)
+    return np.take_along_axis(rows, cols, 1), cols
 
 
 class HungarianMatcher(nn.Module):
@@ -17,12 +47,19 @@ class HungarianMatcher(nn.Module):
     while the others are un-matched (and thus treated as non-objects).
     """
     def __init__(self,  cost_class: float = 1, cost_span: float = 1, cost_giou: float = 1,
-                 span_loss_type: str = "l1", max_v_l: int = 75):
+                 span_loss_type: str = "l1", max_v_l: int = 75, batched: bool = False,
+                 max_brute_force_spans: int = 4, num_threads: int = 1):
         """Creates the matcher
 
         Params:
             cost_span: This is the relative weight of the L1 error of the span coordinates in the matching cost
             cost_giou: This is the relative weight of the giou loss of the spans in the matching cost
+            batched: compute one (num_queries, num_target_spans) cost block per sample instead of the
+                cross-batch matrix, and solve the assignments of samples with the same number of spans at once
+            max_brute_force_spans: samples with up to this many target spans are solved exactly by
+                enumeration (10 * 9 * 8 * 7 assignments for 4 spans), the others with scipy
+            num_threads: threads running the scipy assignments of the remaining samples; with 10 queries
+                each call takes microseconds and threads do not pay off, so this is for larger num_queries
         """
         super().__init__()
         self.cost_class = cost_class
@@ -31,6 +68,10 @@ class HungarianMatcher(nn.Module):
         self.span_loss_type = span_loss_type
         self.max_v_l = max_v_l
         self.foreground_label = 0
+        self.batched = batched
+        self.max_brute_force_spans = max_brute_force_spans
+        self.num_threads = num_threads
+        self._executor = None
         assert cost_class != 0 or cost_span != 0 or cost_giou != 0, "all costs cant be 0"
 
     @torch.no_grad()
@@ -54,6 +95,8 @@ class HungarianMatcher(nn.Module):
             For each batch element, it holds:
                 len(index_i) = len(index_j) = min(num_queries, num_target_spans)
         """
+        if self.batched:
+            return self.batched_forward(outputs, targets)
         bs, num_queries = outputs["pred_spans"].shape[:2]
         targets = targets["span_labels"]
 
@@ -99,9 +142,80 @@ class HungarianMatcher(nn.Module):
         indices = [linear_sum_assignment(c[i]) for i, c in enumerate(C.split(sizes, -1))]
         return [(torch.as_tensor(i, dtype=torch.int64), torch.as_tensor(j, dtype=torch.int64)) for i, j in indices]
 
+    @torch.no_grad()
+    def cost_blocks(self, outputs, targets):
+        """ Matching costs of each sample against its own target spans only
+
+        Returns:
+            C: (batch_size, num_queries, max #spans in the batch) cpu np.ndarray, the columns past
+                the number of spans of a sample are padding
+            sizes: list(int), number of target spans per sample
+        """
+        bs, num_queries = outputs["pred_spans"].shape[:2]
+        targets = targets["span_labels"]
+        sizes = [len(v["spans"]) for v in targets]
+        tgt_spans = pad_sequence([v["spans"] for v in targets], batch_first=True)  # (bsz, max #spans, 2)
+
+        # as in forward, 1 - prob[foreground] without the constant
+        out_prob = outputs["pred_logits"].softmax(-1)[..., self.foreground_label]  # (bsz, #queries)
+        cost_class = -out_prob[:, :, None]  # (bsz, #queries, 1)
+
+        if self.span_loss_type == "l1":
+            out_spans = outputs["pred_spans"]  # (bsz, #queries, 2)
+            cost_span = torch.cdist(out_spans, tgt_spans, p=1)  # (bsz, #queries, max #spans)
+            cost_giou = - batched_generalized_temporal_iou(span_cxw_to_xx(out_spans), span_cxw_to_xx(tgt_spans))
+        else:
+            pred_spans = outputs["pred_spans"].view(bs, num_queries, 2, self.max_v_l).softmax(-1)
+            index = tgt_spans[:, None].expand(bs, num_queries, -1, 2)  # (bsz, #queries, max #spans, 2)
+            cost_span = - pred_spans[:, :, 0].gather(2, index[..., 0]) - pred_spans[:, :, 1].gather(2, index[..., 1])
+            cost_giou = 0
+
+        C = self.cost_span * cost_span + self.cost_giou * cost_giou + self.cost_class * cost_class
+        return C.float().cpu().numpy(), sizes
+
+    def _solve(self, C, sizes):
+        # samples with the same small number of spans are solved together by enumeration, the
+        # others go to linear_sum_assignment on a thread pool
+        num_queries = C.shape[1]
+        indices = [None] * len(sizes)
+        by_size = {}
+        for i, k in enumerate(sizes):
+            by_size.setdefault(k, []).append(i)
+        scipy_samples = []
+        for k, samples in by_size.items():
+            if k > min(self.max_brute_force_spans, num_queries):
+                scipy_samples.extend(samples)
+                continue
+            rows, cols = brute_force_assignment(C[samples, :, :k])
+            for i, r, c in zip(samples, rows, cols):
+                indices[i] = (r, c)
+        if len(scipy_samples) > 1 and self.num_threads > 1:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(self.num_threads, thread_name_prefix="matcher")
+            solved = self._executor.map(lambda i: linear_sum_assignment(C[i, :, :sizes[i]]), scipy_samples)
+        else:
+            solved = (linear_sum_assignment(C[i, :, :sizes[i]]) for i in scipy_samples)
+        for i, (r, c) in zip(scipy_samples, solved):
+            indices[i] = (r, c)
+        return indices
+
+    @torch.no_grad()
+    def batched_forward(self, outputs, targets):
+        """ Same matching as forward, see `batched` in __init__ """
+        C, sizes = self.cost_blocks(outputs, targets)
+        return [(torch.as_tensor(i, dtype=torch.int64), torch.as_tensor(j, dtype=torch.int64))
+                for i, j in self._solve(C, sizes)]
+
+    def __getstate__(self):
+        # the thread pool cannot be pickled or deep-copied, it is recreated on demand
+        state = self.__dict__.copy()
+        state["_executor"] = None
+        return state
+
 
 def build_matcher(args):
     return HungarianMatcher(
         cost_span=args.set_cost_span, cost_giou=args.set_cost_giou,
-        cost_class=args.set_cost_class, span_loss_type=args.span_loss_type, max_v_l=args.max_v_l
+        cost_class=args.set_cost_class, span_loss_type=args.span_loss_type, max_v_l=args.max_v_l,
+        batched=getattr(args, "batched_matcher", False),
     )
@@ -135,7 +135,43 @@ class CGDETR(nn.Module):
         scls_encoder_norm = nn.LayerNorm(hidden_dim) if normalize_before else None
         self.scls_encoder = TransformerEncoder(scls_encoder_layer, args.sent_layers, scls_encoder_norm)
 
-    def forward(self, src_txt, src_txt_mask, src_vid, src_vid_mask, vid, qid, src_aud=None, src_aud_mask=None, targets=None):
+    def encode_text_state(self, src_txt, src_txt_mask):
+        """The part of the forward that only depends on the query: text projection, dummy tokens
+        and the text-dummy encoder. Computing it once lets `forward(..., text_state=state)` score one
+        query against many videos without re-running the text branch.
+               - src_txt: [batch_size, L_txt, D_txt]
+               - src_txt_mask: [batch_size, L_txt], containing 0 on padded pixels
+
+            It returns a dict of tensors, all with batch_size as first dimension.
+        """
+        src_txt = self.input_txt_proj(src_txt)
+        src_txt = src_txt + self.token_type_embeddings(torch.zeros_like(src_txt_mask.long()))
+        pos_txt = self.txt_position_embed(src_txt) if self.use_txt_pos else torch.zeros_like(src_txt)  # (bsz, L_txt, d)
+
+        ### insert dummy token in front of txt
+        txt_dummy = self.dummy_rep_token.reshape([1, self.args.num_dummies, self.hidden_dim]).repeat(src_txt.shape[0], 1, 1)
+        src_txt_dummy = torch.cat([txt_dummy, src_txt], dim=1)
+        mask_txt = torch.tensor([[True] * self.args.num_dummies]).to(src_txt_mask.device).repeat(src_txt_mask.shape[0], 1)
+        src_txt_mask_dummy = torch.cat([mask_txt, src_txt_mask], dim=1)
+
+        pos_dummy = self.dummy_rep_pos.reshape([1, self.args.num_dummies, self.hidden_dim]).repeat(pos_txt.shape[0], 1, 1)
+        pos_txt_dummy = torch.cat([pos_dummy, pos_txt], dim=1)
+        src_txt_dummy = src_txt_dummy.permute(1, 0, 2)  # (L, batch_size, d)
+        pos_txt_dummy = pos_txt_dummy.permute(1, 0, 2)   # (L, batch_size, d)
+
+        memory = self.txtproj_encoder(src_txt_dummy, src_key_padding_mask=~(src_txt_mask_dummy.bool()), pos=pos_txt_dummy)  # (L, batch_size, d)
+        dummy_token = memory[:self.args.num_dummies].permute(1, 0, 2)
+        pos_txt_dummy = pos_txt_dummy.permute(1, 0, 2)  # (L, batch_size, d)
+
+        src_txt_dummy = torch.cat([dummy_token, src_txt], dim=1)
+        mask_txt_dummy = torch.tensor([[True]*self.args.num_dummies]).to(src_txt_mask.device).repeat(src_txt_mask.shape[0], 1)
+        src_txt_mask_dummy = torch.cat([mask_txt_dummy, src_txt_mask], dim=1)
+        return dict(src_txt=src_txt, src_txt_mask=src_txt_mask, pos_txt=pos_txt, dummy_token=dummy_token,
+                    pos_dummy=pos_dummy, src_txt_dummy=src_txt_dummy, pos_txt_dummy=pos_txt_dummy,
+                    mask_txt_dummy=mask_txt_dummy, src_txt_mask_dummy=src_txt_mask_dummy)
+
+    def forward(self, src_txt, src_txt_mask, src_vid, src_vid_mask, vid, qid, src_aud=None, src_aud_mask=None, targets=None,
+                text_state=None):
         """The forward expects two tensors:
                - src_txt: [batch_size, L_txt, D_txt]
                - src_txt_mask: [batch_size, L_txt], containing 0 on padded pixels,
@@ -143,6 +179,8 @@ class CGDETR(nn.Module):
                - src_vid: [batch_size, L_vid, D_vid]
                - src_vid_mask: [batch_size, L_vid], containing 0 on padded pixels,
                     will convert to 1 as padding later for transformer
+               - text_state: optional output of `encode_text_state`, replaces src_txt and src_txt_mask
+                    (which may then be None). With a batch size of 1 it is broadcast over the videos.
 
             It returns a dict with the following elements:
                - "pred_spans": The normalized boxes coordinates for all queries, represented as
@@ -165,30 +203,18 @@ class CGDETR(nn.Module):
         if src_aud is not None:
             src_vid = torch.cat([src_vid, src_aud], dim=2)
         src_vid = self.input_vid_proj(src_vid)
-        src_txt = self.input_txt_proj(src_txt)
         src_vid = src_vid + self.token_type_embeddings(torch.full_like(src_vid_mask.long(), 1))
-        src_txt = src_txt + self.token_type_embeddings(torch.zeros_like(src_txt_mask.long()))
         pos_vid = self.position_embed(src_vid, src_vid_mask)  # (bsz, L_vid, d)
-        pos_txt = self.txt_position_embed(src_txt) if self.use_txt_pos else torch.zeros_like(src_txt)  # (bsz, L_txt, d)
-
-        ### insert dummy token in front of txt
-        txt_dummy = self.dummy_rep_token.reshape([1, self.args.num_dummies, self.hidden_dim]).repeat(src_txt.shape[0], 1, 1)
-        src_txt_dummy = torch.cat([txt_dummy, src_txt], dim=1)
-        mask_txt = torch.tensor([[True] * self.args.num_dummies]).to(src_txt_mask.device).repeat(src_txt_mask.shape[0], 1)
-        src_txt_mask_dummy = torch.cat([mask_txt, src_txt_mask], dim=1)
 
-        pos_dummy = self.dummy_rep_pos.reshape([1, self.args.num_dummies, self.hidden_dim]).repeat(pos_txt.shape[0], 1, 1)
-        pos_txt_dummy = torch.cat([pos_dummy, pos_txt], dim=1)
-        src_txt_dummy = src_txt_dummy.permute(1, 0, 2)  # (L, batch_size, d)
-        pos_txt_dummy = pos_txt_dummy.permute(1, 0, 2)   # (L, batch_size, d)
-
-        memory = self.txtproj_encoder(src_txt_dummy, src_key_padding_mask=~(src_txt_mask_dummy.bool()), pos=pos_txt_dummy)  # (L, batch_size, d)
-        dummy_token = memory[:self.args.num_dummies].permute(1, 0, 2)
-        pos_txt_dummy = pos_txt_dummy.permute(1, 0, 2)  # (L, batch_size, d)
-
-        src_txt_dummy = torch.cat([dummy_token, src_txt], dim=1)
-        mask_txt_dummy = torch.tensor([[True]*self.args.num_dummies]).to(src_txt_mask.device).repeat(src_txt_mask.shape[0], 1)
-        src_txt_mask_dummy = torch.cat([mask_txt_dummy, src_txt_mask], dim=1)
+        if text_state is None:
+            text_state = self.encode_text_state(src_txt, src_txt_mask)
+        if text_state["src_txt"].shape[0] != src_vid.shape[0]:
+            # a single query broadcast over a batch of videos
+            text_state = {k: v.expand(src_vid.shape[0], *v.shape[1:]) for k, v in text_state.items()}
+        src_txt, src_txt_mask, pos_txt = text_state["src_txt"], text_state["src_txt_mask"], text_state["pos_txt"]
+        dummy_token, pos_dummy = text_state["dummy_token"], text_state["pos_dummy"]
+        src_txt_dummy, pos_txt_dummy = text_state["src_txt_dummy"], text_state["pos_txt_dummy"]
+        mask_txt_dummy, src_txt_mask_dummy = text_state["mask_txt_dummy"], text_state["src_txt_mask_dummy"]
 
         # Input : Concat video, dummy, txt
         src = torch.cat([src_vid, src_txt_dummy], dim=1)  # (bsz, L_vid+L_txt, d)
@@ -120,3 +120,31 @@ def generalized_temporal_iou(spans1, spans2):
     return iou - (enclosing_area - union) / enclosing_area
 
 
+
+
+def batched_generalized_temporal_iou(spans1, spans2):
+    """ generalized_temporal_iou between the spans of each batch element only
+
+    Args:
+        spans1: (B, N, 2) torch.Tensor, each row defines a span in xx format [st, ed]
+        spans2: (B, M, 2) torch.Tensor, ...
+
+    Returns:
+        giou: (B, N, M) torch.Tensor
+    """
+    spans1 = spans1.float()
+    spans2 = spans2.float()
+    areas1 = spans1[..., 1] - spans1[..., 0]  # (B, N)
+    areas2 = spans2[..., 1] - spans2[..., 0]  # (B, M)
+
+    left = torch.max(spans1[:, :, None, 0], spans2[:, None, :, 0])  # (B, N, M)
+    right = torch.min(spans1[:, :, None, 1], spans2[:, None, :, 1])  # (B, N, M)
+    inter = (right - left).clamp(min=0)  # (B, N, M)
+    union = areas1[:, :, None] + areas2[:, None] - inter  # (B, N, M)
+    iou = inter / union
+
+    left = torch.min(spans1[:, :, None, 0], spans2[:, None, :, 0])  # (B, N, M)
+    right = torch.max(spans1[:, :, None, 1], spans2[:, None, :, 1])  # (B, N, M)
+    enclosing_area = (right - left).clamp(min=0)  # (B, N, M)
+
+    return iou - (enclosing_area - union) / enclosing_area
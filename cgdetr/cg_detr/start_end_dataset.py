@@ -1,13 +1,16 @@
 import torch
-from torch.utils.data import Dataset
+from torch.utils.data import Dataset, Sampler
 import numpy as np
 from tqdm import tqdm
 import random
 import logging
+import multiprocessing.util
+from collections import OrderedDict
 from os.path import join, exists
 from utils.basic_utils import load_jsonl, l2_normalize_np_array
 from utils.tensor_utils import pad_sequences_1d
 from cg_detr.span_utils import span_xx_to_cxw
+from cg_detr.feature_store import PackedFeatureStore
 from torchtext import vocab
 import torch.nn as nn
 
@@ -74,7 +77,7 @@ class StartEndDataset(Dataset):
                  max_q_l=32, max_v_l=75, data_ratio=1.0, ctx_mode="video",
                  normalize_v=True, normalize_t=True, load_labels=True,
                  clip_len=2, max_windows=5, span_loss_type="l1", txt_drop_ratio=0,
-                 dset_domain=None):
+                 dset_domain=None, use_packed=True, video_cache_size=0):
         self.dset_name = dset_name
         self.data_path = data_path
         self.data_ratio = data_ratio
@@ -105,6 +108,16 @@ class StartEndDataset(Dataset):
         # checks
         assert q_feat_type in self.Q_FEAT_TYPES
 
+        # packed stores built by cg_detr/feature_store.py, used when present and up to date with the files
+        self.v_feat_stores = [self._open_store(d, "features", normalize_v, use_packed) for d in self.v_feat_dirs]
+        self.q_feat_store = self._open_store(q_feat_dir, q_feat_type, normalize_t, use_packed)
+
+        # LRU cache of video features by vid; every DataLoader worker holds its own copy
+        self.video_cache_size = video_cache_size
+        self._video_cache = OrderedDict()
+        self.video_cache_hits = 0
+        self.video_cache_misses = 0
+
         # data
         self.data = self.load_data()
         
@@ -142,6 +155,30 @@ class StartEndDataset(Dataset):
             self.embedding = nn.Embedding.from_pretrained(self.vocab.vectors)
         
 
+    @staticmethod
+    def _open_store(feat_dir, key, normalize, use_packed):
+        if not use_packed or feat_dir is None or not PackedFeatureStore.exists(feat_dir, key):
+            return None
+        store = PackedFeatureStore.open(feat_dir, key)
+        if store.normalized != normalize:
+            logger.warning(f"Ignoring the packed {key} of {feat_dir}, normalized={store.normalized} "
+                           f"but the dataset expects {normalize}")
+            return None
+        stale_reason = store.stale_reason(feat_dir)
+        if stale_reason is not None:
+            logger.warning(f"Ignoring the packed {key} of {feat_dir} as {stale_reason}, "
+                           f"rebuild it with cg_detr/feature_store.py")
+            return None
+        logger.info(f"Using the packed {key} of {feat_dir} ({len(store)} samples)")
+        return store
+
+    def _get_packed(self, store, name, max_len=None):
+        # zero-copy slice of the memory map if it is float32, already normalized
+        if store is None or name not in store:
+            return None
+        feat = store.get(name, max_len)
+        return feat if feat.dtype == np.float32 else feat.astype(np.float32)
+
     def load_data(self):
         datalist = load_jsonl(self.data_path)
         if self.data_ratio != 1:
@@ -411,24 +448,30 @@ class StartEndDataset(Dataset):
             return torch.from_numpy(q_feat['last_hidden_state'])
         
         elif self.dset_name in ['tacos', 'nlq']:
-            q_feat_path = join(self.q_feat_dir, f"{qid}.npz")
-            q_feat = np.load(q_feat_path)[self.q_feat_type].astype(np.float32)
-            if self.q_feat_type == "last_hidden_state":
-                q_feat = q_feat[:self.max_q_l]
-            if self.normalize_t:
-                q_feat = l2_normalize_np_array(q_feat)
+            q_feat = self._get_packed(self.q_feat_store, f"{qid}", self.max_q_l)
+            if q_feat is None:
+                q_feat_path = join(self.q_feat_dir, f"{qid}.npz")
+                q_feat = np.load(q_feat_path)[self.q_feat_type].astype(np.float32)
+                if self.q_feat_type == "last_hidden_state":
+                    q_feat = q_feat[:self.max_q_l]
+                if self.normalize_t:
+                    q_feat = l2_normalize_np_array(q_feat)
             if self.txt_drop_ratio > 0:
-                q_feat = self.random_drop_rows(q_feat)
+                # copy, the drop must not write into the shared memory map
+                q_feat = self.random_drop_rows(q_feat.copy())
         else:
             # QVhighlight dataset
-            q_feat_path = join(self.q_feat_dir, f"qid{qid}.npz")
-            q_feat = np.load(q_feat_path)[self.q_feat_type].astype(np.float32)
-            if self.q_feat_type == "last_hidden_state":
-                q_feat = q_feat[:self.max_q_l]
-            if self.normalize_t:
-                q_feat = l2_normalize_np_array(q_feat)
+            q_feat = self._get_packed(self.q_feat_store, f"qid{qid}", self.max_q_l)
+            if q_feat is None:
+                q_feat_path = join(self.q_feat_dir, f"qid{qid}.npz")
+                q_feat = np.load(q_feat_path)[self.q_feat_type].astype(np.float32)
+                if self.q_feat_type == "last_hidden_state":
+                    q_feat = q_feat[:self.max_q_l]
+                if self.normalize_t:
+                    q_feat = l2_normalize_np_array(q_feat)
             if self.txt_drop_ratio > 0:
-                q_feat = self.random_drop_rows(q_feat)
+                # copy, the drop must not write into the shared memory map
+                q_feat = self.random_drop_rows(q_feat.copy())
         return torch.from_numpy(q_feat)  # (D, ) or (Lq, D)
 
     def random_drop_rows(self, embeddings):
@@ -444,6 +487,48 @@ class StartEndDataset(Dataset):
         return embeddings
 
     def _get_video_feat_by_vid(self, vid):
+        if self.video_cache_size <= 0:
+            return self._load_video_feat_by_vid(vid)
+        if vid in self._video_cache:
+            self._video_cache.move_to_end(vid)
+            self.video_cache_hits += 1
+            return self._video_cache[vid]
+        self.video_cache_misses += 1
+        v_feat = self._load_video_feat_by_vid(vid)
+        self._video_cache[vid] = v_feat
+        if len(self._video_cache) > self.video_cache_size:
+            self._video_cache.popitem(last=False)
+        return v_feat
+
+    def get_video_lengths(self):
+        """Number of clips of every sample, without loading the features: exact from a packed
+        store, otherwise estimated from the duration"""
+        store = self.v_feat_stores[0] if self.v_feat_stores else None
+        lengths = []
+        for meta in self.data:
+            if store is not None and meta["vid"] in store:
+                n = store.length(meta["vid"])
+            else:
+                n = int(np.ceil(meta.get("duration", self.max_v_l * self.clip_len) / self.clip_len))
+            lengths.append(min(n, self.max_v_l))
+        return np.array(lengths)
+
+    def video_cache_info(self):
+        """Hit counters of the video feature cache of this process (i.e. of one DataLoader worker)"""
+        lookups = self.video_cache_hits + self.video_cache_misses
+        return dict(hits=self.video_cache_hits, misses=self.video_cache_misses, size=len(self._video_cache),
+                    hit_rate=self.video_cache_hits / lookups if lookups else 0.0)
+
+    def log_video_cache_info(self, worker_id=None):
+        """Log the video feature cache counters of this process and reset them for the next epoch"""
+        if self.video_cache_size <= 0:
+            return
+        where = "main process" if worker_id is None else f"worker {worker_id}"
+        logger.info("Video feature cache of {}: {}".format(where, self.video_cache_info()))
+        self.video_cache_hits = 0
+        self.video_cache_misses = 0
+
+    def _load_video_feat_by_vid(self, vid):
         if self.dset_name == 'tvsum':
             v_feat_list = []
             for _feat_dir in self.v_feat_dirs:
@@ -465,18 +550,10 @@ class StartEndDataset(Dataset):
 
         elif self.dset_name == 'youtube_uni':
             v_feat_list = []
-            for _feat_dir in self.v_feat_dirs:
-                # Only single npz files per directory
-                try:
-                    _feat_path = join(_feat_dir, f"{vid}.npz")
-                    _feat = np.load(_feat_path)["features"][:self.max_v_l].astype(np.float32)
-                except:
-                    _feat_path = join(_feat_dir, f"{vid}.npy")
-                    _feat = np.load(_feat_path)[:self.max_v_l].astype(np.float32)
-                
-                # _feat = _feat_rgb
-                if self.normalize_v:
-                    _feat = l2_normalize_np_array(_feat)
+            for _feat_dir, _store in zip(self.v_feat_dirs, self.v_feat_stores):
+                _feat = self._get_packed(_store, vid, self.max_v_l)
+                if _feat is None:
+                    _feat = self._load_video_feat_file(_feat_dir, vid)
                 v_feat_list.append(_feat)
             # some features are slightly longer than the others
             min_len = min([len(e) for e in v_feat_list])
@@ -485,22 +562,117 @@ class StartEndDataset(Dataset):
 
         else:
             v_feat_list = []
-            for _feat_dir in self.v_feat_dirs:
-                try:
-                    _feat_path = join(_feat_dir, f"{vid}.npz")
-                    _feat = np.load(_feat_path)["features"][:self.max_v_l].astype(np.float32)
-                except:
-                    _feat_path = join(_feat_dir, f"{vid}.npy")
-                    _feat = np.load(_feat_path)[:self.max_v_l].astype(np.float32)
-                if self.normalize_v:
-                    _feat = l2_normalize_np_array(_feat)
+            for _feat_dir, _store in zip(self.v_feat_dirs, self.v_feat_stores):
+                _feat = self._get_packed(_store, vid, self.max_v_l)
+                if _feat is None:
+                    _feat = self._load_video_feat_file(_feat_dir, vid)
                 v_feat_list.append(_feat)
-            # some features are slightly longer than the others
-            min_len = min([len(e) for e in v_feat_list])
-            v_feat_list = [e[:min_len] for e in v_feat_list]
-            v_feat = np.concatenate(v_feat_list, axis=1)
+            if len(v_feat_list) == 1:
+                v_feat = v_feat_list[0]  # keep the memory-mapped slice, no copy
+            else:
+                # some features are slightly longer than the others
+                min_len = min([len(e) for e in v_feat_list])
+                v_feat_list = [e[:min_len] for e in v_feat_list]
+                v_feat = np.concatenate(v_feat_list, axis=1)
         return torch.from_numpy(v_feat)  # (Lv, D)
 
+    def _load_video_feat_file(self, feat_dir, vid):
+        # Only single npz or npy files per directory
+        _feat_path = join(feat_dir, f"{vid}.npz")
+        if exists(_feat_path):
+            _feat = np.load(_feat_path)["features"][:self.max_v_l].astype(np.float32)
+        else:
+            _feat_path = join(feat_dir, f"{vid}.npy")
+            _feat = np.load(_feat_path)[:self.max_v_l].astype(np.float32)
+        if self.normalize_v:
+            _feat = l2_normalize_np_array(_feat)
+        return _feat
+
+
+
+class VidGroupedBatchSampler(Sampler):
+    """Batches in which the queries of a vid are consecutive. The DataLoader hands the batches to
+    its workers round-robin, so only the queries of a vid within one batch share a worker and its
+    video feature cache; a vid split over two batches is loaded by two workers. Only the order of
+    the samples changes."""
+
+    def __init__(self, dataset, batch_size, shuffle=False, drop_last=False, seed=0):
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.drop_last = drop_last
+        self.seed = seed
+        self.epoch = 0
+        groups = OrderedDict()
+        for idx, meta in enumerate(dataset.data):
+            groups.setdefault(meta["vid"], []).append(idx)
+        self.groups = list(groups.values())
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def __iter__(self):
+        groups = self.groups
+        if self.shuffle:
+            rng = random.Random(self.seed + self.epoch)
+            groups = [rng.sample(g, len(g)) for g in groups]
+            rng.shuffle(groups)
+        indices = [idx for g in groups for idx in g]
+        for st in range(0, len(indices), self.batch_size):
+            batch = indices[st:st + self.batch_size]
+            if len(batch) < self.batch_size and self.drop_last:
+                return
+            yield batch
+
+    def __len__(self):
+        n = sum(len(g) for g in self.groups)
+        return n // self.batch_size if self.drop_last else (n + self.batch_size - 1) // self.batch_size
+
+
+class LengthBucketBatchSampler(Sampler):
+    """Batches of samples with similar video lengths, so little of each batch is padding.
+    Samples are sorted by length inside buckets of `bucket_batches` batches (the whole dataset
+    when not shuffling); with shuffle the buckets and the batch order are random."""
+
+    def __init__(self, dataset, batch_size, lengths=None, shuffle=False, drop_last=False, bucket_batches=50, seed=0):
+        self.lengths = np.asarray(lengths if lengths is not None else dataset.get_video_lengths())
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.drop_last = drop_last
+        self.bucket_batches = bucket_batches
+        self.seed = seed
+        self.epoch = 0
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def __iter__(self):
+        if self.shuffle:
+            rng = np.random.default_rng(self.seed + self.epoch)
+            order = rng.permutation(len(self.lengths))
+            bucket = self.batch_size * self.bucket_batches
+            order = np.concatenate([
+                order[st:st + bucket][np.argsort(-self.lengths[order[st:st + bucket]], kind="stable")]
+                for st in range(0, len(order), bucket)
+            ]) if len(order) else order
+        else:
+            order = np.argsort(-self.lengths, kind="stable")
+        batches = [order[st:st + self.batch_size].tolist() for st in range(0, len(order), self.batch_size)]
+        if self.drop_last and batches and len(batches[-1]) < self.batch_size:
+            batches = batches[:-1]
+        if self.shuffle:
+            rng.shuffle(batches)
+        return iter(batches)
+
+    def __len__(self):
+        n = len(self.lengths)
+        return n // self.batch_size if self.drop_last else (n + self.batch_size - 1) // self.batch_size
+
+
+def video_cache_worker_init_fn(worker_id):
+    """DataLoader worker_init_fn that logs the video feature cache counters of the worker when it exits,
+    i.e. at the end of every epoch (the workers are not persistent); the main process never sees them"""
+    dataset = torch.utils.data.get_worker_info().dataset
+    multiprocessing.util.Finalize(dataset, dataset.log_video_cache_info, args=(worker_id,), exitpriority=0)
 
 
 def start_end_collate(batch):
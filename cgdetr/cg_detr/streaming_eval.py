@@ -0,0 +1,144 @@
+"""Moment retrieval metrics accumulated one query at a time.
+
+Same definitions as the QVHighlights `standalone_eval` (R1 of the top window against the best
+matching ground truth window, ActivityNet-style AP per query averaged over queries, both per window
+length range, and "full" over all the ground truth windows), but every query is scored as soon as its prediction is available and only running
+sums are kept, so the predictions of a split never have to be held in memory.
+"""
+from collections import OrderedDict
+
+import numpy as np
+
+# rounded like standalone_eval, so the metric keys are "0.7" rather than "0.7000000000000001"
+MAP_IOU_THDS = [float(f"{e:.2f}") for e in np.linspace(0.5, 0.95, 10)]
+R1_IOU_THDS = [float(f"{e:.2f}") for e in np.linspace(0.5, 0.95, 10)]
+# (min, max] window length in seconds, None for no filtering
+LENGTH_RANGES = OrderedDict([("short", (0, 10)), ("middle", (10, 30)), ("long", (30, 150)), ("full", None)])
+
+
+def temporal_iou_cross(spans1, spans2):
+    """
+    Args:
+        spans1: (N, 2) np.ndarray, [st, ed] per row
+        spans2: (M, 2) np.ndarray
+    Returns:
+        iou: (N, M) np.ndarray
+    """
+    spans1 = np.asarray(spans1, dtype=np.float64).reshape(-1, 2)
+    spans2 = np.asarray(spans2, dtype=np.float64).reshape(-1, 2)
+    left = np.maximum(spans1[:, None, 0], spans2[None, :, 0])
+    right = np.minimum(spans1[:, None, 1], spans2[None, :, 1])
+    inter = np.clip(right - left, 0, None)
+    union = (spans1[:, 1] - spans1[:, 0])[:, None] + (spans2[:, 1] - spans2[:, 0])[None] - inter
+    return np.divide(inter, union, out=np.zeros_like(inter), where=union > 0)
+
+
+def interpolated_precision_recall(precision, recall):
+    mprecision = np.hstack([[0], precision, [0]])
+    mrecall = np.hstack([[0], recall, [1]])
+    mprecision = np.maximum.accumulate(mprecision[::-1])[::-1]
+    idx = np.where(mrecall[1:] != mrecall[:-1])[0] + 1
+    return np.sum((mrecall[idx] - mrecall[idx - 1]) * mprecision[idx])
+
+
+def average_precision(gt_windows, pred_windows, iou_thds=MAP_IOU_THDS):
+    """ AP of the ranked windows of one query, each ground truth window matched at most once
+
+    Args:
+        gt_windows: list([st, ed])
+        pred_windows: list([st, ed, score])
+    Returns:
+        ap: (#iou_thds, ) np.ndarray
+    """
+    ap = np.zeros(len(iou_thds))
+    if len(pred_windows) == 0:
+        return ap
+    # stable sort, ties keep the submission order, as the list.sort of standalone_eval
+    pred_windows = sorted(pred_windows, key=lambda x: -x[2])
+    ious = temporal_iou_cross([w[:2] for w in pred_windows], gt_windows)  # (#preds, #gts)
+    tp = np.zeros((len(iou_thds), len(pred_windows)))
+    for t_idx, thd in enumerate(iou_thds):
+        locked = np.zeros(len(gt_windows), dtype=bool)
+        for p_idx, pred_ious in enumerate(ious):
+            # the best overlapping ground truth window still free
+            for g_idx in pred_ious.argsort()[::-1]:
+                if pred_ious[g_idx] < thd:
+                    break
+                if not locked[g_idx]:
+                    locked[g_idx] = True
+                    tp[t_idx, p_idx] = 1
+                    break
+    tp_cumsum = np.cumsum(tp, axis=1)
+    recall = tp_cumsum / len(gt_windows)
+    precision = tp_cumsum / np.arange(1, len(pred_windows) + 1)
+    for t_idx in range(len(iou_thds)):
+        ap[t_idx] = interpolated_precision_recall(precision[t_idx], recall[t_idx])
+    return ap
+
+
+class StreamingMREval:
+    """Running R1 and mAP over the queries seen so far, per window length range.
+
+    Feed every prediction with its ground truth to `update`, then read `metrics()`; the result has
+    the layout of `standalone_eval.eval.eval_submission` (a "brief" dict and one dict per range, under
+    the range name),
+    without the highlight detection metrics.
+    """
+
+    def __init__(self, max_pred_windows=10, length_ranges=LENGTH_RANGES):
+        self.max_pred_windows = max_pred_windows
+        self.length_ranges = length_ranges
+        self.n_queries = {name: 0 for name in length_ranges}
+        self.ap_sums = {name: np.zeros(len(MAP_IOU_THDS)) for name in length_ranges}
+        self.r1_hits = {name: np.zeros(len(R1_IOU_THDS)) for name in length_ranges}
+        self.iou_sums = {name: 0. for name in length_ranges}
+        self.qids = set()
+
+    def update(self, prediction, gt):
+        """
+        Args:
+            prediction: dict with "qid" and "pred_relevant_windows", list([st, ed, score]), best first
+            gt: dict with "relevant_windows", list([st, ed])
+        """
+        self.qids.add(prediction["qid"])
+        pred_windows = prediction["pred_relevant_windows"][:self.max_pred_windows]
+        for name, length_range in self.length_ranges.items():
+            if length_range is None:
+                gt_windows = gt["relevant_windows"]
+            else:
+                min_l, max_l = length_range
+                gt_windows = [w for w in gt["relevant_windows"] if min_l < w[1] - w[0] <= max_l]
+            if len(gt_windows) == 0:
+                continue
+            self.n_queries[name] += 1
+            self.ap_sums[name] += average_precision(gt_windows, pred_windows)
+            # top-1 window against its best matching ground truth window
+            top_iou = temporal_iou_cross(pred_windows[0][:2], gt_windows)[0].max()
+            self.r1_hits[name] += top_iou >= np.asarray(R1_IOU_THDS)
+            self.iou_sums[name] += top_iou
+
+    def metrics(self):
+        results = OrderedDict()
+        brief = OrderedDict()
+        for name in self.length_ranges:
+            # a range without ground truth window reports zeros, like standalone_eval
+            n = max(self.n_queries[name], 1)
+            ap = self.ap_sums[name] / n
+            mr_ap = OrderedDict((str(thd), float(f"{100 * v:.2f}")) for thd, v in zip(MAP_IOU_THDS, ap))
+            mr_ap["average"] = float(f"{100 * ap.mean():.2f}")
+            mr_r1 = OrderedDict(
+                (str(thd), float(f"{100 * v / n:.2f}")) for thd, v in zip(R1_IOU_THDS, self.r1_hits[name])
+            )
+            results[name] = OrderedDict(
+                [("MR-mAP", mr_ap), ("MR-R1", mr_r1), ("MR-mIoU", float(f"{100 * self.iou_sums[name] / n:.2f}")),
+                 ("num_queries", self.n_queries[name])]
+            )
+            brief[f"MR-{name}-mAP"] = mr_ap["average"]
+            if name == "full":
+                brief["MR-full-mAP@0.5"] = mr_ap["0.5"]
+                brief["MR-full-mAP@0.75"] = mr_ap["0.75"]
+                brief["MR-full-R1@0.5"] = mr_r1["0.5"]
+                brief["MR-full-R1@0.7"] = mr_r1["0.7"]
+                brief["MR-full-mIoU"] = results["full"]["MR-mIoU"]
+        results["brief"] = brief
+        return results
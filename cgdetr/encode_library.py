@@ -0,0 +1,169 @@
+"""Pre-extract the CLIP features of every video under a directory.
+
+Each video is written to `{output_dir}/{vid}.npz` with a `features` array of one CLIP feature per
+2-sec clip, the format `StartEndDataset` and `load_feature_dir` read. Videos whose file already
+exists are skipped, and files are written atomically, so an interrupted run can simply be restarted.
+
+    encode-library videos/ features/ --workers 4 --threads_per_worker 4
+"""
+import argparse
+import logging
+import multiprocessing
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy as np
+
+VIDEO_EXTENSIONS = (".mp4", ".mov", ".avi", ".mkv", ".webm")
+
+_extractor = None
+
+
+def find_videos(video_dir):
+    # vid -> path, the vid being the file name without extension
+    videos = {}
+    for root, _, files in os.walk(video_dir):
+        for name in sorted(files):
+            if not name.lower().endswith(VIDEO_EXTENSIONS):
+                continue
+            vid = os.path.splitext(name)[0]
+            if vid in videos:
+                logging.warning(f"Skipping {os.path.join(root, name)}, {vid} is already {videos[vid]}")
+                continue
+            videos[vid] = os.path.join(root, name)
+    return videos
+
+
+def is_done(output_path):
+    # Written atomically, but check it loads in case it was copied or truncated by hand
+    if not os.path.exists(output_path):
+        return False
+    try:
+        with np.load(output_path) as data:
+            return data["features"].ndim == 2
+    except (OSError, ValueError, KeyError):
+        return False
+
+
+def _init_worker(counter, threads_per_worker, model_name_or_path, device, scene_threshold):
+    # One model per process, pinned to its own slice of the cores so workers do not compete
+    global _extractor
+    with counter.get_lock():
+        worker_idx = counter.value
+        counter.value += 1
+    if hasattr(os, "sched_setaffinity"):
+        cores = sorted(os.sched_getaffinity(0))
+        first = (worker_idx * threads_per_worker) % len(cores)
+        os.sched_setaffinity(0, cores[first : first + threads_per_worker] or cores)
+    import torch
+
+    torch.set_num_threads(threads_per_worker)
+    from .run_on_video.data_utils import ClipFeatureExtractor
+
+    _extractor = ClipFeatureExtractor(
+        framerate=1 / 2,
+        size=224,
+        centercrop=True,
+        model_name_or_path=model_name_or_path,
+        device=device,
+        scene_threshold=scene_threshold,
+    )
+
+
+def _encode(video_path, output_path, dtype):
+    start = time.perf_counter()
+    features = _extractor.encode_video(video_path).float().cpu().numpy().astype(dtype)
+    # hidden temporary name, so readers globbing *.npz never see a partial file
+    output_dir, name = os.path.split(output_path)
+    tmp_path = os.path.join(output_dir, f".{name}.{os.getpid()}.tmp.npz")
+    np.savez(tmp_path, features=features)
+    os.replace(tmp_path, output_path)
+    return len(features), time.perf_counter() - start
+
+
+def encode_library(
+    video_dir,
+    output_dir,
+    workers=1,
+    threads_per_worker=None,
+    model_name_or_path="ViT-B/32",
+    device="cpu",
+    dtype="float32",
+    scene_threshold=None,
+):
+    """Encode the videos under `video_dir` that are not in `output_dir` yet.
+    Returns:
+        dict, the number of videos encoded, skipped and failed
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    videos = find_videos(video_dir)
+    todo = {
+        vid: path for vid, path in videos.items()
+        if not is_done(os.path.join(output_dir, f"{vid}.npz"))
+    }
+    summary = dict(encoded=0, skipped=len(videos) - len(todo), failed=0)
+    logging.info(f"{len(videos)} videos, {summary['skipped']} already encoded, {len(todo)} to do")
+    if not todo:
+        return summary
+
+    threads_per_worker = threads_per_worker or max(1, (os.cpu_count() or 1) // workers)
+    # spawn, so every worker loads its own model instead of inheriting torch state through fork
+    context = multiprocessing.get_context("spawn")
+    counter = context.Value("i", 0)
+    with ProcessPoolExecutor(
+        max_workers=workers,
+        mp_context=context,
+        initializer=_init_worker,
+        initargs=(counter, threads_per_worker, model_name_or_path, device, scene_threshold),
+    ) as executor:
+        futures = {
+            executor.submit(_encode, path, os.path.join(output_dir, f"{vid}.npz"), dtype): vid
+            for vid, path in todo.items()
+        }
+        for future in as_completed(futures):
+            vid = futures[future]
+            try:
+                n_clips, duration = future.result()
+            except Exception:
+                logging.exception(f"Failed to encode {todo[vid]}")
+                summary["failed"] += 1
+                continue
+            summary["encoded"] += 1
+            logging.info(
+                f"[{summary['encoded'] + summary['failed']}/{len(todo)}] {vid}: "
+                f"{n_clips} clips in {duration:.1f}s"
+            )
+    return summary
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("video_dir")
+    parser.add_argument("output_dir")
+    parser.add_argument("--workers", type=int, default=1, help="number of processes, each with its own model")
+    parser.add_argument("--threads_per_worker", type=int, default=None,
+                        help="torch threads and pinned cores per process, defaults to an even split")
+    parser.add_argument("--model", default="ViT-B/32", help="CLIP model name or path")
+    parser.add_argument("--device", default="cpu")
+    parser.add_argument("--dtype", default="float32", choices=["float16", "float32"])
+    parser.add_argument("--scene_threshold", type=float, default=None,
+                        help="only re-encode clips that differ from the last encoded one, see ClipFeatureExtractor")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    summary = encode_library(
+        args.video_dir,
+        args.output_dir,
+        workers=args.workers,
+        threads_per_worker=args.threads_per_worker,
+        model_name_or_path=args.model,
+        device=args.device,
+        dtype=args.dtype,
+        scene_threshold=args.scene_threshold,
+    )
+    logging.info(f"Done: {summary}")
+
+
+if __name__ == "__main__":
+    main()
@@ -11,11 +11,16 @@ from .run_on_video.model_utils import build_inference_model
 from .utils.tensor_utils import pad_sequences_1d
 from .cg_detr.span_utils import span_cxw_to_xx
 import torch.nn.functional as F
+from .tracing import span
 
 
 class CGDETRPredictor:
     def __init__(
-        self, ckpt_path=None, clip_model_name_or_path="ViT-B/32", device="cuda"
+        self,
+        ckpt_path=None,
+        clip_model_name_or_path="ViT-B/32",
+        device="cuda",
+        scene_threshold=None,
     ):
         if ckpt_path is None:
             ckpt_path = os.path.join(
@@ -33,34 +38,190 @@ class CGDETRPredictor:
             centercrop=True,
             model_name_or_path=clip_model_name_or_path,
             device=device,
+            scene_threshold=scene_threshold,
         )
         logging.info("Loading trained CG-DETR model...")
         self.model = build_inference_model(ckpt_path).to(self.device)
 
     @torch.no_grad()
-    def localize_moment(self, video_path, query_list):
+    def localize_moment(
+        self,
+        video_path,
+        query_list,
+        return_clip_scores=False,
+        progress_callback=None,
+        return_saliency=False,
+    ):
         """
         Args:
             video_path: str, path to the video file
             query_list: List[str], each str is a query for this video
+            return_clip_scores: bool, if True, add `pred_clip_scores` to each prediction, the CLIP
+                cosine similarity between every 2-sec clip and the query. It reuses the features
+                computed for CG-DETR, so no additional model pass is needed.
+            progress_callback: callable or None, called with every event of `iter_localize_moment`
+            return_saliency: bool, if True, add `pred_saliency_scores` to each prediction, CG-DETR's
+                saliency score of every 2-sec clip for the query. The model computes them in the same
+                forward as the moments, they are otherwise discarded.
         """
-        # construct model inputs
-        n_query = len(query_list)
-        video_feats = self.feature_extractor.encode_video(video_path)
-        video_feats = F.normalize(video_feats, dim=-1, eps=1e-5)
-        n_frames = len(video_feats)
-        # add tef
-        tef_st = torch.arange(0, n_frames, 1.0) / n_frames
-        tef_ed = tef_st + 1.0 / n_frames
-        tef = torch.stack([tef_st, tef_ed], dim=1).to(self.device)  # (n_frames, 2)
-        video_feats = torch.cat([video_feats, tef], dim=1)
-        assert n_frames <= 75, (
+        predictions = [None] * len(query_list)
+        for event in self.iter_localize_moment(
+            video_path,
+            query_list,
+            return_clip_scores=return_clip_scores,
+            return_saliency=return_saliency,
+        ):
+            if progress_callback is not None:
+                progress_callback(event)
+            if event["stage"] == "prediction":
+                predictions[event["index"]] = event["prediction"]
+        return predictions
+
+    @torch.no_grad()
+    def iter_localize_moment(
+        self, video_path, query_list, return_clip_scores=False, query_bsz=8, return_saliency=False
+    ):
+        """Streaming version of `localize_moment`.
+        Yields dicts with a "stage" key, in this order:
+            probe, decode, features: progress of the video encoding,
+                see ClipFeatureExtractor.iter_encode_video
+            prediction: index=int, prediction=dict, the prediction for query_list[index],
+                yielded as soon as its chunk of `query_bsz` queries has been scored
+        """
+        video_feats = []
+        for event in self.feature_extractor.iter_encode_video(video_path):
+            if event["stage"] == "features":
+                video_feats.append(event["features"])
+            yield event
+        video_feats = F.normalize(torch.cat(video_feats, dim=0), dim=-1, eps=1e-5)
+        assert len(video_feats) <= 75, (
             "The positional embedding of this pretrained CGDETR only support video up "
             "to 150 secs (i.e., 75 2-sec clips) in length"
         )
+
+        for st_idx in range(0, len(query_list), query_bsz):
+            chunk_predictions = self._predict(
+                video_feats,
+                query_list[st_idx : st_idx + query_bsz],
+                video_path,
+                return_clip_scores,
+                return_saliency,
+            )
+            for idx, prediction in enumerate(chunk_predictions, start=st_idx):
+                yield dict(stage="prediction", index=idx, prediction=prediction)
+
+    @torch.no_grad()
+    def encode_query(self, query):
+        """Precompute everything CG-DETR needs from a query, for `localize_in_videos`.
+        Args:
+            query: str
+        Returns:
+            dict with the query, the CLIP pooled embedding and the text-side encoder state
+        """
+        query_feats, query_pooled = self.feature_extractor.encode_text(
+            [query], return_pooler=True
+        )
+        query_feats, query_mask = pad_sequences_1d(
+            query_feats, dtype=torch.float32, device=self.device, fixed_length=None
+        )
+        query_feats = F.normalize(query_feats, dim=-1, eps=1e-5)
+        with span("cgdetr_text_state"):
+            text_state = self.model.encode_text_state(query_feats, query_mask)
+        return dict(
+            query=query,
+            pooled=F.normalize(query_pooled.float(), dim=-1, eps=1e-5),
+            text_state=text_state,
+        )
+
+    @torch.no_grad()
+    def localize_in_videos(
+        self, query, video_feats, batch_size=32, return_clip_scores=False, return_saliency=False
+    ):
+        """Localize one query in many videos whose CLIP features are already computed, e.g. to find
+        a description across an archive. The text branch runs once; the videos are scored in batched
+        forwards with the text state broadcast over the batch.
+        Args:
+            query: str or the output of `encode_query`
+            video_feats: dict, vid -> (#clips, d) tensor from ClipFeatureExtractor.encode_video,
+                at most 75 clips each
+            batch_size: int, number of videos per forward
+            return_clip_scores: bool, see `localize_moment`
+            return_saliency: bool, see `localize_moment`
+        Returns:
+            List[dict], one prediction per video in the order of `video_feats`, `vid` being its key
+        """
+        if isinstance(query, str):
+            query = self.encode_query(query)
+        vids = list(video_feats.keys())
+        predictions = []
+        for st_idx in range(0, len(vids), batch_size):
+            batch_vids = vids[st_idx : st_idx + batch_size]
+            clip_feats = []
+            for vid in batch_vids:
+                feats = F.normalize(
+                    torch.as_tensor(video_feats[vid]).to(self.device).float(), dim=-1, eps=1e-5
+                )
+                assert len(feats) <= 75, (
+                    f"{vid}: the positional embedding of this pretrained CGDETR only support video "
+                    "up to 150 secs (i.e., 75 2-sec clips) in length"
+                )
+                clip_feats.append(feats)
+            video_input, video_mask = pad_sequences_1d(
+                [self._add_tef(feats) for feats in clip_feats],
+                dtype=torch.float32,
+                device=self.device,
+                fixed_length=None,
+            )
+            with span("cgdetr_forward", n_videos=len(batch_vids)):
+                outputs = self.model(
+                    src_txt=None,
+                    src_txt_mask=None,
+                    src_vid=video_input,
+                    src_vid_mask=video_mask,
+                    vid=None,
+                    qid=None,
+                    text_state=query["text_state"],
+                )
+            clip_scores = None
+            if return_clip_scores:
+                clip_scores = [(query["pooled"] @ feats.T)[0].cpu() for feats in clip_feats]
+            with span("postprocess"):
+                predictions.extend(
+                    self._compose_predictions(
+                        outputs,
+                        [query["query"]] * len(batch_vids),
+                        batch_vids,
+                        video_duration=[len(feats) * self.clip_len for feats in clip_feats],
+                        clip_scores=clip_scores,
+                        n_clips=[len(feats) for feats in clip_feats] if return_saliency else None,
+                    )
+                )
+        return predictions
+
+    def _add_tef(self, clip_video_feats):
+        # temporal endpoint features, the normalized start and end of every clip
+        n_frames = len(clip_video_feats)
+        tef_st = torch.arange(0, n_frames, 1.0) / n_frames
+        tef_ed = tef_st + 1.0 / n_frames
+        tef = torch.stack([tef_st, tef_ed], dim=1).to(self.device)  # (n_frames, 2)
+        return torch.cat([clip_video_feats, tef], dim=1)
+
+    def _predict(
+        self, clip_video_feats, query_list, video_path, return_clip_scores, return_saliency=False
+    ):
+        # construct model inputs
+        n_query = len(query_list)
+        n_frames = len(clip_video_feats)
+        # add tef
+        video_feats = self._add_tef(clip_video_feats)
         video_feats = video_feats.unsqueeze(0).repeat(n_query, 1, 1)  # (#text, T, d)
         video_mask = torch.ones(n_query, n_frames).to(self.device)
-        query_feats = self.feature_extractor.encode_text(query_list)  # #text * (L, d)
+        query_feats, query_pooled = self.feature_extractor.encode_text(
+            query_list, return_pooler=True
+        )  # #text * (L, d), (#text, d_joint)
+        if return_clip_scores:
+            query_pooled = F.normalize(query_pooled.float(), dim=-1, eps=1e-5)
+            clip_scores = (query_pooled @ clip_video_feats.float().T).cpu()  # (#text, T)
         query_feats, query_mask = pad_sequences_1d(
             query_feats, dtype=torch.float32, device=self.device, fixed_length=None
         )
@@ -75,7 +236,23 @@ class CGDETRPredictor:
         )
 
         # decode outputs
-        outputs = self.model(**model_inputs)
+        with span("cgdetr_forward", n_queries=n_query):
+            outputs = self.model(**model_inputs)
+        with span("postprocess"):
+            predictions = self._compose_predictions(
+                outputs,
+                query_list,
+                video_path,
+                video_duration=n_frames * self.clip_len,
+                clip_scores=clip_scores if return_clip_scores else None,
+                n_clips=n_frames if return_saliency else None,
+            )
+        return predictions
+
+    def _compose_predictions(
+        self, outputs, query_list, video_path, video_duration, clip_scores=None, n_clips=None
+    ):
+        # n_clips: int or list, number of valid clips per video, to return their saliency scores
         # #moment_queries refers to the positional embeddings in CGDETR's decoder, not the input text query
         prob = F.softmax(
             outputs["pred_logits"], -1
@@ -85,11 +262,20 @@ class CGDETRPredictor:
         ]  # * (batch_size, #moment_queries)  foreground label is 0, we directly take it
         pred_spans = outputs["pred_spans"]  # (bsz, #moment_queries, 2)
 
+        # one video for all queries, or one video per query
+        if isinstance(video_path, str):
+            video_path = [video_path] * len(query_list)
+        if not isinstance(video_duration, (list, tuple)):
+            video_duration = [video_duration] * len(query_list)
+        if n_clips is not None:
+            if not isinstance(n_clips, (list, tuple)):
+                n_clips = [n_clips] * len(query_list)
+            saliency_scores = outputs["saliency_scores"].float().cpu()  # (bsz, L)
+
         # compose predictions
         predictions = []
-        video_duration = n_frames * self.clip_len
         for idx, (spans, score) in enumerate(zip(pred_spans.cpu(), scores.cpu())):
-            spans = span_cxw_to_xx(spans) * video_duration
+            spans = span_cxw_to_xx(spans) * video_duration[idx]
             # # (#queries, 3), [st(float), ed(float), score(float)]
             cur_ranked_preds = torch.cat([spans, score[:, None]], dim=1).tolist()
             cur_ranked_preds = sorted(
@@ -100,9 +286,17 @@ class CGDETRPredictor:
             ]
             cur_query_pred = dict(
                 query=query_list[idx],  # str
-                vid=video_path,
+                vid=video_path[idx],
                 pred_relevant_windows=cur_ranked_preds,  # List([st(float), ed(float), score(float)])
             )
+            if clip_scores is not None:
+                cur_query_pred["pred_clip_scores"] = [
+                    float(f"{e:.4f}") for e in clip_scores[idx].tolist()
+                ]  # List(float), one per clip_len-sec clip
+            if n_clips is not None:
+                cur_query_pred["pred_saliency_scores"] = [
+                    float(f"{e:.4f}") for e in saliency_scores[idx, : n_clips[idx]].tolist()
+                ]  # List(float), one per clip_len-sec clip
             predictions.append(cur_query_pred)
 
         return predictions
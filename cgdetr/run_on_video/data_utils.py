@@ -1,52 +1,131 @@
 import torch
+import torch.nn.functional as F
 import numpy as np
 import ffmpeg
 import math
 import logging
+import threading
+from ..tracing import span
 from .clip import *
 
 class ClipFeatureExtractor:
-    def __init__(self, framerate=1/2, size=224, centercrop=True, model_name_or_path="ViT-B/32", device="cuda"):
+    def __init__(self, framerate=1/2, size=224, centercrop=True, model_name_or_path="ViT-B/32", device="cuda",
+                 scene_threshold=None):
+        """
+        Args:
+            scene_threshold: float or None, if set, a sampled clip is only encoded with CLIP when its
+                downscaled grayscale thumbnail differs from the last encoded one by more than this
+                mean absolute difference (in [0, 1]). Skipped clips reuse the previous feature, so the
+                output still has one feature per clip.
+        """
+        self.scene_threshold = scene_threshold
         self.video_loader = VideoLoader(framerate=framerate, size=size, centercrop=centercrop)
         logging.info("Loading CLIP models")
         self.clip_extractor, _ = clip.load(model_name_or_path, device=device, jit=False)
         self.tokenizer = clip.tokenize
-        self.video_preprocessor = Preprocessing()
+        self.video_preprocessor = Preprocessing(device=device)
         self.device = device
 
     @torch.no_grad()
     def encode_video(self, video_path: str, bsz=60):
-        video_frames = self.video_loader.read_video_from_file(video_path)  # (T, H, W, 3)
-        video_frames = self.video_preprocessor(video_frames)
-        n_frames = len(video_frames)
-        n_batch = int(math.ceil(n_frames / bsz))
-        video_features = []
-        for i in range(n_batch):
-            st_idx = i * bsz
-            ed_idx = (i+1) * bsz
-            _video_frames = video_frames[st_idx:ed_idx].to(self.device)
-            _video_features = self.clip_extractor.encode_image(_video_frames)
-            video_features.append(_video_features)
+        video_features = [event["features"] for event in self.iter_encode_video(video_path, bsz=bsz)
+                          if event["stage"] == "features"]
         video_features = torch.cat(video_features, dim=0)
         return video_features  # (T=#frames, d) torch tensor
 
     @torch.no_grad()
-    def encode_text(self, text_list, bsz=60):
+    def iter_encode_video(self, video_path: str, bsz=60):
+        """Decode and encode the video chunk by chunk, so callers can report progress.
+        Yields dicts with a "stage" key:
+            probe: info=dict, the ffprobe summary of the video
+            decode: n_frames=int, total=int or None, #clips decoded so far and the expected total
+            features: features=(n, d) torch tensor, n_frames=int, total=int or None, features of
+                the clips decoded last, concatenating all of them gives the encode_video output
+        """
+        with span("probe"):
+            info = self.video_loader._get_video_info(video_path)
+        total = self.video_loader.expected_n_frames(info)
+        yield dict(stage="probe", info=info)
+        n_decoded, n_encoded = 0, 0
+        reference, last_feature = None, None
+        for video_frames in self.video_loader.iter_video_from_file(video_path, chunk_size=bsz, info=info):
+            n_decoded += len(video_frames)
+            yield dict(stage="decode", n_frames=n_decoded, total=total)
+            if self.scene_threshold is None:
+                features = self._encode_frames(video_frames)
+            else:
+                keyframe_indices, clip_to_keyframe, reference = detect_keyframes(
+                    video_frames, self.scene_threshold, reference=reference)
+                n_encoded += len(keyframe_indices)
+                # index 0 holds the feature of the previous chunk's last clip, reused by clips marked -1
+                features = [] if last_feature is None else [last_feature[None]]
+                if keyframe_indices:
+                    features.append(self._encode_frames(video_frames[keyframe_indices]))
+                features = torch.cat(features, dim=0)
+                offset = 0 if last_feature is None else 1
+                # expand back to the full clip grid expected by CG-DETR
+                features = features[clip_to_keyframe.to(features.device) + offset]
+            last_feature = features[-1]
+            yield dict(stage="features", features=features, n_frames=n_decoded, total=total)
+        if self.scene_threshold is not None:
+            logging.info("Scene-aware sampling: encoded {} of {} clips".format(n_encoded, n_decoded))
+
+    def _encode_frames(self, video_frames):
+        # frames stay uint8 until they reach the target device
+        with span("preprocess"):
+            video_frames = self.video_preprocessor(video_frames)
+        with span("clip_visual", n_frames=len(video_frames)):
+            return self.clip_extractor.encode_image(video_frames)
+
+    @torch.no_grad()
+    def encode_text(self, text_list, bsz=60, return_pooler=False):
         n_text = len(text_list)
         n_batch = int(math.ceil(n_text / bsz))
         text_features = []
+        pooler_outputs = []
         for i in range(n_batch):
             st_idx = i * bsz
             ed_idx = (i+1) * bsz
-            encoded_texts = self.tokenizer(text_list[st_idx:ed_idx], context_length=77).to(self.device)
-            output = self.clip_extractor.encode_text(encoded_texts)
+            with span("clip_text", n_texts=len(text_list[st_idx:ed_idx])):
+                encoded_texts = self.tokenizer(text_list[st_idx:ed_idx], context_length=77).to(self.device)
+                output = self.clip_extractor.encode_text(encoded_texts)
             valid_lengths = (encoded_texts != 0).sum(1).tolist()
             batch_last_hidden_states = output["last_hidden_state"]
             for j, valid_len in enumerate(valid_lengths):
                 text_features.append(batch_last_hidden_states[j, :valid_len])
+            pooler_outputs.append(output["pooler_output"])
+        if return_pooler:
+            # pooler_output lives in the joint image-text space, comparable with encode_video features
+            return text_features, torch.cat(pooler_outputs, dim=0)  # List([L_j, d]), (#text, d_joint)
         return text_features  # List([L_j, d]) torch tensor
 
 
+def detect_keyframes(video_frames, threshold, thumb_size=32, reference=None):
+    """Find the clips that differ visibly from the last kept clip.
+    Args:
+        video_frames: (T, 3, H, W) uint8 torch tensor
+        threshold: float, minimum mean absolute difference in [0, 1] between grayscale
+            thumbnails of size (thumb_size, thumb_size) to start a new keyframe
+        reference: (thumb_size**2, ) tensor or None, thumbnail of the last keyframe of a previous
+            chunk. Without it, the first clip is always kept.
+    Returns:
+        keyframe_indices: list(int), indices of the clips to encode
+        clip_to_keyframe: (T, ) long tensor, position in keyframe_indices whose feature each clip
+            reuses, -1 for clips that reuse the feature of `reference`
+        reference: (thumb_size**2, ) tensor, thumbnail of the last keyframe, to pass on with the next chunk
+    """
+    thumbs = video_frames[:, :, ::4, ::4].float().mean(1, keepdim=True)  # (T, 1, H/4, W/4)
+    thumbs = F.adaptive_avg_pool2d(thumbs, thumb_size).flatten(1) / 255.0  # (T, thumb_size**2)
+    keyframe_indices = []
+    clip_to_keyframe = torch.zeros(len(thumbs), dtype=torch.long)
+    for idx in range(len(thumbs)):
+        if reference is None or (thumbs[idx] - reference).abs().mean() > threshold:
+            keyframe_indices.append(idx)
+            reference = thumbs[idx]
+        clip_to_keyframe[idx] = len(keyframe_indices) - 1
+    return keyframe_indices, clip_to_keyframe, reference
+
+
 def convert_to_float(frac_str):
     try:
         return float(frac_str)
@@ -78,16 +157,28 @@ class Normalize(object):
 
 
 class Preprocessing(object):
+    """Device-aware conversion of uint8 frames to normalised CLIP inputs.
+
+    The uint8 frames are uploaded as-is (4x fewer bytes than float32) and
+    `/255` plus mean/std normalisation are folded into a single fused
+    multiply-add on the target device, i.e. `x * scale + shift` with
+    `scale = 1 / (255 * std)` and `shift = -mean / std`.
+    """
 
-    def __init__(self):
+    def __init__(self, device="cpu"):
+        self.device = device
         self.norm = Normalize(
             mean=[0.48145466, 0.4578275, 0.40821073],
             std=[0.26862954, 0.26130258, 0.27577711])
+        std = self.norm.std + 1e-8
+        self.scale = (1.0 / (255.0 * std)).to(device)
+        self.shift = (-self.norm.mean / std).to(device)
 
     def __call__(self, tensor):
-        tensor = tensor / 255.0
-        tensor = self.norm(tensor)
-        return tensor
+        if tensor.dtype != torch.uint8:  # already float frames, e.g. from an older loader
+            return self.norm(tensor / 255.0).to(self.device)
+        tensor = tensor.to(self.device).float()
+        return torch.addcmul(self.shift, tensor, self.scale)
 
 
 class VideoLoader:
@@ -129,16 +220,13 @@ class VideoLoader:
         else:
             return self.size, int(w * self.size / h)
 
-    def read_video_from_file(self, video_path):
-        try:
-            info = self._get_video_info(video_path)
-            h, w = info["height"], info["width"]
-        except Exception as e:
-            logging.info(e)
-            logging.info('ffprobe failed at: {}'.format(video_path))
-            return {'video': torch.zeros(1), 'input': video_path,
-                    'info': {}}
-        height, width = self._get_output_dim(h, w)
+    def expected_n_frames(self, info):
+        """Number of sampled clips ffmpeg is expected to output, None if the duration is unknown"""
+        if info.get("duration", -1) <= 0:
+            return None
+        return int(math.ceil(info["duration"] * self._get_sample_rate(info)))
+
+    def _get_sample_rate(self, info):
         try:
             duration = info["duration"]
             fps = self.framerate
@@ -147,6 +235,12 @@ class VideoLoader:
                 logging.info(duration, fps)
         except Exception:
             fps = self.framerate
+        return fps
+
+    def _build_cmd(self, video_path, info):
+        h, w = info["height"], info["width"]
+        height, width = self._get_output_dim(h, w)
+        fps = self._get_sample_rate(info)
         cmd = (
             ffmpeg
             .input(video_path)
@@ -157,14 +251,56 @@ class VideoLoader:
             x = int((width - self.size) / 2.0)
             y = int((height - self.size) / 2.0)
             cmd = cmd.crop(x, y, self.size, self.size)
-        out, _ = (
-            cmd.output('pipe:', format='rawvideo', pix_fmt='rgb24')
-            .run(capture_stdout=True, quiet=True)
-        )
         if self.centercrop and isinstance(self.size, int):
             height, width = self.size, self.size
+        cmd = cmd.output('pipe:', format='rawvideo', pix_fmt='rgb24')
+        return cmd, height, width
+
+    def read_video_from_file(self, video_path):
+        try:
+            info = self._get_video_info(video_path)
+        except Exception as e:
+            logging.info(e)
+            logging.info('ffprobe failed at: {}'.format(video_path))
+            return {'video': torch.zeros(1), 'input': video_path,
+                    'info': {}}
+        cmd, height, width = self._build_cmd(video_path, info)
+        out, _ = cmd.run(capture_stdout=True, quiet=True)
         video = np.frombuffer(out, np.uint8).reshape(
             [-1, height, width, 3])
-        video = torch.from_numpy(video.astype('float32'))
+        # keep uint8, normalisation happens on the target device in `Preprocessing`
+        video = torch.from_numpy(video.copy())
         video = video.permute(0, 3, 1, 2)
         return video
+
+    def iter_video_from_file(self, video_path, chunk_size=60, info=None):
+        """Same as read_video_from_file, but yields (n<=chunk_size, 3, H, W) uint8 chunks
+        while ffmpeg is still decoding the rest of the video."""
+        if info is None:
+            info = self._get_video_info(video_path)
+        cmd, height, width = self._build_cmd(video_path, info)
+        frame_bytes = height * width * 3
+        process = cmd.global_args('-loglevel', 'error').run_async(pipe_stdout=True, pipe_stderr=True)
+        # drained by a thread, ffmpeg would block on a full stderr pipe
+        stderr = []
+        drain = threading.Thread(target=lambda: stderr.append(process.stderr.read()), daemon=True)
+        drain.start()
+        try:
+            while True:
+                with span("decode"):
+                    out = process.stdout.read(frame_bytes * chunk_size)
+                n_frames = len(out) // frame_bytes
+                if n_frames == 0:
+                    break
+                video = np.frombuffer(out[:n_frames * frame_bytes], np.uint8).reshape(
+                    [n_frames, height, width, 3])
+                yield torch.from_numpy(video.copy()).permute(0, 3, 1, 2)
+        finally:
+            process.stdout.close()
+            returncode = process.wait()
+            drain.join()
+            process.stderr.close()
+        # only reached when the whole stream was read, not when the consumer stopped early
+        if returncode != 0:
+            message = b"".join(stderr).decode("utf-8", errors="replace").strip()
+            raise RuntimeError(f"ffmpeg failed to decode {video_path} (exit code {returncode}): {message}")
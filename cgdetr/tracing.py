@@ -0,0 +1,19 @@
+"""Stage timing hooks, without a dependency on a tracing backend.
+
+`span` is a no-op until the application installs a tracer with `set_tracer`, any object with a
+`span(name, **attributes)` context manager, e.g. `swiss_adt.tracing.tracer`.
+"""
+import contextlib
+
+_tracer = None
+
+
+def set_tracer(tracer):
+    global _tracer
+    _tracer = tracer
+
+
+def span(name, **attributes):
+    if _tracer is None:
+        return contextlib.nullcontext()
+    return _tracer.span(name, **attributes)
@@ -41,6 +41,29 @@ def save_jsonl(data, filename):
         f.write("\n".join([json.dumps(e) for e in data]))
 
 
+class JsonlWriter:
+    """Write dicts to a jsonl file one at a time, in the same format as save_jsonl"""
+    def __init__(self, filename):
+        self.filename = filename
+        self.f = open(filename, "w")
+        self.count = 0
+
+    def write(self, e):
+        if self.count > 0:
+            self.f.write("\n")
+        self.f.write(json.dumps(e))
+        self.count += 1
+
+    def close(self):
+        self.f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
 def save_lines(list_of_str, filepath):
     with open(filepath, "w") as f:
         f.write("\n".join(list_of_str))
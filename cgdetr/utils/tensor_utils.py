@@ -1,6 +1,10 @@
 import numpy as np
 import torch
 
+# Above this many values per row, copying each sequence into place is bandwidth-bound and
+# concatenating first would only add a pass over the data
+_SCATTER_MAX_ROW_NUMEL = 128
+
 
 def pad_sequences_1d(sequences, dtype=torch.long, device=torch.device("cpu"), fixed_length=None):
     """ Pad a single-nested list or a sequence of n-d array (torch.tensor or np.ndarray)
@@ -26,30 +30,74 @@ def pad_sequences_1d(sequences, dtype=torch.long, device=torch.device("cpu"), fi
         >>> pad_sequences_1d(test_data_3d, dtype=np.float32)
     """
     if isinstance(sequences[0], list):
+        # one conversion for the whole batch instead of one tensor per sequence
+        lengths = [len(seq) for seq in sequences]
+        flat = [e for seq in sequences for e in seq]
         if "torch" in str(dtype):
-            sequences = [torch.tensor(s, dtype=dtype, device=device) for s in sequences]
+            flat = torch.tensor(flat, dtype=dtype, device=device)
+        else:
+            flat = np.asarray(flat, dtype=dtype)
+    else:
+        lengths = [len(seq) for seq in sequences]
+        if isinstance(sequences[0], torch.Tensor):
+            assert "torch" in str(dtype), "dtype and input type does not match"
+        else:  # np
+            assert "numpy" in str(dtype), "dtype and input type does not match"
+        if int(np.prod(sequences[0].shape[1:])) >= _SCATTER_MAX_ROW_NUMEL:
+            return _copy_padded(sequences, lengths, dtype, device, fixed_length)
+        if isinstance(sequences[0], torch.Tensor):
+            flat = torch.cat(list(sequences), dim=0).to(device=device, dtype=dtype)
         else:
-            sequences = [np.asarray(s, dtype=dtype) for s in sequences]
+            flat = np.concatenate([np.asarray(seq) for seq in sequences], axis=0).astype(dtype, copy=False)
+    return _scatter_padded(flat, lengths, dtype, device, fixed_length)
 
-    extra_dims = sequences[0].shape[1:]  # the extra dims should be the same for all elements
-    lengths = [len(seq) for seq in sequences]
-    if fixed_length is not None:
-        max_length = fixed_length
+
+def _allocate_padded(is_torch, lengths, extra_dims, dtype, device, fixed_length):
+    # zero-filled outputs with the mask already set, 1 for the first lengths[i] positions of row i
+    max_length = fixed_length if fixed_length is not None else max(lengths)
+    assert max(lengths) <= max_length, "sequences are longer than fixed_length"
+    bsz = len(lengths)
+    if is_torch:
+        lengths_t = torch.as_tensor(lengths, dtype=torch.long, device=device)
+        padded_seqs = torch.zeros((bsz, max_length) + extra_dims, dtype=dtype, device=device)
+        mask = torch.zeros((bsz, max_length), dtype=torch.float32, device=device)
+        torch.lt(torch.arange(max_length, device=device)[None], lengths_t[:, None], out=mask)
     else:
-        max_length = max(lengths)
-    if isinstance(sequences[0], torch.Tensor):
-        assert "torch" in str(dtype), "dtype and input type does not match"
-        padded_seqs = torch.zeros((len(sequences), max_length) + extra_dims, dtype=dtype, device=device)
-        mask = torch.zeros((len(sequences), max_length), dtype=torch.float32, device=device)
-    else:  # np
-        assert "numpy" in str(dtype), "dtype and input type does not match"
-        padded_seqs = np.zeros((len(sequences), max_length) + extra_dims, dtype=dtype)
-        mask = np.zeros((len(sequences), max_length), dtype=np.float32)
+        padded_seqs = np.zeros((bsz, max_length) + extra_dims, dtype=dtype)
+        mask = (np.arange(max_length)[None] < np.asarray(lengths)[:, None]).astype(np.float32)
+    return padded_seqs, mask
+
 
+def _copy_padded(sequences, lengths, dtype, device, fixed_length=None):
+    # wide rows: one contiguous copy per sequence straight into the output
+    is_torch = isinstance(sequences[0], torch.Tensor)
+    padded_seqs, mask = _allocate_padded(
+        is_torch, lengths, tuple(sequences[0].shape[1:]), dtype, device, fixed_length
+    )
     for idx, seq in enumerate(sequences):
-        end = lengths[idx]
-        padded_seqs[idx, :end] = seq
-        mask[idx, :end] = 1
+        padded_seqs[idx, : lengths[idx]] = seq
+    return padded_seqs, mask
+
+
+def _scatter_padded(flat, lengths, dtype, device, fixed_length=None):
+    # Write the concatenated rows of all sequences into the padded array with a single index_put:
+    # row j of sequence i goes to [i, j]
+    bsz = len(lengths)
+    is_torch = isinstance(flat, torch.Tensor)
+    padded_seqs, mask = _allocate_padded(
+        is_torch, lengths, tuple(flat.shape[1:]), dtype, device, fixed_length
+    )
+    if is_torch:
+        lengths_t = torch.as_tensor(lengths, dtype=torch.long, device=device)
+        rows = torch.repeat_interleave(torch.arange(bsz, device=device), lengths_t)
+        starts = torch.cumsum(lengths_t, 0) - lengths_t
+        cols = torch.arange(len(flat), device=device) - torch.repeat_interleave(starts, lengths_t)
+        padded_seqs[rows, cols] = flat
+    else:
+        lengths_np = np.asarray(lengths, dtype=np.int64)
+        rows = np.repeat(np.arange(bsz), lengths_np)
+        cols = np.arange(len(flat)) - np.repeat(np.cumsum(lengths_np) - lengths_np, lengths_np)
+        padded_seqs[rows, cols] = flat
     return padded_seqs, mask  # , lengths
 
 
@@ -58,7 +106,8 @@ def pad_sequences_2d(sequences, dtype=torch.long):
         only allow the first two dims has variable lengths
     Args:
         sequences: list(n-d tensor or list)
-        dtype: torch.long for word indices / torch.float (float32) for other cases
+        dtype: torch.long for word indices / torch.float (float32) for other cases,
+            or a numpy dtype for numpy arrays / lists
     Returns:
     Examples:
         >>> test_data_list = [[[1, 3, 5], [3, 7, 4, 1]], [[98, 34, 11, 89, 90], [22], [34, 56]],]
@@ -67,27 +116,30 @@ def pad_sequences_2d(sequences, dtype=torch.long):
         >>> pad_sequences_2d(test_data_3d, dtype=torch.float)  # torch.Size([2, 3, 5])
         >>> test_data_3d2 = [[torch.randn(2,4), ], [torch.randn(3,4), torch.randn(5,4)]]
         >>> pad_sequences_2d(test_data_3d2, dtype=torch.float)  # torch.Size([2, 3, 5])
-    # TODO add support for numpy array
+        >>> test_data_np = [[np.random.randn(2,4), ], [np.random.randn(3,4), np.random.randn(5,4)]]
+        >>> pad_sequences_2d(test_data_np, dtype=np.float32)  # (2, 2, 5, 4)
     """
     bsz = len(sequences)
     para_lengths = [len(seq) for seq in sequences]
     max_para_len = max(para_lengths)
-    sen_lengths = [[len(word_seq) for word_seq in seq] for seq in sequences]
-    max_sen_len = max([max(e) for e in sen_lengths])
 
-    if isinstance(sequences[0], torch.Tensor):
-        extra_dims = sequences[0].shape[2:]
-    elif isinstance(sequences[0][0], torch.Tensor):
-        extra_dims = sequences[0][0].shape[1:]
-    else:
-        sequences = [[torch.Tensor(word_seq, dtype=dtype) for word_seq in seq] for seq in sequences]
-        extra_dims = ()
+    # pad all sentences of the batch at once, then place them at their (paragraph, sentence) slot
+    sentences = [word_seq for seq in sequences for word_seq in seq]
+    if not isinstance(sentences[0], (torch.Tensor, np.ndarray)) and "torch" in str(dtype):
+        sentences = [list(word_seq) for word_seq in sentences]
+    padded_sentences, sentence_mask = pad_sequences_1d(sentences, dtype=dtype)
+    max_sen_len = padded_sentences.shape[1]
+    extra_dims = tuple(padded_sentences.shape[2:])
 
-    padded_seqs = torch.zeros((bsz, max_para_len, max_sen_len) + extra_dims, dtype=dtype)
-    mask = torch.zeros(bsz, max_para_len, max_sen_len).float()
-
-    for b_i in range(bsz):
-        for sen_i, sen_l in enumerate(sen_lengths[b_i]):
-            padded_seqs[b_i, sen_i, :sen_l] = sequences[b_i][sen_i]
-            mask[b_i, sen_i, :sen_l] = 1
+    rows = np.repeat(np.arange(bsz), para_lengths)
+    cols = np.arange(len(sentences)) - np.repeat(np.cumsum(para_lengths) - para_lengths, para_lengths)
+    if isinstance(padded_sentences, torch.Tensor):
+        rows, cols = torch.from_numpy(rows), torch.from_numpy(cols)
+        padded_seqs = torch.zeros((bsz, max_para_len, max_sen_len) + extra_dims, dtype=dtype)
+        mask = torch.zeros(bsz, max_para_len, max_sen_len).float()
+    else:
+        padded_seqs = np.zeros((bsz, max_para_len, max_sen_len) + extra_dims, dtype=dtype)
+        mask = np.zeros((bsz, max_para_len, max_sen_len), dtype=np.float32)
+    padded_seqs[rows, cols] = padded_sentences
+    mask[rows, cols] = sentence_mask
     return padded_seqs, mask  # , sen_lengths
@@ -1,2 +1,2 @@
-from .video_processor import extract_frames, save_subclip, encode_images
+from .video_processor import extract_frames, save_subclip, encode_images, rank_window_clips, FrameDeduplicator
 from .translator import Translator
@@ -0,0 +1,482 @@
+"""SQLite job queue and worker processes for the demo.
+
+The Streamlit app only submits jobs and polls their status; retrieval, subclip encoding, frame
+extraction and translation run in worker processes that load the models once. Every job gets its
+own directory under the jobs root, so concurrent users never overwrite each other's files.
+
+    python -m swiss_adt.jobs --root jobs --workers 4
+
+starts a pool serving the queue in `jobs/queue.db`, e.g. next to an app started with SWISS_ADT_WORKERS=0.
+The queue is SQLite in WAL mode, which needs a local filesystem: the jobs directory cannot be shared
+with another machine over a network filesystem.
+
+Running workers renew a lease on their job every few seconds; a running job whose lease has expired
+belonged to a dead worker and is put back in the queue by the next claim, unless the job already
+took down MAX_ATTEMPTS workers: then it is marked failed, so an input that crashes the workers does
+not block the queue forever. Finished jobs and their directories are deleted after a retention period.
+
+The workers store the histograms of their pipeline spans in the queue database after every job,
+`JobQueue.span_stats` sums them up for the metrics endpoint of the app.
+"""
+import argparse
+import json
+import logging
+import multiprocessing
+import os
+import shutil
+import sqlite3
+import threading
+import time
+import uuid
+
+import cv2
+
+logger = logging.getLogger(__name__)
+
+QUEUED, RUNNING, DONE, FAILED = "queued", "running", "done", "failed"
+
+HEARTBEAT_INTERVAL = 5  # seconds between two lease renewals of a running job
+LEASE_TIMEOUT = 60  # seconds without renewal after which a running job is considered orphaned
+MAX_ATTEMPTS = 3  # claims of a job whose workers all died before it is failed instead of requeued
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id TEXT PRIMARY KEY,
+    status TEXT NOT NULL,
+    params TEXT NOT NULL,
+    work_dir TEXT NOT NULL,
+    progress REAL NOT NULL DEFAULT 0,
+    message TEXT NOT NULL DEFAULT '',
+    result TEXT,
+    error TEXT,
+    worker TEXT,
+    created_at REAL NOT NULL,
+    started_at REAL,
+    finished_at REAL,
+    heartbeat_at REAL,
+    attempts INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, created_at);
+CREATE TABLE IF NOT EXISTS spans (
+    worker TEXT NOT NULL,
+    span TEXT NOT NULL,
+    count INTEGER NOT NULL,
+    sum REAL NOT NULL,
+    errors INTEGER NOT NULL,
+    buckets TEXT NOT NULL,
+    PRIMARY KEY (worker, span)
+);
+"""
+
+
+class JobQueue:
+    """Persistent FIFO of jobs in a SQLite database under `root`, shared by the UI and the workers.
+
+    Each call opens its own connection, so instances can be used from any thread or process.
+    """
+
+    def __init__(self, root="jobs"):
+        self.root = os.path.abspath(root)
+        os.makedirs(self.root, exist_ok=True)
+        self.db_path = os.path.join(self.root, "queue.db")
+        with self._connect() as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.executescript(_SCHEMA)
+            # databases created before the leases and the attempt counter
+            columns = {row["name"] for row in conn.execute("PRAGMA table_info(jobs)")}
+            if "heartbeat_at" not in columns:
+                conn.execute("ALTER TABLE jobs ADD COLUMN heartbeat_at REAL")
+            if "attempts" not in columns:
+                conn.execute("ALTER TABLE jobs ADD COLUMN attempts INTEGER NOT NULL DEFAULT 0")
+
+    def _connect(self):
+        conn = sqlite3.connect(self.db_path, timeout=30, isolation_level=None)
+        conn.row_factory = sqlite3.Row
+        return conn
+
+    def create(self):
+        # Reserve a job id and its directory, so the input files can be written before submitting
+        job_id = uuid.uuid4().hex
+        work_dir = os.path.join(self.root, job_id)
+        os.makedirs(work_dir)
+        return job_id, work_dir
+
+    def submit(self, job_id, params):
+        with self._connect() as conn:
+            conn.execute(
+                "INSERT INTO jobs (id, status, params, work_dir, created_at) VALUES (?, ?, ?, ?, ?)",
+                (job_id, QUEUED, json.dumps(params), os.path.join(self.root, job_id), time.time()),
+            )
+        return job_id
+
+    def claim(self, worker, lease_timeout=LEASE_TIMEOUT, max_attempts=MAX_ATTEMPTS):
+        # Atomically move the oldest queued job to running, None if the queue is empty.
+        # Jobs of workers that stopped renewing their lease are requeued (or failed) first.
+        conn = self._connect()
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            self._requeue_expired(conn, lease_timeout, max_attempts)
+            row = conn.execute(
+                "SELECT id FROM jobs WHERE status = ? ORDER BY created_at LIMIT 1", (QUEUED,)
+            ).fetchone()
+            if row is None:
+                conn.execute("COMMIT")
+                return None
+            now = time.time()
+            conn.execute(
+                "UPDATE jobs SET status = ?, worker = ?, started_at = ?, heartbeat_at = ?, attempts = attempts + 1 "
+                "WHERE id = ?",
+                (RUNNING, worker, now, now, row["id"]),
+            )
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        finally:
+            conn.close()
+        return self.get(row["id"])
+
+    def update(self, job_id, progress, message=""):
+        with self._connect() as conn:
+            conn.execute(
+                "UPDATE jobs SET progress = ?, message = ?, heartbeat_at = ? WHERE id = ?",
+                (progress, message, time.time(), job_id),
+            )
+
+    def heartbeat(self, job_id, worker):
+        # Renew the lease of a running job, False if it is no longer this worker's
+        with self._connect() as conn:
+            return conn.execute(
+                "UPDATE jobs SET heartbeat_at = ? WHERE id = ? AND status = ? AND worker = ?",
+                (time.time(), job_id, RUNNING, worker),
+            ).rowcount == 1
+
+    def complete(self, job_id, result, worker=None):
+        # With `worker`, only if the job is still this worker's, i.e. its lease did not expire meanwhile
+        with self._connect() as conn:
+            conn.execute(
+                "UPDATE jobs SET status = ?, progress = 1, message = '', result = ?, finished_at = ? "
+                "WHERE id = ? AND (? IS NULL OR worker = ?)",
+                (DONE, json.dumps(result), time.time(), job_id, worker, worker),
+            )
+
+    def fail(self, job_id, error, worker=None):
+        with self._connect() as conn:
+            conn.execute(
+                "UPDATE jobs SET status = ?, error = ?, finished_at = ? WHERE id = ? AND (? IS NULL OR worker = ?)",
+                (FAILED, error, time.time(), job_id, worker, worker),
+            )
+
+    @staticmethod
+    def _requeue_expired(conn, lease_timeout, max_attempts):
+        now = time.time()
+        expired = "status = ? AND COALESCE(heartbeat_at, started_at, 0) < ?"
+        failed = conn.execute(
+            f"UPDATE jobs SET status = ?, error = 'Worker died ' || attempts || ' times running this job', "
+            f"finished_at = ? WHERE {expired} AND attempts >= ?",
+            (FAILED, now, RUNNING, now - lease_timeout, max_attempts),
+        ).rowcount
+        if failed:
+            logger.error(f"Failed {failed} jobs whose workers died {max_attempts} times")
+        count = conn.execute(
+            "UPDATE jobs SET status = ?, worker = NULL, progress = 0, message = '', heartbeat_at = NULL "
+            f"WHERE {expired}",
+            (QUEUED, RUNNING, now - lease_timeout),
+        ).rowcount
+        if count:
+            logger.warning(f"Requeued {count} jobs of workers that stopped renewing their lease")
+        return count
+
+    def requeue_expired(self, lease_timeout=LEASE_TIMEOUT, max_attempts=MAX_ATTEMPTS):
+        # Jobs left running by workers that died, e.g. when the app was restarted; jobs of live
+        # workers keep being renewed and are left alone. Returns the number of jobs requeued.
+        with self._connect() as conn:
+            return self._requeue_expired(conn, lease_timeout, max_attempts)
+
+    def cleanup(self, retention):
+        """Delete the finished jobs older than `retention` seconds with their directories, and the
+        directories of jobs created but never submitted. Returns the number of jobs removed."""
+        cutoff = time.time() - retention
+        with self._connect() as conn:
+            rows = conn.execute(
+                "SELECT id, work_dir FROM jobs WHERE status IN (?, ?) AND finished_at < ?",
+                (DONE, FAILED, cutoff),
+            ).fetchall()
+            known = {row["id"] for row in conn.execute("SELECT id FROM jobs")}
+        for row in rows:
+            shutil.rmtree(row["work_dir"], ignore_errors=True)
+            with self._connect() as conn:
+                conn.execute("DELETE FROM jobs WHERE id = ?", (row["id"],))
+        for name in os.listdir(self.root):
+            path = os.path.join(self.root, name)
+            if name not in known and os.path.isdir(path) and os.path.getmtime(path) < cutoff:
+                shutil.rmtree(path, ignore_errors=True)
+        if rows:
+            logger.info(f"Deleted {len(rows)} jobs finished more than {retention} seconds ago")
+        return len(rows)
+
+    def save_spans(self, worker, snapshot):
+        # Replace the span histograms of a worker with its `Tracer.snapshot()`, they are cumulative
+        with self._connect() as conn:
+            conn.executemany(
+                "INSERT OR REPLACE INTO spans (worker, span, count, sum, errors, buckets) VALUES (?, ?, ?, ?, ?, ?)",
+                [
+                    (worker, name, s["count"], s["sum"], s["errors"], json.dumps(s["buckets"]))
+                    for name, s in snapshot.items()
+                ],
+            )
+
+    def span_stats(self):
+        # Span histograms summed over all the workers that ever served the queue, as a collector
+        # for `Tracer.add_collector`; rows of stopped workers are kept so the counters never go down
+        stats = {}
+        with self._connect() as conn:
+            rows = conn.execute("SELECT span, count, sum, errors, buckets FROM spans").fetchall()
+        for row in rows:
+            buckets = json.loads(row["buckets"])
+            total = stats.setdefault(row["span"], dict(count=0, sum=0.0, errors=0, buckets=[0] * len(buckets)))
+            total["count"] += row["count"]
+            total["sum"] += row["sum"]
+            total["errors"] += row["errors"]
+            total["buckets"] = [a + b for a, b in zip(total["buckets"], buckets)]
+        return stats
+
+    def get(self, job_id):
+        with self._connect() as conn:
+            row = conn.execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        if row is None:
+            return None
+        job = dict(row)
+        job["params"] = json.loads(job["params"])
+        job["result"] = json.loads(job["result"]) if job["result"] else None
+        return job
+
+    def position(self, job_id):
+        # Number of queued jobs ahead of this one
+        with self._connect() as conn:
+            return conn.execute(
+                "SELECT COUNT(*) FROM jobs WHERE status = ? AND created_at < "
+                "(SELECT created_at FROM jobs WHERE id = ?)",
+                (QUEUED, job_id),
+            ).fetchone()[0]
+
+
+def run_job(job, predictor, translator, progress=None):
+    """Retrieve the moment of the audio description, extract its frames and translate it.
+    args:
+        job: dict: The job as returned by `JobQueue.get`, its video is `input.mp4` in the job directory
+        predictor: CGDETRPredictor
+        translator: Translator
+        progress: Callable[[float, str], None]: Called with the fraction done and a status message
+    return:
+        dict: moment window, paths of the moment subclip and frames, translations per target language
+    """
+    from .video_processor import FrameDeduplicator, extract_frames, rank_window_clips, save_subclip
+
+    progress = progress or (lambda fraction, message: None)
+    params, work_dir = job["params"], job["work_dir"]
+    vid_file = os.path.join(work_dir, "input.mp4")
+    moment_file = os.path.join(work_dir, "moment.mp4")
+    extraction = params["extraction"]
+
+    def on_event(event):
+        if event["stage"] == "features" and event["total"]:
+            done = min(event["n_frames"] / event["total"], 1.0)
+            progress(0.6 * done, f"Encoded {event['n_frames']} of ~{event['total']} clips")
+
+    progress(0.0, "Reading video ...")
+    predictions = predictor.localize_moment(
+        video_path=vid_file,
+        query_list=[params["audio_description"]],
+        return_clip_scores=extraction["option"] == "Most relevant clips",
+        return_saliency=extraction["option"] == "Highest saliency clips",
+        progress_callback=on_event,
+    )
+    moment = predictions[0]["pred_relevant_windows"][0]
+    progress(0.6, "Saving the moment ...")
+    save_subclip(vid_file, moment_file, moment[0], moment[1])
+
+    progress(0.7, "Extracting frames ...")
+    if extraction["option"] == "Every nth frame":
+        frames = extract_frames(moment_file, nth_frame=extraction["value"], num_frames=None)
+    elif extraction["option"] == "Most diverse frames":
+        frames = extract_frames(moment_file, diverse_frames=extraction["value"])
+    elif extraction["option"] == "Highest saliency clips":
+        # Extract the frames from the clips CG-DETR scores as most salient for the audio description
+        timestamps = rank_window_clips(
+            predictions[0]["pred_saliency_scores"],
+            moment,
+            clip_len=predictor.clip_len,
+            top_k=extraction["value"],
+        )
+        frames = extract_frames(moment_file, timestamps=timestamps)
+    elif extraction["option"] == "Most relevant clips":
+        # Extract the frames from the clips most similar to the audio description
+        timestamps = rank_window_clips(
+            predictions[0]["pred_clip_scores"],
+            moment,
+            clip_len=predictor.clip_len,
+            top_k=extraction["value"],
+        )
+        frames = extract_frames(moment_file, timestamps=timestamps)
+    else:
+        frames = extract_frames(moment_file, num_frames=extraction["value"], nth_frame=None)
+    frames = list(frames)
+
+    frame_files = []
+    for i, frame in enumerate(frames):
+        frame_file = os.path.join(work_dir, f"frame_{i:03d}.png")
+        cv2.imwrite(frame_file, cv2.cvtColor(frame, cv2.COLOR_RGB2BGR))
+        frame_files.append(frame_file)
+
+    progress(0.8, "Translating the audio description ...")
+    translations = translator.translate_segment_multi(
+        text=params["audio_description"],
+        # a deduplicator per job, so no frame of another job can be matched or sent
+        images=FrameDeduplicator().dedup(frames),
+        source_language=params["source_language"],
+        target_languages=params["target_languages"],
+    )
+    return dict(
+        moment=moment, moment_file=moment_file, frame_files=frame_files, translations=translations
+    )
+
+
+def process_job(queue, worker, job, predictor, translator):
+    # Run a claimed job, record its outcome unless the lease was lost, and publish the spans it recorded
+    from .tracing import tracer
+
+    logger.info(f"Worker {worker} running job {job['id']}")
+    try:
+        result = run_job(
+            job, predictor, translator,
+            progress=lambda fraction, message: queue.update(job["id"], fraction, message),
+        )
+    except Exception as e:
+        logger.exception(f"Job {job['id']} failed")
+        queue.fail(job["id"], f"{type(e).__name__}: {e}", worker)
+    else:
+        queue.complete(job["id"], result, worker)
+    finally:
+        try:
+            queue.save_spans(worker, tracer.snapshot())
+        except sqlite3.Error:
+            logger.exception("Could not save the span metrics")
+
+
+def _renew_lease(queue, worker, current):
+    # Heartbeat thread of a worker, renews the lease of the job it is running
+    while True:
+        time.sleep(HEARTBEAT_INTERVAL)
+        job_id = current.get("id")
+        if job_id is not None:
+            try:
+                queue.heartbeat(job_id, worker)
+            except sqlite3.Error:
+                logger.exception(f"Could not renew the lease of job {job_id}")
+
+
+def worker_main(root, worker, device="cpu", num_threads=None, poll_interval=0.5, retention=24 * 3600,
+                cleanup_interval=600):
+    """Serve the queue until interrupted: load the models once, then claim and run jobs one at a time.
+    Every `cleanup_interval` seconds, finished jobs older than `retention` seconds are deleted
+    (never if `retention` is None)."""
+    if num_threads:
+        import torch
+
+        torch.set_num_threads(num_threads)
+    from cgdetr import CGDETRPredictor, set_tracer
+    from .tracing import tracer
+    from .translator import Translator
+
+    # time the retrieval stages with the same tracer as the rest of the pipeline
+    set_tracer(tracer)
+
+    logging.basicConfig(level=logging.INFO)
+    queue = JobQueue(root)
+    predictor = CGDETRPredictor(device=device)
+    translator = Translator(
+        api_key=os.environ.get("OPENAI_API_KEY", ""),
+        base_url=os.environ.get("OPENAI_BASE_URL", "https://api.openai.com/v1"),
+    )
+    logger.info(f"Worker {worker} ready")
+
+    current = {}
+    threading.Thread(target=_renew_lease, args=(queue, worker, current), daemon=True).start()
+    last_cleanup = 0.0
+    while True:
+        if retention is not None and time.monotonic() - last_cleanup > cleanup_interval:
+            queue.cleanup(retention)
+            last_cleanup = time.monotonic()
+        job = queue.claim(worker)
+        if job is None:
+            time.sleep(poll_interval)
+            continue
+        current["id"] = job["id"]
+        try:
+            process_job(queue, worker, job, predictor, translator)
+        finally:
+            current.pop("id", None)
+
+
+class WorkerPool:
+    """Worker processes serving a `JobQueue`, each owning its own models.
+
+    The CPU threads are split between the workers, so jobs run in parallel instead of
+    oversubscribing the cores.
+    """
+
+    def __init__(self, root="jobs", n_workers=None, device="cpu", retention=24 * 3600):
+        self.root = root
+        self.n_workers = n_workers or max(1, (os.cpu_count() or 1) // 4)
+        self.device = device
+        self.retention = retention
+        self.processes = []
+
+    def start(self):
+        # Only jobs whose lease expired are requeued, those of other live pools keep running
+        JobQueue(self.root).requeue_expired()
+        num_threads = max(1, (os.cpu_count() or 1) // self.n_workers)
+        # spawn rather than fork, torch and the Streamlit threads do not survive a fork
+        context = multiprocessing.get_context("spawn")
+        for i in range(self.n_workers):
+            process = context.Process(
+                target=worker_main,
+                args=(self.root, f"{os.getpid()}-{i}", self.device, num_threads),
+                kwargs=dict(retention=self.retention),
+                daemon=True,
+            )
+            process.start()
+            self.processes.append(process)
+        return self
+
+    def stop(self):
+        for process in self.processes:
+            process.terminate()
+        for process in self.processes:
+            process.join()
+        self.processes = []
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--root", default="jobs", help="directory of the queue database and job directories")
+    parser.add_argument("--workers", type=int, default=None, help="defaults to one worker per 4 cores")
+    parser.add_argument("--device", default="cpu")
+    parser.add_argument("--retention_hours", type=float, default=24,
+                        help="delete finished jobs and their files after this many hours, 0 to keep them")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    retention = args.retention_hours * 3600 if args.retention_hours > 0 else None
+    pool = WorkerPool(args.root, args.workers, args.device, retention=retention).start()
+    logger.info(f"Started {pool.n_workers} workers on {os.path.abspath(args.root)}")
+    try:
+        for process in pool.processes:
+            process.join()
+    except KeyboardInterrupt:
+        pool.stop()
+
+
+if __name__ == "__main__":
+    main()
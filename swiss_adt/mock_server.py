@@ -0,0 +1,306 @@
+"""Local stand-in for the OpenAI chat completions API, for offline load tests of `Translator`.
+
+    python -m swiss_adt.mock_server --port 8000 --latency 0.5 --rate_429 0.1 --rate_5xx 0.05
+
+then point the translator at it with `Translator(api_key="mock", base_url="http://127.0.0.1:8000/v1")`
+or `OPENAI_BASE_URL=http://127.0.0.1:8000/v1` for the demo. `GET /stats` reports the number of
+requests per status code and the peak number of concurrent requests.
+
+The Batch API is mocked as well (`POST /v1/files`, `POST /v1/batches`, `GET /v1/batches/{id}`,
+`GET /v1/files/{id}/content`): a batch is processed in a background thread, each line drawing
+its outcome like a synchronous request, and failed lines are reported in the error file.
+"""
+import argparse
+import itertools
+import json
+import random
+import threading
+import time
+from email.parser import BytesParser
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class MockChatServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(
+        self,
+        host="127.0.0.1",
+        port=0,
+        latency=0.0,
+        jitter=0.0,
+        rate_429=0.0,
+        rate_5xx=0.0,
+        retry_after=1.0,
+        response_words=8,
+        seed=0,
+    ):
+        """
+        Args:
+            latency: float, seconds every request takes
+            jitter: float, uniform random extra latency in [0, jitter] seconds
+            rate_429: float, fraction of requests answered with 429 and a Retry-After header
+            rate_5xx: float, fraction of requests answered with 500/502/503
+            retry_after: float, value of the Retry-After header in seconds
+            response_words: int, number of words of the returned translation
+            seed: int, seed of the random generator deciding latency jitter and injected errors
+        """
+        super().__init__((host, port), _MockChatHandler)
+        self.latency = latency
+        self.jitter = jitter
+        self.rate_429 = rate_429
+        self.rate_5xx = rate_5xx
+        self.retry_after = retry_after
+        self.response_words = response_words
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self.status_counts = {}
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.files = {}
+        self.batches = {}
+        self._ids = itertools.count()
+
+    @property
+    def base_url(self):
+        return f"http://{self.server_address[0]}:{self.server_address[1]}/v1"
+
+    def start(self):
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+    def draw(self):
+        # Decide latency and injected error of a request, under the lock so a seed gives
+        # the same sequence of outcomes regardless of thread scheduling
+        with self._lock:
+            delay = self.latency + self._random.uniform(0, self.jitter)
+            p = self._random.random()
+            if p < self.rate_429:
+                return delay, 429
+            if p < self.rate_429 + self.rate_5xx:
+                return delay, self._random.choice([500, 502, 503])
+            return delay, 200
+
+    def count(self, status, delta_in_flight=0):
+        with self._lock:
+            if status is not None:
+                self.status_counts[status] = self.status_counts.get(status, 0) + 1
+            self.in_flight += delta_in_flight
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+
+    def new_id(self, prefix):
+        with self._lock:
+            return f"{prefix}-mock{next(self._ids)}"
+
+    def add_file(self, content, purpose):
+        file_id = self.new_id("file")
+        self.files[file_id] = dict(
+            id=file_id, object="file", bytes=len(content), purpose=purpose,
+            created_at=int(time.time()), content=content,
+        )
+        return file_id
+
+    def create_batch(self, input_file_id, endpoint):
+        batch_id = self.new_id("batch")
+        batch = dict(
+            id=batch_id, object="batch", endpoint=endpoint, input_file_id=input_file_id,
+            completion_window="24h", status="validating", created_at=int(time.time()),
+            output_file_id=None, error_file_id=None,
+            request_counts=dict(total=0, completed=0, failed=0),
+        )
+        self.batches[batch_id] = batch
+        threading.Thread(target=self._run_batch, args=(batch,), daemon=True).start()
+        return batch
+
+    def _run_batch(self, batch):
+        lines = [line for line in self.files[batch["input_file_id"]]["content"].splitlines() if line.strip()]
+        batch["request_counts"]["total"] = len(lines)
+        batch["status"] = "in_progress"
+        outputs, errors = [], []
+        for line in lines:
+            request = json.loads(line)
+            delay, status = self.draw()
+            time.sleep(delay)
+            if status == 200:
+                content = _MockChatHandler._content(request["body"], self.response_words)
+                body = _MockChatHandler._completion(request["body"]["model"], content)
+                outputs.append(dict(custom_id=request["custom_id"], response=dict(status_code=200, body=body), error=None))
+                batch["request_counts"]["completed"] += 1
+            else:
+                body = {"error": {"message": "The server had an error", "type": "server_error"}}
+                errors.append(dict(custom_id=request["custom_id"], response=dict(status_code=status, body=body), error=None))
+                batch["request_counts"]["failed"] += 1
+        if outputs:
+            batch["output_file_id"] = self.add_file(b"".join(json.dumps(o).encode() + b"\n" for o in outputs), "batch_output")
+        if errors:
+            batch["error_file_id"] = self.add_file(b"".join(json.dumps(e).encode() + b"\n" for e in errors), "batch_output")
+        batch["completed_at"] = int(time.time())
+        batch["status"] = "completed"
+
+    def stats(self):
+        with self._lock:
+            return dict(
+                status_counts={str(k): v for k, v in self.status_counts.items()},
+                requests=sum(self.status_counts.values()),
+                max_in_flight=self.max_in_flight,
+            )
+
+
+class _MockChatHandler(BaseHTTPRequestHandler):
+    server: MockChatServer
+
+    def do_GET(self):
+        path = self.path.rstrip("/")
+        if path == "/stats":
+            self._send_json(200, self.server.stats())
+        elif path.startswith("/v1/batches/") and path[len("/v1/batches/"):] in self.server.batches:
+            self._send_json(200, self.server.batches[path[len("/v1/batches/"):]])
+        elif path.startswith("/v1/files/") and path.endswith("/content"):
+            file = self.server.files.get(path[len("/v1/files/"):-len("/content")])
+            if file is None:
+                self._error(404, "No such file", "invalid_request_error")
+            else:
+                self._send_bytes(200, file["content"], "application/jsonl")
+        else:
+            self._error(404, "Not found", "invalid_request_error")
+
+    def do_POST(self):
+        self.server.count(None, delta_in_flight=1)
+        try:
+            status = self._handle_post()
+        finally:
+            self.server.count(None, delta_in_flight=-1)
+        self.server.count(status)
+
+    def _handle_post(self):
+        raw_body = self._read_body()
+        if self.path.rstrip("/") == "/v1/files":
+            return self._upload_file(raw_body)
+        if self.path.rstrip("/") == "/v1/batches":
+            return self._create_batch(raw_body)
+        if self.path.rstrip("/") != "/v1/chat/completions":
+            return self._error(404, "Unknown endpoint", "invalid_request_error")
+        try:
+            body = json.loads(raw_body)
+            assert isinstance(body["model"], str) and body["messages"]
+        except (ValueError, KeyError, TypeError, AssertionError):
+            return self._error(400, "Invalid chat completions request", "invalid_request_error")
+
+        delay, status = self.server.draw()
+        time.sleep(delay)
+        if status == 429:
+            return self._error(
+                429, "Rate limit reached", "rate_limit_error",
+                headers={"Retry-After": str(self.server.retry_after)},
+            )
+        if status != 200:
+            return self._error(status, "The server had an error", "server_error")
+        return self._send_json(200, self._completion(body["model"], self._content(body, self.server.response_words)))
+
+    def _read_body(self):
+        if self.headers.get("Transfer-Encoding", "").lower() != "chunked":
+            return self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        chunks = []
+        while True:
+            size = int(self.rfile.readline().split(b";")[0].strip(), 16)
+            if size == 0:
+                # skip optional trailers up to the final empty line
+                while self.rfile.readline().strip():
+                    pass
+                return b"".join(chunks)
+            chunks.append(self.rfile.read(size))
+            self.rfile.readline()
+
+    def _upload_file(self, raw_body):
+        # multipart/form-data with a "purpose" field and a "file" part
+        header = f"Content-Type: {self.headers.get('Content-Type', '')}\r\n\r\n".encode()
+        message = BytesParser().parsebytes(header + raw_body)
+        fields = {}
+        if message.is_multipart():
+            for part in message.get_payload():
+                fields[part.get_param("name", header="content-disposition")] = part.get_payload(decode=True)
+        if "file" not in fields or fields.get("purpose") != b"batch":
+            return self._error(400, "Expected a batch file upload", "invalid_request_error")
+        file_id = self.server.add_file(fields["file"], "batch")
+        file = {k: v for k, v in self.server.files[file_id].items() if k != "content"}
+        return self._send_json(200, file)
+
+    def _create_batch(self, raw_body):
+        try:
+            body = json.loads(raw_body)
+            assert body["input_file_id"] in self.server.files
+            assert body["endpoint"] == "/v1/chat/completions"
+        except (ValueError, KeyError, TypeError, AssertionError):
+            return self._error(400, "Invalid batch request", "invalid_request_error")
+        return self._send_json(200, self.server.create_batch(body["input_file_id"], body["endpoint"]))
+
+    @staticmethod
+    def _content(body, response_words):
+        # Structured output requests get a JSON object with a translation per schema property
+        translation = " ".join(["traduction"] * response_words)
+        response_format = body.get("response_format") or {}
+        if response_format.get("type") == "json_schema":
+            schema = response_format["json_schema"]["schema"]
+            return json.dumps({key: translation for key in schema.get("properties", {})})
+        return translation
+
+    @staticmethod
+    def _completion(model, content):
+        return {
+            "id": "chatcmpl-mock",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": model,
+            "choices": [
+                {
+                    "index": 0,
+                    "message": {"role": "assistant", "content": content},
+                    "finish_reason": "stop",
+                }
+            ],
+            "usage": {"prompt_tokens": 0, "completion_tokens": len(content.split()), "total_tokens": 0},
+        }
+
+    def _error(self, status, message, error_type, headers=None):
+        return self._send_json(status, {"error": {"message": message, "type": error_type}}, headers)
+
+    def _send_json(self, status, payload, headers=None):
+        return self._send_bytes(status, json.dumps(payload).encode("utf-8"), "application/json", headers)
+
+    def _send_bytes(self, status, body, content_type, headers=None):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(body)
+        return status
+
+    def log_message(self, format, *args):
+        pass
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--latency", type=float, default=0.0)
+    parser.add_argument("--jitter", type=float, default=0.0)
+    parser.add_argument("--rate_429", type=float, default=0.0)
+    parser.add_argument("--rate_5xx", type=float, default=0.0)
+    parser.add_argument("--retry_after", type=float, default=1.0)
+    parser.add_argument("--response_words", type=int, default=8)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    server = MockChatServer(**vars(args))
+    print(f"Mock chat completions server listening on {server.base_url}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    main()
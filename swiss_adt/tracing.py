@@ -0,0 +1,178 @@
+import json
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Iterable, Iterator
+
+logger = logging.getLogger(__name__)
+
+# Histogram buckets in seconds, from single frames up to whole videos / slow API calls
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+
+class _SpanStats:
+    def __init__(self, buckets):
+        self.count = 0
+        self.sum = 0.0
+        self.errors = 0
+        self.bucket_counts = [0] * len(buckets)
+
+
+class Tracer:
+    """Records the duration of named pipeline stages.
+
+    Durations are aggregated into Prometheus histograms, served in the text exposition
+    format by `start_http_server`, and optionally logged as one JSON line per span.
+    Spans recorded in other processes are exported by adding a collector that returns their
+    `snapshot()`, e.g. read back from a shared store.
+    Spans around GPU work measure the host side only, unless the code inside synchronises.
+    """
+
+    def __init__(self, buckets=DEFAULT_BUCKETS, json_logs=False):
+        self.buckets = tuple(buckets)
+        self.json_logs = json_logs
+        self._stats = {}
+        self._collectors = []
+        self._lock = threading.Lock()
+        self._server = None
+
+    @contextmanager
+    def span(self, name: str, **attributes):
+        start = time.perf_counter()
+        error = None
+        try:
+            yield
+        except BaseException as e:
+            error = type(e).__name__
+            raise
+        finally:
+            self.record(name, time.perf_counter() - start, error=error, **attributes)
+
+    def iter(self, name: str, iterable: Iterable, **attributes) -> Iterator:
+        # Time only the production of the items, not what the consumer does in between
+        iterator = iter(iterable)
+        while True:
+            start = time.perf_counter()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+            except BaseException as e:
+                self.record(name, time.perf_counter() - start, error=type(e).__name__, **attributes)
+                raise
+            self.record(name, time.perf_counter() - start, **attributes)
+            yield item
+
+    def record(self, name: str, duration: float, error=None, **attributes):
+        with self._lock:
+            stats = self._stats.get(name)
+            if stats is None:
+                stats = self._stats[name] = _SpanStats(self.buckets)
+            stats.count += 1
+            stats.sum += duration
+            if error is not None:
+                stats.errors += 1
+            for i, bound in enumerate(self.buckets):
+                if duration <= bound:
+                    stats.bucket_counts[i] += 1
+        if self.json_logs:
+            record = dict(span=name, duration_s=round(duration, 6), error=error)
+            record.update(attributes)
+            logger.info(json.dumps(record, default=str))
+
+    def reset(self):
+        with self._lock:
+            self._stats = {}
+
+    def summary(self) -> dict:
+        with self._lock:
+            return {
+                name: dict(count=s.count, total_s=s.sum, errors=s.errors)
+                for name, s in self._stats.items()
+            }
+
+    def snapshot(self) -> dict:
+        # Histograms of the spans recorded so far: {name: dict(count, sum, errors, buckets)}
+        with self._lock:
+            return {
+                name: dict(count=s.count, sum=s.sum, errors=s.errors, buckets=list(s.bucket_counts))
+                for name, s in self._stats.items()
+            }
+
+    def add_collector(self, collect):
+        # `collect()` returns histograms in the format of `snapshot`, exported with those of this tracer
+        self._collectors.append(collect)
+
+    def _collect(self) -> dict:
+        merged = self.snapshot()
+        for collect in self._collectors:
+            try:
+                snapshot = collect()
+            except Exception:
+                logger.exception("Span collector failed")
+                continue
+            for name, stats in snapshot.items():
+                total = merged.setdefault(
+                    name, dict(count=0, sum=0.0, errors=0, buckets=[0] * len(self.buckets))
+                )
+                total["count"] += stats["count"]
+                total["sum"] += stats["sum"]
+                total["errors"] += stats["errors"]
+                total["buckets"] = [a + b for a, b in zip(total["buckets"], stats["buckets"])]
+        return merged
+
+    def render_prometheus(self) -> str:
+        lines = [
+            "# HELP swiss_adt_span_seconds Duration of pipeline stages in seconds.",
+            "# TYPE swiss_adt_span_seconds histogram",
+        ]
+        error_lines = [
+            "# HELP swiss_adt_span_errors_total Pipeline stages that raised an exception.",
+            "# TYPE swiss_adt_span_errors_total counter",
+        ]
+        for name, stats in sorted(self._collect().items()):
+            # bucket counts are already cumulative, as Prometheus expects
+            for bound, count in zip(self.buckets, stats["buckets"]):
+                lines.append(
+                    f'swiss_adt_span_seconds_bucket{{span="{name}",le="{bound}"}} {count}'
+                )
+            lines.append(
+                f'swiss_adt_span_seconds_bucket{{span="{name}",le="+Inf"}} {stats["count"]}'
+            )
+            lines.append(f'swiss_adt_span_seconds_sum{{span="{name}"}} {stats["sum"]}')
+            lines.append(f'swiss_adt_span_seconds_count{{span="{name}"}} {stats["count"]}')
+            error_lines.append(f'swiss_adt_span_errors_total{{span="{name}"}} {stats["errors"]}')
+        return "\n".join(lines + error_lines) + "\n"
+
+    def start_http_server(self, port: int = 9464, addr: str = "127.0.0.1"):
+        # Serve the metrics at http://addr:port/metrics from a daemon thread
+        if self._server is not None:
+            return self._server
+        tracer = self
+
+        class MetricsHandler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split("?")[0] != "/metrics":
+                    self.send_error(404)
+                    return
+                body = tracer.render_prometheus().encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self._server = ThreadingHTTPServer((addr, port), MetricsHandler)
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+        logger.info(f"Serving span metrics on http://{addr}:{port}/metrics")
+        return self._server
+
+
+tracer = Tracer(json_logs=os.environ.get("SWISS_ADT_TRACE_JSON", "") not in ("", "0"))
+span = tracer.span
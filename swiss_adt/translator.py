@@ -1,15 +1,126 @@
-import backoff
 import requests
+import json
 import logging
+import os
+import random
+import re
+import tempfile
+import threading
 import time
+from concurrent.futures import ThreadPoolExecutor
+from email.utils import parsedate_to_datetime
+from .tracing import span
 
 logging.basicConfig(level=logging.INFO)
 
 
 class ServerError(Exception):
+    """Retryable error, optionally with the delay the server asked for"""
+
+    def __init__(self, message, retry_after=None):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class RateLimitError(ServerError):
     pass
 
 
+class ClientError(Exception):
+    """Request rejected by the API (4xx other than 429), retrying would not help"""
+
+    def __init__(self, message, status_code=None):
+        super().__init__(message)
+        self.status_code = status_code
+
+
+def _parse_duration(value):
+    # OpenAI rate limit reset headers look like "1s", "6m0s", "20ms" or "1h2m3.5s"
+    units = {"h": 3600, "m": 60, "s": 1, "ms": 0.001}
+    parts = re.findall(r"(\d+(?:\.\d+)?)(ms|h|m|s)", value)
+    if not parts:
+        return float(value)
+    return sum(float(number) * units[unit] for number, unit in parts)
+
+
+def parse_retry_after(headers):
+    """Seconds to wait before retrying according to the response headers, None if not given"""
+    if "retry-after-ms" in headers:
+        try:
+            return float(headers["retry-after-ms"]) / 1000
+        except ValueError:
+            pass
+    if "retry-after" in headers:
+        value = headers["retry-after"]
+        try:
+            return max(float(value), 0.0)
+        except ValueError:
+            try:
+                return max(parsedate_to_datetime(value).timestamp() - time.time(), 0.0)
+            except (TypeError, ValueError):
+                pass
+    resets = []
+    for key in ("x-ratelimit-reset-requests", "x-ratelimit-reset-tokens"):
+        remaining = headers.get(key.replace("reset", "remaining"))
+        if key in headers and remaining in (None, "0"):
+            try:
+                resets.append(_parse_duration(headers[key]))
+            except ValueError:
+                pass
+    return max(resets) if resets else None
+
+
+def retry_after_or_expo(base=2, factor=1, max_value=60):
+    """Wait generator, sent the exception of each failed attempt: the server's Retry-After if the
+    exception carries one, otherwise full-jitter exponential backoff"""
+    exception = yield
+    n = 0
+    while True:
+        retry_after = getattr(exception, "retry_after", None)
+        if retry_after is not None:
+            # small positive jitter so clients rejected together do not come back together
+            exception = yield retry_after * (1 + 0.1 * random.random())
+        else:
+            exception = yield random.uniform(0, min(factor * base**n, max_value))
+            n += 1
+
+
+class AdaptiveConcurrencyLimiter:
+    """Limits the number of in-flight requests with AIMD: the limit grows by about one per
+    window of successful requests and is multiplied by `decrease_factor` on congestion, i.e. rate
+    limiting, server errors and network errors (at most once per `cooldown` seconds, as a burst of
+    errors is one congestion event). Other failures leave the limit as it is."""
+
+    def __init__(self, initial=4, minimum=1, maximum=32, decrease_factor=0.5, cooldown=1.0):
+        self.limit = float(initial)
+        self.minimum = minimum
+        self.maximum = maximum
+        self.decrease_factor = decrease_factor
+        self.cooldown = cooldown
+        self.in_flight = 0
+        self._last_decrease = 0.0
+        self._cond = threading.Condition()
+
+    def acquire(self):
+        with self._cond:
+            while self.in_flight >= int(self.limit):
+                self._cond.wait()
+            self.in_flight += 1
+
+    def release(self, success=False, congested=False):
+        with self._cond:
+            self.in_flight -= 1
+            if congested:
+                now = time.monotonic()
+                if now - self._last_decrease >= self.cooldown:
+                    self.limit = max(self.minimum, self.limit * self.decrease_factor)
+                    self._last_decrease = now
+                    logging.info(f"Upstream congested, concurrency limit lowered to {int(self.limit)}")
+            elif success:
+                self.limit = min(self.maximum, self.limit + 1 / self.limit)
+            self._cond.notify_all()
+
+
 DEFAULT_LANGUAGE_CODES = {
     "DE": "German",
     "FR": "French",
@@ -18,6 +129,71 @@ DEFAULT_LANGUAGE_CODES = {
 }
 
 
+class StreamingChatBody:
+    """JSON body of a chat completions request, written one image at a time.
+
+    `payload` holds everything but the images, which are appended to the content of its first message
+    while the body is iterated, so serialising never holds more than one frame besides the payload.
+    Passed as `data` to requests, it is sent with chunked transfer encoding, and iterated again for every
+    retry. `images` may be an iterable of base64 strings, copied to a list here so that a generator is not
+    used up by the first attempt, or a callable returning a fresh iterable of them on every call (e.g.
+    `lambda: encode_images(frames)` with `frames` a list, not a generator), so a retried request re-encodes
+    lazily instead of keeping all frames encoded. Dict items are other content parts, e.g. the text of
+    the next segment in a grouped request, and are written as they are between the images.
+    """
+
+    _MARKER = "__swiss_adt_images__"
+
+    def __init__(self, payload, images):
+        self.payload = payload
+        self.images = images if callable(images) else list(images)
+
+    def __iter__(self):
+        content = self.payload["messages"][0]["content"]
+        content.append(self._MARKER)
+        try:
+            prefix, suffix = json.dumps(self.payload).split(f', "{self._MARKER}"')
+        finally:
+            content.pop()
+        yield prefix.encode("utf-8")
+        images = self.images() if callable(self.images) else self.images
+        for img in images:
+            if isinstance(img, dict):
+                yield b", " + json.dumps(img).encode("utf-8")
+                continue
+            # separate chunks, so the frame is not copied into a concatenated string
+            yield b', {"type": "image_url", "image_url": {"url": "data:image/jpeg;base64,'
+            yield img.encode("ascii")
+            yield b'"}}'
+        yield suffix.encode("utf-8")
+
+    def to_dict(self):
+        # The full payload in memory, for debugging
+        return json.loads(b"".join(self))
+
+
+def parse_translations(content, keys):
+    """Valid entries of a JSON object of translations keyed by language code, an empty dict if it does not parse"""
+    if content is None:
+        return {}
+    content = content.strip()
+    # tolerate a markdown code fence around the object
+    if content.startswith("```"):
+        content = content.strip("`")
+        content = content[content.find("{"):]
+    try:
+        data = json.loads(content)
+    except ValueError:
+        return {}
+    if not isinstance(data, dict):
+        return {}
+    return {
+        key: data[key].strip()
+        for key in keys
+        if isinstance(data.get(key), str) and data[key].strip()
+    }
+
+
 class Translator:
     def __init__(
         self,
@@ -25,79 +201,369 @@ class Translator:
         model="gpt-4o",
         request_per_second=-1,
         language_code=None,
+        base_url="https://api.openai.com/v1",
+        max_concurrency=16,
+        max_retry_time=60,
     ):
         self.api_key = api_key
+        self.base_url = base_url.rstrip("/")
         self.requests_per_second = request_per_second
         if language_code is None:
             self.language_code = DEFAULT_LANGUAGE_CODES
         else:
             self.language_code = language_code
         self.model = model
+        # seconds within which a request is retried, Retry-After waits included
+        self.max_retry_time = max_retry_time
+        self.limiter = AdaptiveConcurrencyLimiter(
+            initial=min(4, max_concurrency), maximum=max_concurrency
+        )
+
+    def translate_segments(self, segments, source_language, target_language):
+        """Translate several segments concurrently, the number of requests in flight adapts to rate limiting.
+        args:
+            segments: list[tuple[str, list[str]]]: (audio description, base64 encoded frames) pairs
+            source_language: str: The source language code
+            target_language: str: The target language code
+        return:
+            list[str]: The translated audio descriptions, in the order of the segments
+        """
+        with ThreadPoolExecutor(max_workers=self.limiter.maximum) as executor:
+            futures = [
+                executor.submit(
+                    self.translate_segment, text, images, source_language, target_language
+                )
+                for text, images in segments
+            ]
+            return [future.result() for future in futures]
+
+    def translate_segments_grouped(self, segments, source_language, target_language, group_size=4):
+        """Translate consecutive segments in groups of `group_size` per request. The segments of a group share
+        the prompt and are translated in context; the groups run concurrently like `translate_segments`.
+        Segments missing from an unparsable or incomplete answer are translated one by one.
+        args:
+            segments: list[tuple[str, list[str]]]: consecutive (audio description, base64 encoded frames) pairs
+            source_language: str: The source language code
+            target_language: str: The target language code
+            group_size: int: Maximum number of segments per request
+        return:
+            list[str]: The translated audio descriptions, in the order of the segments
+        """
+        segments = list(segments)
+        groups = [segments[i : i + group_size] for i in range(0, len(segments), group_size)]
+        with ThreadPoolExecutor(max_workers=self.limiter.maximum) as executor:
+            futures = [
+                executor.submit(self.translate_group, group, source_language, target_language)
+                for group in groups
+            ]
+            return [translation for future in futures for translation in future.result()]
+
+    def translate_group(self, segments, source_language, target_language):
+        """Translate consecutive segments of the same scene with a single request.
+        args:
+            segments: list[tuple[str, list[str]]]: (audio description, base64 encoded frames) pairs
+            source_language: str: The source language code
+            target_language: str: The target language code
+        return:
+            list[str]: The translated audio descriptions, in the order of the segments
+        """
+        # the images of a segment may be sent twice, with the group and on its own
+        segments = [(text, images if callable(images) else list(images)) for text, images in segments]
+        if len(segments) == 1:
+            return [self.translate_segment(*segments[0], source_language, target_language)]
+
+        content = self._post_chat(self._build_group_payload(segments, source_language, target_language))
+        keys = [str(i + 1) for i in range(len(segments))]
+        translations = parse_translations(content, keys)
+        missing = [key for key in keys if key not in translations]
+        if missing:
+            logging.warning(f"No valid translation of segments {missing} in the JSON response, translating them one by one")
+        for key in missing:
+            text, images = segments[int(key) - 1]
+            translations[key] = self.translate_segment(text, images, source_language, target_language)
+        return [translations[key] for key in keys]
 
-    @backoff.on_exception(
-        backoff.expo, (requests.exceptions.RequestException, ServerError), max_time=60
-    )
     def translate_segment(self, text, images, source_language, target_language):
         """Translate the audio description for the frames of a video from the source language to the target language.
         args:
             text: str: The audio description to translate
-            images: list[str]: A list of base64 encoded frames to send to the model
+            images: list[str] | Callable[[], Iterable[str]]: A list of base64 encoded frames to send to the model,
+                or a function returning them lazily, see `StreamingChatBody`
             source_language: str: The source language code
             target_language: str: The target language code
         return:
             str: The translated audio description
         """
+        body = self._build_payload(text, images, source_language, target_language)
+        translation = self._post_chat(body)
+        return translation
+
+    def translate_segment_multi(self, text, images, source_language, target_languages):
+        """Translate the audio description into several target languages with a single request, so the frames
+        are only uploaded once. The model answers with a JSON object keyed by language code; languages missing
+        from an unparsable or incomplete answer are translated with one `translate_segment` call each.
+        args:
+            text: str: The audio description to translate
+            images: list[str]: A list of base64 encoded frames to send to the model
+            source_language: str: The source language code
+            target_languages: list[str]: The target language codes
+        return:
+            dict[str, str]: target language code -> translated audio description
+        """
+        target_languages = list(dict.fromkeys(target_languages))
+        if len(target_languages) == 1:
+            return {target_languages[0]: self.translate_segment(text, images, source_language, target_languages[0])}
+
+        body = self._build_multi_payload(text, images, source_language, target_languages)
+        translations = parse_translations(self._post_chat(body), target_languages)
+        missing = [code for code in target_languages if code not in translations]
+        if missing:
+            logging.warning(f"No valid translation to {missing} in the JSON response, translating them one by one")
+        for code in missing:
+            translations[code] = self.translate_segment(text, images, source_language, code)
+        return {code: translations[code] for code in target_languages}
+
+    def translate_batch(
+        self,
+        segments,
+        source_language,
+        target_language,
+        batch_file=None,
+        poll_interval=60,
+        timeout=24 * 3600,
+    ):
+        """Translate many segments offline with the Batch API: higher throughput and lower cost, but results
+        may take up to 24 hours.
+        args:
+            segments: dict[str, tuple[str, list[str]]]: segment id -> (audio description, base64 encoded frames)
+            source_language: str: The source language code
+            target_language: str: The target language code
+            batch_file: str: Where to write the JSONL batch input, a temporary file if None
+            poll_interval: float: Seconds between two status checks of the batch
+            timeout: float: Seconds to wait for the batch before giving up
+        return:
+            dict[str, str]: segment id -> translated audio description, None for segments that failed
+        """
+        keep_file = batch_file is not None
+        if batch_file is None:
+            fd, batch_file = tempfile.mkstemp(suffix=".jsonl", prefix="swiss_adt_batch_")
+            os.close(fd)
+        try:
+            with open(batch_file, "w") as f:
+                for segment_id, (text, images) in segments.items():
+                    body = self._build_payload(text, images, source_language, target_language)
+                    request = {
+                        "custom_id": str(segment_id),
+                        "method": "POST",
+                        "url": "/v1/chat/completions",
+                    }
+                    # one request per line, with the body streamed in after the other fields
+                    f.write(json.dumps(request)[:-1] + ', "body": ')
+                    for chunk in body:
+                        f.write(chunk.decode("utf-8"))
+                    f.write("}\n")
+            # streamed from the file, which _request rewinds for every attempt
+            with open(batch_file, "rb") as f:
+                input_file = self._request(
+                    "POST",
+                    "/files",
+                    data={"purpose": "batch"},
+                    files={"file": (os.path.basename(batch_file), f, "application/jsonl")},
+                )
+        finally:
+            if not keep_file:
+                os.remove(batch_file)
+
+        batch = self._request(
+            "POST",
+            "/batches",
+            json={
+                "input_file_id": input_file["id"],
+                "endpoint": "/v1/chat/completions",
+                "completion_window": "24h",
+            },
+        )
+        logging.info(f"Submitted batch {batch['id']} with {len(segments)} segments")
+
+        deadline = time.monotonic() + timeout
+        while batch["status"] not in ("completed", "failed", "expired", "cancelled"):
+            if time.monotonic() > deadline:
+                raise TimeoutError(f"Batch {batch['id']} not finished after {timeout} seconds")
+            time.sleep(poll_interval)
+            batch = self._request("GET", f"/batches/{batch['id']}")
+        logging.info(f"Batch {batch['id']} finished with status {batch['status']}")
 
-        if (
-            source_language not in self.language_code
-            or target_language not in self.language_code
-        ):
+        translations = {str(segment_id): None for segment_id in segments}
+        for file_key in ("output_file_id", "error_file_id"):
+            if not batch.get(file_key):
+                continue
+            content = self._request("GET", f"/files/{batch[file_key]}/content", raw=True)
+            for line in content.splitlines():
+                if not line.strip():
+                    continue
+                result = json.loads(line)
+                response = result.get("response") or {}
+                if response.get("status_code") == 200:
+                    body = response["body"]
+                    translations[result["custom_id"]] = body["choices"][0]["message"]["content"]
+                else:
+                    logging.warning(
+                        f"Segment {result['custom_id']} failed in batch {batch['id']}: "
+                        f"{result.get('error') or response.get('body')}"
+                    )
+        # map back to the caller's ids
+        return {segment_id: translations[str(segment_id)] for segment_id in segments}
+
+    def _language_names(self, *codes):
+        if any(code not in self.language_code for code in codes):
             raise ValueError("Invalid language code")
-        source_language = self.language_code[source_language]
-        target_language = self.language_code[target_language]
+        return [self.language_code[code] for code in codes]
 
+    def _build_payload(self, text, images, source_language, target_language):
+        source_language, target_language = self._language_names(source_language, target_language)
         text = (
             f"Translate the following audio description for the frames of this video from {source_language} to"
             f" {target_language}. Respond with the translation only. If the audio description does not match the "
             f"image, please ignore the image. Respond with a translation only. This is the audio description to translate: \n {text}"
         )
+        return self._chat_payload(text, images)
+
+    def _build_multi_payload(self, text, images, source_language, target_languages):
+        source_language, *names = self._language_names(source_language, *target_languages)
+        targets = ", ".join(f"{name} ({code})" for code, name in zip(target_languages, names))
+        text = (
+            f"Translate the following audio description for the frames of this video from {source_language} to"
+            f" each of these languages: {targets}. Respond with a JSON object that maps each language code to its "
+            f"translation. If the audio description does not match the image, please ignore the image. "
+            f"This is the audio description to translate: \n {text}"
+        )
+        schema = {
+            "type": "object",
+            "properties": {code: {"type": "string"} for code in target_languages},
+            "required": list(target_languages),
+            "additionalProperties": False,
+        }
+        response_format = {
+            "type": "json_schema",
+            "json_schema": {"name": "translations", "strict": True, "schema": schema},
+        }
+        return self._chat_payload(
+            text, images, max_tokens=300 * len(target_languages), response_format=response_format
+        )
 
-        headers = {
-            "Content-Type": "application/json",
-            "Authorization": f"Bearer {self.api_key}",
+    def _build_group_payload(self, segments, source_language, target_language):
+        source_language, target_language = self._language_names(source_language, target_language)
+        keys = [str(i + 1) for i in range(len(segments))]
+        text = (
+            f"Translate the following {len(segments)} consecutive audio description segments of the same video from "
+            f"{source_language} to {target_language}. Each segment is followed by the new frames of the moment it "
+            f"describes; a segment without frames shows frames already sent with an earlier segment. Use the neighbouring segments as context, but translate each segment on its own. Respond "
+            f"with a JSON object that maps each segment number to its translation. If an audio description does "
+            f"not match its images, please ignore the images."
+        )
+        schema = {
+            "type": "object",
+            "properties": {key: {"type": "string"} for key in keys},
+            "required": keys,
+            "additionalProperties": False,
+        }
+        response_format = {
+            "type": "json_schema",
+            "json_schema": {"name": "translations", "strict": True, "schema": schema},
         }
+        segments = [(text, images if callable(images) else list(images)) for text, images in segments]
+
+        def parts():
+            # each segment's text followed by its images, streamed like the images of a single segment
+            for key, (segment_text, images) in zip(keys, segments):
+                yield {"type": "text", "text": f"Segment {key}: {segment_text}"}
+                yield from images() if callable(images) else images
 
+        return self._chat_payload(
+            text, parts, max_tokens=300 * len(segments), response_format=response_format
+        )
+
+    def _chat_payload(self, text, images, max_tokens=300, response_format=None):
         payload = {
             "model": self.model,
             "messages": [{"role": "user", "content": [{"type": "text", "text": text}]}],
-            "max_tokens": 300,
+            "max_tokens": max_tokens,
         }
+        if response_format is not None:
+            payload["response_format"] = response_format
 
-        logging.info(
+        logging.debug(
             f"Sending request to OpenAI with payload (images not included): {payload}"
         )
+        return StreamingChatBody(payload, images)
 
-        for img in images:
-            image = {
-                "type": "image_url",
-                "image_url": {"url": f"data:image/jpeg;base64,{img}"},
-            }
-
-            payload["messages"][0]["content"].append(image)
-
-        response = requests.post(
-            "https://api.openai.com/v1/chat/completions", headers=headers, json=payload
+    def _post_chat(self, body):
+        response = self._request(
+            "POST", "/chat/completions", data=body, headers={"Content-Type": "application/json"}
         )
-
-        if response.status_code != 200 or "error" in response.json():
-            raise ServerError(f"Error in response: {response.json()}")
-        logging.info(f"Received response from OpenAI: {response.json()}")
+        # the whole body only at debug level, under load a line per response floods the logs
+        logging.debug(f"Received response from OpenAI: {response}")
 
         if self.requests_per_second > 0:
             time.sleep(1 / self.requests_per_second)
 
-        translation = response.json()["choices"][0]["message"]["content"]
-        return translation
+        return response["choices"][0]["message"]["content"]
+
+    def _request(self, method, path, raw=False, **kwargs):
+        # Retried for network errors, 429 and 5xx but never for other 4xx, for up to max_retry_time
+        # seconds. A Retry-After is always waited in full: if it does not fit in the time left, the
+        # error is raised right away rather than retrying before the server allows it.
+        deadline = time.monotonic() + self.max_retry_time
+        waits = retry_after_or_expo()
+        next(waits)
+        while True:
+            # a failed attempt may have read uploaded files partly or up to EOF
+            for upload in (kwargs.get("files") or {}).values():
+                handle = upload[1] if isinstance(upload, tuple) else upload
+                if hasattr(handle, "seek"):
+                    handle.seek(0)
+            try:
+                return self._attempt(method, path, raw, **kwargs)
+            except (requests.exceptions.RequestException, ServerError) as e:
+                wait = waits.send(e)
+                remaining = deadline - time.monotonic()
+                if remaining <= 0 or (getattr(e, "retry_after", None) is not None and wait > remaining):
+                    raise
+                wait = min(wait, remaining)
+                logging.info(f"Retrying {method} {path} in {wait:.1f}s: {e}")
+                time.sleep(wait)
+
+    def _attempt(self, method, path, raw=False, **kwargs):
+        headers = {"Authorization": f"Bearer {self.api_key}", **kwargs.pop("headers", {})}
+        self.limiter.acquire()
+        # a request that raised, e.g. a connection error or timeout, counts as congestion
+        success, congested = False, True
+        try:
+            with span("http_translate", model=self.model, path=path):
+                response = requests.request(
+                    method, f"{self.base_url}{path}", headers=headers, **kwargs
+                )
+            success = 200 <= response.status_code < 300
+            congested = response.status_code in (408, 429) or response.status_code >= 500
+        finally:
+            self.limiter.release(success=success, congested=congested)
+
+        if raw and response.status_code == 200:
+            return response.text
+        try:
+            body = response.json()
+        except ValueError:
+            body = None
+        if response.status_code == 200 and isinstance(body, dict) and "error" not in body:
+            return body
+
+        message = f"Error in response ({response.status_code}): {body if body is not None else response.text[:500]}"
+        retry_after = parse_retry_after(response.headers)
+        if response.status_code == 429:
+            raise RateLimitError(message, retry_after=retry_after)
+        if 400 <= response.status_code < 500 and response.status_code not in (408, 409):
+            raise ClientError(message, status_code=response.status_code)
+        raise ServerError(message, retry_after=retry_after)
 
 
 if __name__ == "__main__":
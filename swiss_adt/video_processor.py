@@ -6,15 +6,97 @@ import cv2
 import numpy as np
 import logging
 import base64
+import hashlib
+import threading
+from collections import OrderedDict
+from .tracing import span, tracer
 
 
 def encode_images(image_arrays: Iterable[np.ndarray]) -> Iterable[str]:
     # Convert the numpy array to bytes
     for image_array in image_arrays:
-        _, buffer = cv2.imencode(".png", image_array)
-        image_bytes = buffer.tobytes()
-        # Encode the bytes to base64
-        yield base64.b64encode(image_bytes).decode("utf-8")
+        with span("image_encode"):
+            _, buffer = cv2.imencode(".png", image_array)
+            image_bytes = buffer.tobytes()
+            # Encode the bytes to base64
+            encoded = base64.b64encode(image_bytes).decode("utf-8")
+        yield encoded
+
+
+def perceptual_hash(image_array: np.ndarray, hash_size: int = 8) -> int:
+    # Difference hash: compare neighbouring pixels of a small grayscale copy, robust to
+    # re-encoding, small shifts and brightness changes between near-identical frames
+    gray = cv2.cvtColor(image_array, cv2.COLOR_RGB2GRAY) if image_array.ndim == 3 else image_array
+    small = cv2.resize(gray, (hash_size + 1, hash_size), interpolation=cv2.INTER_AREA)
+    bits = (small[:, 1:] > small[:, :-1]).flatten()
+    return int.from_bytes(np.packbits(bits).tobytes(), "big")
+
+
+def hamming_distance(a: int, b: int) -> int:
+    return bin(a ^ b).count("1")
+
+
+class FrameDeduplicator:
+    """Drops near-duplicate frames before upload and caches their base64 encoding.
+
+    Frames whose perceptual hashes differ in at most `max_distance` bits are considered the same
+    image and only the first one is kept. The encoding cache (least recently used evicted first) is
+    only hit by a frame with the same hash and the same pixels, so the encoding returned is always the
+    frame's own. Create one deduplicator per job, the cache holds the frames it has seen.
+    """
+
+    def __init__(self, max_distance: int = 5, cache_size: int = 1024, hash_size: int = 8):
+        self.max_distance = max_distance
+        self.cache_size = cache_size
+        self.hash_size = hash_size
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _cache_key(image_array: np.ndarray, frame_hash: int) -> tuple:
+        digest = hashlib.blake2b(np.ascontiguousarray(image_array).tobytes(), digest_size=16).digest()
+        return frame_hash, image_array.shape, str(image_array.dtype), digest
+
+    def encode(self, image_array: np.ndarray, frame_hash: int = None) -> tuple[int, str]:
+        # Return the perceptual hash of the frame and its base64 encoding
+        if frame_hash is None:
+            frame_hash = perceptual_hash(image_array, self.hash_size)
+        key = self._cache_key(image_array, frame_hash)
+        with self._lock:
+            if key in self._cache:
+                self._cache.move_to_end(key)
+                return frame_hash, self._cache[key]
+        encoded = next(iter(encode_images([image_array])))
+        with self._lock:
+            self._cache[key] = encoded
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+        return frame_hash, encoded
+
+    def dedup(self, image_arrays: Iterable[np.ndarray], seen: set = None) -> list[str]:
+        """Encode the frames, skipping those that are near-duplicates of an earlier frame or of a frame in `seen`.
+        args:
+            image_arrays: Iterable[np.ndarray]: RGB frames
+            seen: set[int]: Hashes of frames already sent, updated in place
+        return:
+            list[str]: base64 encoded frames
+        """
+        if seen is None:
+            seen = set()
+        encoded_frames = []
+        for image_array in image_arrays:
+            frame_hash = perceptual_hash(image_array, self.hash_size)
+            if any(hamming_distance(frame_hash, h) <= self.max_distance for h in seen):
+                continue
+            _, encoded = self.encode(image_array, frame_hash)
+            seen.add(frame_hash)
+            encoded_frames.append(encoded)
+        return encoded_frames
+
+    def dedup_segments(self, frame_sets: Iterable[Iterable[np.ndarray]]) -> list[list[str]]:
+        # Frames of segments sent in one request: each frame is uploaded with the first segment showing it
+        seen = set()
+        return [self.dedup(frames, seen) for frames in frame_sets]
 
 
 def save_subclip(
@@ -25,7 +107,7 @@ def save_subclip(
 ):
 
     # Open the video file
-    with VideoFileClip(input_file, audio=False) as video_clip:
+    with span("subclip_write"), VideoFileClip(input_file, audio=False) as video_clip:
 
         # Check if the end time is greater than the duration of the video
         if end_time_seconds > video_clip.duration:
@@ -44,8 +126,67 @@ def save_subclip(
         subclip.write_videofile(output_file, codec="libx264", audio_codec="aac")
 
 
+def frame_histogram(frame: np.ndarray, bins: int = 8) -> np.ndarray:
+    # Colour histogram of a downscaled copy of the frame, cheap enough to compute for every candidate
+    small = cv2.resize(frame, (64, 64), interpolation=cv2.INTER_AREA)
+    hsv = cv2.cvtColor(small, cv2.COLOR_RGB2HSV)
+    hist = cv2.calcHist(
+        [hsv], [0, 1, 2], None, [bins] * 3, [0, 180, 0, 256, 0, 256]
+    ).flatten()
+    return hist / (hist.sum() + 1e-8)
+
+
+def select_diverse_frames(histograms: np.ndarray, k: int) -> list[int]:
+    # Greedy farthest-point selection: start with the most representative frame, then repeatedly
+    # add the frame whose histogram is furthest (L1) from all frames selected so far
+    if len(histograms) == 0 or k <= 0:
+        return []
+    if len(histograms) <= k:
+        return list(range(len(histograms)))
+    selected = [int(np.abs(histograms - histograms.mean(0)).sum(1).argmin())]
+    min_dist = np.abs(histograms - histograms[selected[0]]).sum(1)
+    while len(selected) < k:
+        idx = int(min_dist.argmax())
+        selected.append(idx)
+        min_dist = np.minimum(min_dist, np.abs(histograms - histograms[idx]).sum(1))
+    return sorted(selected)
+
+
+def rank_window_clips(
+    clip_scores: list[float],
+    window: list[float],
+    clip_len: float = 2,
+    top_k: int = 2,
+    frames_per_clip: int = 1,
+) -> list[float]:
+    # Pick the top_k highest scoring clips overlapping the window and return frame timestamps
+    # inside them, relative to the window start (i.e. usable on the saved subclip)
+    start, end = window[0], window[1]
+    first_clip = int(start // clip_len)
+    last_clip = min(int(np.ceil(end / clip_len)), len(clip_scores))
+    clip_ids = list(range(first_clip, last_clip))
+    if not clip_ids:
+        # No scored clip overlaps the window (no scores, or the window lies past them): use its midpoint
+        return [(end - start) / 2]
+    ranked = sorted(clip_ids, key=lambda i: clip_scores[i], reverse=True)[:top_k]
+
+    timestamps = []
+    for clip_id in sorted(ranked):
+        clip_start = max(clip_id * clip_len, start)
+        clip_end = min((clip_id + 1) * clip_len, end)
+        # Exclude the clip boundaries, like the num_frames mode does for the whole moment
+        times = np.linspace(clip_start, clip_end, frames_per_clip + 2)[1:-1]
+        timestamps.extend(float(t - start) for t in times)
+    return timestamps
+
+
 def extract_frames(
-    video_path: str, num_frames: int = None, nth_frame: int = None
+    video_path: str,
+    num_frames: int = None,
+    nth_frame: int = None,
+    diverse_frames: int = None,
+    candidate_fps: float = 2,
+    timestamps: Iterable[float] = None,
 ) -> Iterable[np.ndarray]:
     # Open the video file
     video_clip = VideoFileClip(video_path, audio=False)
@@ -54,7 +195,12 @@ def extract_frames(
     duration = video_clip.duration
     logging.info(f"Duration of the video: {duration} seconds")
 
-    if num_frames:
+    if timestamps is not None:
+        # Frames at explicit timestamps, e.g. from rank_window_clips
+        frames = (
+            video_clip.get_frame(min(t, duration)) for t in timestamps
+        )
+    elif num_frames:
         # Calculate the time intervals to extract frames, including the first and last frames
         intervals = np.linspace(0, duration, num_frames + 2)[
             1:-1
@@ -67,8 +213,23 @@ def extract_frames(
             for i, frame in enumerate(video_clip.iter_frames())
             if i % nth_frame == 0
         )
+    elif diverse_frames:
+        # Decode the candidates at candidate_fps keeping only timestamps and histograms in memory,
+        # the selection needs all of them, then seek again to the few selected frames
+        times, histograms = [], []
+        for t, frame in video_clip.iter_frames(fps=candidate_fps, with_times=True):
+            times.append(t)
+            histograms.append(frame_histogram(frame))
+        if histograms:
+            selected = select_diverse_frames(np.stack(histograms), diverse_frames)
+        else:
+            selected = []
+        logging.info(
+            f"Selected {len(selected)} diverse frames out of {len(times)} candidates"
+        )
+        frames = (video_clip.get_frame(times[i]) for i in selected)
 
-    for frame in frames:
+    for frame in tracer.iter("frame_extraction", frames):
         # Get the size of the frame in bytes
         current_image_size_bytes = sys.getsizeof(frame.tobytes())
 
@@ -0,0 +1,5 @@
+import os
+import sys
+
+# the vendored CG-DETR modules import each other as top-level packages (cg_detr, utils, standalone_eval)
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "cgdetr"))
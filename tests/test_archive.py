@@ -0,0 +1,22 @@
+import numpy as np
+
+from cgdetr.archive import ClipIndex
+
+
+def make_feats():
+    rng = np.random.default_rng(0)
+    return {f"vid{i}": rng.standard_normal((20, 8)).astype(np.float32) for i in range(5)}
+
+
+def test_search_returns_no_hits_for_k_zero():
+    query = np.ones(8, dtype=np.float32)
+    assert ClipIndex.build(make_feats()).search(query, k=0) == []
+    assert ClipIndex.build(make_feats(), nlist=4).search(query, k=0) == []
+
+
+def test_search_returns_no_hits_when_probed_lists_are_empty():
+    index = ClipIndex.build(make_feats(), nlist=4)
+    query = np.ones(8, dtype=np.float32)
+    assert index.search(query, k=5, nprobe=0) == []
+    index.list_offsets[:] = 0
+    assert index.search(query, k=5, nprobe=4) == []
@@ -0,0 +1,62 @@
+import argparse
+
+import numpy as np
+import pytest
+import torch
+
+from cg_detr.model import CGDETR, build_position_encoding, build_transformer
+from utils.tensor_utils import pad_sequences_1d
+
+
+@pytest.fixture(scope="module")
+def model():
+    # a small randomly initialised CG-DETR, the layers and masks are those of the real one
+    args = argparse.Namespace(
+        hidden_dim=32, nheads=4, enc_layers=1, dec_layers=1, t2v_layers=1, sent_layers=1, moment_layers=1,
+        dummy_layers=1, num_dummies=3, total_prompts=10, num_prompts=1, dim_feedforward=64, dropout=0.1,
+        pre_norm=False, position_embedding="sine", max_q_l=32, max_v_l=75, num_queries=10, input_dropout=0.5,
+        aux_loss=False, contrastive_align_loss=False, contrastive_hdim=16, span_loss_type="l1",
+        use_txt_pos=False, n_input_proj=2, t_feat_dim=16, v_feat_dim=18, a_feat_dir=None, dset_name="qvhighlights",
+        device="cpu",
+    )
+    torch.manual_seed(0)
+    position_embedding, txt_position_embedding = build_position_encoding(args)
+    return CGDETR(
+        build_transformer(args), position_embedding, txt_position_embedding, txt_dim=16, vid_dim=18,
+        num_queries=10, input_dropout=0.5, aux_loss=False, contrastive_align_loss=False, contrastive_hdim=16,
+        span_loss_type="l1", use_txt_pos=False, n_input_proj=2, args=args,
+    ).eval()
+
+
+def predict(model, samples, batches):
+    predictions = {}
+    for batch in batches:
+        src_vid, src_vid_mask = pad_sequences_1d([samples[i][0] for i in batch], dtype=torch.float32)
+        src_txt, src_txt_mask = pad_sequences_1d([samples[i][1] for i in batch], dtype=torch.float32)
+        with torch.no_grad():
+            outputs = model(src_txt=src_txt, src_txt_mask=src_txt_mask, src_vid=src_vid, src_vid_mask=src_vid_mask,
+                            vid=None, qid=None)
+        for k, i in enumerate(batch):
+            n_clips = len(samples[i][0])
+            predictions[i] = (outputs["pred_spans"][k], outputs["pred_logits"][k],
+                              outputs["saliency_scores"][k][:n_clips])
+    return predictions
+
+
+def test_predictions_do_not_depend_on_the_batch(model):
+    rng = np.random.default_rng(0)
+    samples = [
+        (torch.randn(int(n_clips), 18), torch.randn(int(n_words), 16))
+        for n_clips, n_words in zip(rng.integers(5, 76, 12), rng.integers(3, 25, 12))
+    ]
+    in_order = [list(range(st, st + 4)) for st in range(0, 12, 4)]
+    by_length = sorted(range(12), key=lambda i: len(samples[i][0]))
+    bucketed = [by_length[st:st + 4] for st in range(0, 12, 4)]
+    alone = [[i] for i in range(12)]
+
+    expected = predict(model, samples, alone)
+    for batches in (in_order, bucketed):
+        predictions = predict(model, samples, batches)
+        for i in range(12):
+            for actual, reference in zip(predictions[i], expected[i]):
+                torch.testing.assert_close(actual, reference, rtol=1e-4, atol=1e-5)
@@ -0,0 +1,19 @@
+import torch
+
+from cgdetr.run_on_video.data_utils import Preprocessing
+
+
+def float_preprocessing(frames):
+    # the float pipeline Preprocessing replaced: /255 on the host, then mean/std normalisation
+    preprocess = Preprocessing()
+    return preprocess.norm(frames.float() / 255.0)
+
+
+def test_uint8_frames_match_the_float_path():
+    frames = torch.randint(0, 256, (4, 3, 32, 32), dtype=torch.uint8)
+    torch.testing.assert_close(Preprocessing()(frames), float_preprocessing(frames))
+
+
+def test_float_frames_are_still_accepted():
+    frames = torch.randint(0, 256, (2, 3, 8, 8), dtype=torch.uint8)
+    torch.testing.assert_close(Preprocessing()(frames.float()), float_preprocessing(frames))
@@ -0,0 +1,49 @@
+import os
+
+import numpy as np
+
+from cg_detr.feature_store import PackedFeatureStore
+
+
+def write_features(feat_dir, lengths, dim=8, seed=0):
+    rng = np.random.default_rng(seed)
+    feats = {}
+    for i, n in enumerate(lengths):
+        feats[f"vid{i}"] = rng.standard_normal((n, dim)).astype(np.float32)
+        np.savez(feat_dir / f"vid{i}.npz", features=feats[f"vid{i}"])
+    return feats
+
+
+def test_lengths_without_reading_the_features(tmp_path):
+    write_features(tmp_path, [3, 7, 1])
+    store = PackedFeatureStore.build(str(tmp_path))
+    assert store.names() == ["vid0", "vid1", "vid2"]
+    assert [store.length(name) for name in store.names()] == [3, 7, 1]
+
+
+def test_packed_features_match_the_files(tmp_path):
+    feats = write_features(tmp_path, [3, 7, 1])
+    store = PackedFeatureStore.build(str(tmp_path))
+    for name, feat in feats.items():
+        expected = feat / (np.linalg.norm(feat, axis=-1, keepdims=True) + 1e-5)
+        np.testing.assert_array_equal(store.get(name), expected)
+    assert store.stale_reason(str(tmp_path)) is None
+
+
+def test_rewritten_added_or_removed_files_make_the_pack_stale(tmp_path):
+    write_features(tmp_path, [3, 7])
+    PackedFeatureStore.build(str(tmp_path))
+    assert PackedFeatureStore.open(str(tmp_path), "features").stale_reason(str(tmp_path)) is None
+
+    # re-extracted with other values, same shape
+    np.savez(tmp_path / "vid1.npz", features=np.ones((7, 8), dtype=np.float32))
+    stat = os.stat(tmp_path / "vid1.npz")
+    os.utime(tmp_path / "vid1.npz", ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+    assert "modified" in PackedFeatureStore.open(str(tmp_path), "features").stale_reason(str(tmp_path))
+
+    PackedFeatureStore.build(str(tmp_path))
+    np.savez(tmp_path / "vid2.npz", features=np.ones((2, 8), dtype=np.float32))
+    assert "3 samples" in PackedFeatureStore.open(str(tmp_path), "features").stale_reason(str(tmp_path))
+    os.remove(tmp_path / "vid2.npz")
+    os.remove(tmp_path / "vid0.npz")
+    assert "1 samples" in PackedFeatureStore.open(str(tmp_path), "features").stale_reason(str(tmp_path))
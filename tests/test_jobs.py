@@ -0,0 +1,117 @@
+import os
+import time
+import urllib.request
+
+import cv2
+import numpy as np
+
+from swiss_adt.jobs import DONE, FAILED, QUEUED, RUNNING, JobQueue, process_job
+from swiss_adt.tracing import Tracer, tracer
+
+
+def submit(queue):
+    job_id, work_dir = queue.create()
+    with open(os.path.join(work_dir, "input.mp4"), "wb") as f:
+        f.write(b"video")
+    return queue.submit(job_id, {"audio_description": "x"})
+
+
+def test_live_jobs_are_not_requeued(tmp_path):
+    queue = JobQueue(str(tmp_path))
+    job_id = submit(queue)
+    assert queue.claim("worker-a")["id"] == job_id
+
+    # a second pool starting up leaves the job of the live worker alone
+    assert JobQueue(str(tmp_path)).requeue_expired() == 0
+    assert queue.claim("worker-b") is None
+    assert queue.get(job_id)["worker"] == "worker-a"
+
+
+def test_expired_lease_is_requeued_and_stale_result_ignored(tmp_path):
+    queue = JobQueue(str(tmp_path))
+    job_id = submit(queue)
+    queue.claim("worker-a")
+    time.sleep(0.05)
+
+    job = queue.claim("worker-b", lease_timeout=0.01)
+    assert job["id"] == job_id and job["status"] == RUNNING and job["worker"] == "worker-b"
+    assert not queue.heartbeat(job_id, "worker-a")
+    queue.complete(job_id, {"from": "a"}, "worker-a")
+    assert queue.get(job_id)["status"] == RUNNING
+    queue.complete(job_id, {"from": "b"}, "worker-b")
+    assert queue.get(job_id)["result"] == {"from": "b"}
+
+
+def test_cleanup_deletes_old_finished_jobs(tmp_path):
+    queue = JobQueue(str(tmp_path))
+    finished = submit(queue)
+    queue.claim("worker-a")
+    queue.complete(finished, {}, "worker-a")
+    queued = submit(queue)
+    orphan, orphan_dir = queue.create()
+    time.sleep(0.05)
+
+    assert queue.cleanup(retention=0.01) == 1
+    assert queue.get(finished) is None and not os.path.exists(os.path.join(str(tmp_path), finished))
+    assert queue.get(queued)["status"] == QUEUED and os.path.exists(os.path.join(str(tmp_path), queued))
+    assert not os.path.exists(orphan_dir)
+    assert queue.cleanup(retention=3600) == 0
+
+
+def test_job_crashing_its_workers_fails_after_max_attempts(tmp_path):
+    queue = JobQueue(str(tmp_path))
+    crashing = submit(queue)
+    time.sleep(0.01)
+    other = submit(queue)
+
+    for attempt in range(1, 3):
+        job = queue.claim(f"worker-{attempt}", lease_timeout=0.01, max_attempts=2)
+        assert job["id"] == crashing and job["attempts"] == attempt
+        time.sleep(0.05)  # the worker dies without renewing its lease
+
+    # the next claim gives up on it instead of handing it to a third worker
+    assert queue.claim("worker-3", lease_timeout=0.01, max_attempts=2)["id"] == other
+    job = queue.get(crashing)
+    assert job["status"] == FAILED and job["error"] == "Worker died 2 times running this job"
+
+
+class FakePredictor:
+    clip_len = 2
+
+    def localize_moment(self, video_path, query_list, **kwargs):
+        return [{"pred_relevant_windows": [[0.5, 2.5, 0.9]]}]
+
+
+class FakeTranslator:
+    def translate_segment_multi(self, text, images, source_language, target_languages):
+        list(images)
+        return {language: text for language in target_languages}
+
+
+def test_metrics_export_the_spans_of_the_workers(tmp_path):
+    queue = JobQueue(str(tmp_path))
+    job_id, work_dir = queue.create()
+    writer = cv2.VideoWriter(os.path.join(work_dir, "input.mp4"), cv2.VideoWriter_fourcc(*"mp4v"), 10, (64, 48))
+    for i in range(30):
+        writer.write(np.full((48, 64, 3), i * 8, np.uint8))
+    writer.release()
+    queue.submit(job_id, dict(
+        audio_description="x", source_language="de", target_languages=["fr"],
+        extraction=dict(option="Number of frames", value=2),
+    ))
+
+    # the worker side, recording into the tracer of its process
+    process_job(queue, "worker-a", queue.claim("worker-a"), FakePredictor(), FakeTranslator())
+    assert queue.get(job_id)["status"] == DONE
+
+    # the app side, whose own tracer records nothing
+    app_tracer = Tracer()
+    app_tracer.add_collector(queue.span_stats)
+    server = app_tracer.start_http_server(port=0)
+    try:
+        with urllib.request.urlopen(f"http://127.0.0.1:{server.server_port}/metrics") as response:
+            metrics = response.read().decode()
+    finally:
+        server.shutdown()
+    assert f'swiss_adt_span_seconds_count{{span="frame_extraction"}} {tracer.snapshot()["frame_extraction"]["count"]}' \
+        in metrics
@@ -0,0 +1,159 @@
+import json
+import logging
+from types import SimpleNamespace
+
+import numpy as np
+import pytest
+import torch
+
+# the dataset module needs the full CG-DETR training dependencies
+pytest.importorskip("pandas")
+pytest.importorskip("torchtext")
+from cg_detr.feature_store import PackedFeatureStore  # noqa: E402
+from cg_detr.start_end_dataset import (  # noqa: E402
+    LengthBucketBatchSampler,
+    StartEndDataset,
+    VidGroupedBatchSampler,
+    start_end_collate,
+    video_cache_worker_init_fn,
+)
+
+
+@pytest.fixture
+def dataset_files(tmp_path):
+    rng = np.random.default_rng(0)
+    v_feat_dir, q_feat_dir = tmp_path / "clip_features", tmp_path / "clip_text_features"
+    v_feat_dir.mkdir()
+    q_feat_dir.mkdir()
+    data = []
+    for qid in range(8):
+        vid = f"vid{qid % 3}"
+        data.append(dict(qid=qid, vid=vid, query=f"query {qid}", duration=150))
+        np.savez(q_feat_dir / f"qid{qid}.npz",
+                 last_hidden_state=rng.standard_normal((int(rng.integers(3, 20)), 16)).astype(np.float32))
+    for i in range(3):
+        np.savez(v_feat_dir / f"vid{i}.npz", features=rng.standard_normal((int(rng.integers(5, 75)), 18)).astype(np.float32))
+    data_path = tmp_path / "highlight_data.jsonl"
+    data_path.write_text("".join(json.dumps(e) + "\n" for e in data))
+    return str(data_path), str(v_feat_dir), str(q_feat_dir)
+
+
+def make_dataset(dataset_files, **kwargs):
+    data_path, v_feat_dir, q_feat_dir = dataset_files
+    return StartEndDataset("hl", data_path, [v_feat_dir], q_feat_dir, load_labels=False, **kwargs)
+
+
+def test_packed_and_per_file_features_are_equal(dataset_files):
+    _, v_feat_dir, q_feat_dir = dataset_files
+    PackedFeatureStore.build(v_feat_dir, "features")
+    PackedFeatureStore.build(q_feat_dir, "last_hidden_state")
+    packed, per_file = make_dataset(dataset_files, use_packed=True), make_dataset(dataset_files, use_packed=False)
+    assert packed.v_feat_stores[0] is not None and packed.q_feat_store is not None
+    for i in range(len(per_file)):
+        for key in ("query_feat", "video_feat"):
+            torch.testing.assert_close(packed[i]["model_inputs"][key], per_file[i]["model_inputs"][key])
+
+
+def test_stale_pack_is_ignored(dataset_files):
+    _, v_feat_dir, _ = dataset_files
+    PackedFeatureStore.build(v_feat_dir, "features")
+    np.savez(f"{v_feat_dir}/vid3.npz", features=np.ones((4, 18), dtype=np.float32))
+    assert make_dataset(dataset_files, use_packed=True).v_feat_stores[0] is None
+
+
+def test_video_cache_counters_are_logged_and_reset(dataset_files, caplog):
+    dataset = make_dataset(dataset_files, video_cache_size=3)
+    for i in range(len(dataset)):
+        dataset[i]
+    assert dataset.video_cache_info()["misses"] == 3
+    with caplog.at_level(logging.INFO, logger="cg_detr.start_end_dataset"):
+        dataset.log_video_cache_info()
+    assert "main process" in caplog.text and "'hits': 5" in caplog.text
+    assert dataset.video_cache_info()["hits"] == dataset.video_cache_info()["misses"] == 0
+
+
+def test_video_cache_counters_are_logged_by_every_worker(dataset_files, tmp_path):
+    # the workers are forked processes, a file handler is what they share with the test
+    log_path = tmp_path / "cache.log"
+    handler = logging.FileHandler(log_path)
+    logger = logging.getLogger("cg_detr.start_end_dataset")
+    logger.addHandler(handler)
+    logger.setLevel(logging.INFO)
+    try:
+        loader = torch.utils.data.DataLoader(
+            make_dataset(dataset_files, video_cache_size=3), batch_size=2, num_workers=2,
+            collate_fn=start_end_collate, worker_init_fn=video_cache_worker_init_fn)
+        for _ in loader:
+            pass
+    finally:
+        logger.removeHandler(handler)
+        handler.close()
+    log = log_path.read_text()
+    assert "worker 0" in log and "worker 1" in log
+
+
+def test_collate_pads_the_features_and_masks_them(dataset_files):
+    dataset = make_dataset(dataset_files)
+    samples = [dataset[i] for i in range(4)]
+    batch_meta, batched = start_end_collate(samples)
+    assert [m["qid"] for m in batch_meta] == [0, 1, 2, 3]
+    for key in ("query_feat", "video_feat"):
+        padded, mask = batched[key]
+        lengths = [len(e["model_inputs"][key]) for e in samples]
+        assert padded.shape[:2] == mask.shape == (4, max(lengths))
+        assert mask.sum(1).tolist() == lengths
+        for i, e in enumerate(samples):
+            torch.testing.assert_close(padded[i, :lengths[i]], e["model_inputs"][key])
+            assert not padded[i, lengths[i]:].any()
+
+
+def vid_dataset(vids):
+    return SimpleNamespace(data=[dict(vid=vid) for vid in vids])
+
+
+@pytest.mark.parametrize("shuffle", [False, True])
+def test_vid_grouped_batches_keep_the_queries_of_a_vid_together(shuffle):
+    dataset = vid_dataset(["a", "b", "a", "c", "b", "a", "c", "d", "a"])
+    sampler = VidGroupedBatchSampler(dataset, batch_size=4, shuffle=shuffle)
+    batches = list(sampler)
+    assert len(batches) == len(sampler) == 3
+    order = [idx for batch in batches for idx in batch]
+    assert sorted(order) == list(range(9))
+    vids = [dataset.data[idx]["vid"] for idx in order]
+    # each vid appears as a single run
+    runs = [vid for i, vid in enumerate(vids) if i == 0 or vids[i - 1] != vid]
+    assert sorted(runs) == ["a", "b", "c", "d"]
+
+
+def test_vid_grouped_shuffle_is_seeded_by_epoch():
+    sampler = VidGroupedBatchSampler(vid_dataset("abcdefgh" * 3), batch_size=4, shuffle=True)
+    first = list(sampler)
+    assert list(sampler) == first
+    sampler.set_epoch(1)
+    assert list(sampler) != first
+
+
+@pytest.mark.parametrize("drop_last", [False, True])
+def test_length_buckets_sort_by_length_without_shuffle(drop_last):
+    lengths = [5, 40, 12, 75, 3, 40, 18, 60, 7, 22]
+    sampler = LengthBucketBatchSampler(None, batch_size=3, lengths=lengths, drop_last=drop_last)
+    batches = list(sampler)
+    assert len(batches) == len(sampler) == (3 if drop_last else 4)
+    batch_lengths = [lengths[idx] for batch in batches for idx in batch]
+    assert batch_lengths == sorted(lengths, reverse=True)[:len(batch_lengths)]
+
+
+def test_length_buckets_with_shuffle_cover_every_sample_and_pad_less():
+    rng = np.random.default_rng(0)
+    lengths = rng.integers(1, 76, 400)
+    sampler = LengthBucketBatchSampler(None, batch_size=8, lengths=lengths, shuffle=True, bucket_batches=10)
+    batches = list(sampler)
+    assert sorted(idx for batch in batches for idx in batch) == list(range(400))
+
+    def padding(batches):
+        return sum(len(b) * lengths[b].max() - lengths[b].sum() for b in map(np.asarray, batches))
+
+    in_order = [list(range(st, st + 8)) for st in range(0, 400, 8)]
+    assert padding(batches) < padding(in_order) / 2
+    sampler.set_epoch(1)
+    assert list(sampler) != batches
@@ -0,0 +1,60 @@
+import numpy as np
+import pytest
+
+from cg_detr.streaming_eval import StreamingMREval
+
+
+def make_submission(n_queries=30, seed=0):
+    rng = np.random.default_rng(seed)
+    submission, ground_truth = [], []
+    for qid in range(n_queries):
+        gt_windows = []
+        for _ in range(rng.integers(1, 4)):
+            st = float(rng.integers(0, 50)) * 2
+            gt_windows.append([st, st + float(rng.choice([4, 20, 60, 200]))])
+        pred_windows = []
+        for _ in range(12):
+            st = float(rng.integers(0, 60)) * 2
+            # few distinct scores, so there are ties
+            pred_windows.append([st, st + float(rng.integers(1, 40)) * 2, float(rng.integers(0, 4)) / 4])
+        pred_windows.sort(key=lambda w: -w[2])
+        submission.append(dict(qid=qid, pred_relevant_windows=pred_windows))
+        ground_truth.append(dict(qid=qid, relevant_windows=gt_windows))
+    return submission, ground_truth
+
+
+def streaming_metrics(submission, ground_truth):
+    evaluator = StreamingMREval()
+    qid2gt = {gt["qid"]: gt for gt in ground_truth}
+    for prediction in submission:
+        evaluator.update(prediction, qid2gt[prediction["qid"]])
+    return evaluator.metrics()
+
+
+def test_metric_keys_are_rounded_thresholds():
+    metrics = streaming_metrics(*make_submission())
+    thresholds = ["0.5", "0.55", "0.6", "0.65", "0.7", "0.75", "0.8", "0.85", "0.9", "0.95"]
+    assert list(metrics["full"]["MR-mAP"]) == thresholds + ["average"]
+    assert list(metrics["full"]["MR-R1"]) == thresholds
+    assert {"MR-full-R1@0.5", "MR-full-R1@0.7", "MR-full-mAP@0.5", "MR-full-mAP@0.75"} <= set(metrics["brief"])
+
+
+def test_full_range_keeps_windows_longer_than_150s():
+    prediction = dict(qid=0, pred_relevant_windows=[[0, 200, 1.0]])
+    metrics = streaming_metrics([prediction], [dict(qid=0, relevant_windows=[[0, 200]])])
+    assert metrics["full"]["MR-mAP"]["average"] == 100.0
+    assert metrics["full"]["MR-R1"]["0.95"] == 100.0
+    assert metrics["long"]["num_queries"] == 0 and metrics["brief"]["MR-long-mAP"] == 0
+
+
+def test_matches_standalone_eval():
+    eval_submission = pytest.importorskip("standalone_eval.eval").eval_submission
+    submission, ground_truth = make_submission()
+    expected = eval_submission(submission, ground_truth, verbose=False, match_number=True)
+    actual = streaming_metrics(submission, ground_truth)
+
+    for name in ("full", "short", "middle", "long"):
+        for key in ("MR-mAP", "MR-R1", "MR-mIoU"):
+            assert actual[name][key] == expected[name][key], (name, key)
+    brief = {k: v for k, v in expected["brief"].items() if k.startswith("MR-")}
+    assert {k: actual["brief"][k] for k in brief} == brief
@@ -0,0 +1,53 @@
+import numpy as np
+import pytest
+import torch
+
+from utils.tensor_utils import pad_sequences_1d
+
+
+def reference_pad_sequences_1d(sequences, dtype, fixed_length=None):
+    # the per-sequence loop pad_sequences_1d used to run
+    if isinstance(sequences[0], list):
+        if "torch" in str(dtype):
+            sequences = [torch.tensor(s, dtype=dtype) for s in sequences]
+        else:
+            sequences = [np.asarray(s, dtype=dtype) for s in sequences]
+    lengths = [len(seq) for seq in sequences]
+    max_length = fixed_length if fixed_length is not None else max(lengths)
+    shape = (len(sequences), max_length) + tuple(sequences[0].shape[1:])
+    if isinstance(sequences[0], torch.Tensor):
+        padded_seqs, mask = torch.zeros(shape, dtype=dtype), torch.zeros(shape[:2])
+    else:
+        padded_seqs, mask = np.zeros(shape, dtype=dtype), np.zeros(shape[:2], dtype=np.float32)
+    for idx, seq in enumerate(sequences):
+        padded_seqs[idx, :lengths[idx]] = seq
+        mask[idx, :lengths[idx]] = 1
+    return padded_seqs, mask
+
+
+def make_sequences(kind, width):
+    rng = np.random.default_rng(0)
+    lengths = [3, 1, 7, 4]
+    if kind == "list":
+        return [rng.integers(0, 100, n).tolist() for n in lengths], torch.long
+    arrays = [rng.standard_normal((n, width)).astype(np.float32) for n in lengths]
+    if kind == "torch":
+        return [torch.from_numpy(a) for a in arrays], torch.float32
+    return arrays, np.float32
+
+
+# widths below and above the size at which the rows are copied one sequence at a time
+@pytest.mark.parametrize("kind,width", [("list", None), ("torch", 4), ("torch", 256), ("numpy", 4), ("numpy", 256)])
+@pytest.mark.parametrize("fixed_length", [None, 10])
+def test_pad_sequences_1d_matches_the_loop(kind, width, fixed_length):
+    sequences, dtype = make_sequences(kind, width)
+    padded, mask = pad_sequences_1d(sequences, dtype=dtype, fixed_length=fixed_length)
+    expected_padded, expected_mask = reference_pad_sequences_1d(sequences, dtype, fixed_length)
+    assert type(padded) is type(expected_padded) and padded.dtype == expected_padded.dtype
+    np.testing.assert_array_equal(np.asarray(padded), np.asarray(expected_padded))
+    np.testing.assert_array_equal(np.asarray(mask), np.asarray(expected_mask))
+
+
+def test_pad_sequences_1d_rejects_sequences_longer_than_fixed_length():
+    with pytest.raises(AssertionError):
+        pad_sequences_1d([torch.ones(5, 2), torch.ones(2, 2)], dtype=torch.float32, fixed_length=3)
@@ -0,0 +1,155 @@
+import json
+
+import pytest
+
+from swiss_adt import translator as translator_module
+from swiss_adt.translator import Translator
+
+
+class FakeResponse:
+    def __init__(self, status_code, body, headers=None):
+        self.status_code = status_code
+        self._body = body
+        self.headers = headers or {}
+        self.text = body if isinstance(body, str) else json.dumps(body)
+
+    def json(self):
+        if isinstance(self._body, str):
+            raise ValueError("not json")
+        return self._body
+
+
+def server_error():
+    # retried after 1 ms instead of the exponential backoff
+    return FakeResponse(500, {"error": {"message": "boom"}}, {"retry-after-ms": "1"})
+
+
+def chat_response(content):
+    return FakeResponse(200, {"choices": [{"message": {"content": content}}]})
+
+
+@pytest.fixture
+def translator():
+    return Translator(api_key="test", base_url="http://fake/v1")
+
+
+def test_retry_resends_images_from_generator(translator, monkeypatch):
+    bodies = []
+
+    def fake_request(method, url, headers=None, data=None, **kwargs):
+        # like requests, consume the streamed body
+        bodies.append(json.loads(b"".join(data)))
+        return server_error() if len(bodies) == 1 else chat_response("Bonjour")
+
+    monkeypatch.setattr(translator_module.requests, "request", fake_request)
+    images = (f"img{i}" for i in range(4))
+    assert translator.translate_segment("Hello", images, "EN", "FR") == "Bonjour"
+
+    assert len(bodies) == 2
+    for body in bodies:
+        content = body["messages"][0]["content"]
+        assert [c["image_url"]["url"] for c in content if c["type"] == "image_url"] == [
+            f"data:image/jpeg;base64,img{i}" for i in range(4)
+        ]
+
+
+def test_batch_upload_retry_sends_full_file(translator, monkeypatch):
+    uploads = []
+
+    def fake_request(method, url, headers=None, files=None, **kwargs):
+        path = url[len("http://fake/v1"):]
+        if path == "/files":
+            # like requests, read the file object from where it is
+            uploads.append(files["file"][1].read())
+            return server_error() if len(uploads) == 1 else FakeResponse(200, {"id": "file-in"})
+        if path == "/batches":
+            return FakeResponse(200, {"id": "batch-1", "status": "completed", "output_file_id": "file-out"})
+        if path == "/files/file-out/content":
+            lines = [
+                {"custom_id": segment_id, "response": {"status_code": 200, "body": {
+                    "choices": [{"message": {"content": f"fr {segment_id}"}}]}}}
+                for segment_id in ("a", "b")
+            ]
+            return FakeResponse(200, "\n".join(json.dumps(line) for line in lines))
+        raise AssertionError(f"unexpected request {method} {path}")
+
+    monkeypatch.setattr(translator_module.requests, "request", fake_request)
+    segments = {"a": ("Hello", ["img0"]), "b": ("Bye", ["img1", "img2"])}
+    assert translator.translate_batch(segments, "EN", "FR") == {"a": "fr a", "b": "fr b"}
+
+    assert len(uploads) == 2
+    assert len(uploads[0]) > 0 and uploads[1] == uploads[0]
+    assert [json.loads(line)["custom_id"] for line in uploads[1].splitlines()] == ["a", "b"]
+
+
+def test_group_payload_streams_images_in_segment_order(translator):
+    segments = [("First", ["a0", "a1"]), ("Second", iter([])), ("Third", lambda: iter(["c0"]))]
+    body = translator._build_group_payload(segments, "EN", "FR")
+    assert body.payload["messages"][0]["content"] == [body.payload["messages"][0]["content"][0]]
+
+    content = body.to_dict()["messages"][0]["content"]
+    parts = [c["text"] if c["type"] == "text" else c["image_url"]["url"] for c in content[1:]]
+    assert parts == [
+        "Segment 1: First", "data:image/jpeg;base64,a0", "data:image/jpeg;base64,a1",
+        "Segment 2: Second",
+        "Segment 3: Third", "data:image/jpeg;base64,c0",
+    ]
+    # iterated again for a retry
+    assert body.to_dict() == json.loads(b"".join(body))
+
+
+@pytest.mark.parametrize(
+    "outcome, expected_limit",
+    [
+        (lambda: chat_response("Bonjour"), 4.25),
+        (lambda: FakeResponse(400, {"error": {"message": "bad request"}}), 4),
+        (lambda: FakeResponse(429, {"error": {"message": "slow down"}}), 2),
+        (lambda: FakeResponse(503, "Service Unavailable"), 2),
+        (lambda: FakeResponse(500, {"error": {"message": "boom"}}), 2),
+        (translator_module.requests.exceptions.ConnectionError, 2),
+    ],
+)
+def test_limiter_grows_only_on_success(translator, monkeypatch, outcome, expected_limit):
+    def fake_request(method, url, **kwargs):
+        result = outcome()
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+    monkeypatch.setattr(translator_module.requests, "request", fake_request)
+    try:
+        # a single attempt, without the retries
+        translator._attempt("POST", "/chat/completions")
+    except Exception:
+        pass
+    assert translator.limiter.limit == expected_limit and translator.limiter.in_flight == 0
+
+
+def test_retry_after_is_waited_in_full(translator, monkeypatch):
+    sleeps, attempts = [], []
+
+    def fake_request(method, url, **kwargs):
+        attempts.append(url)
+        if len(attempts) == 1:
+            return FakeResponse(429, {"error": {"message": "slow down"}}, {"retry-after": "20"})
+        return chat_response("Bonjour")
+
+    monkeypatch.setattr(translator_module.requests, "request", fake_request)
+    monkeypatch.setattr(translator_module.time, "sleep", sleeps.append)
+    translator.max_retry_time = 30
+    assert translator._request("POST", "/chat/completions")["choices"][0]["message"]["content"] == "Bonjour"
+    assert len(attempts) == 2 and len(sleeps) == 1 and 20 <= sleeps[0] <= 22
+
+
+def test_retry_after_beyond_budget_gives_up_at_once(translator, monkeypatch):
+    sleeps, attempts = [], []
+
+    def fake_request(method, url, **kwargs):
+        attempts.append(url)
+        return FakeResponse(429, {"error": {"message": "slow down"}}, {"retry-after": "120"})
+
+    monkeypatch.setattr(translator_module.requests, "request", fake_request)
+    monkeypatch.setattr(translator_module.time, "sleep", sleeps.append)
+    with pytest.raises(translator_module.RateLimitError):
+        translator._request("POST", "/chat/completions")
+    assert len(attempts) == 1 and sleeps == []
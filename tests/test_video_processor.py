@@ -0,0 +1,53 @@
+import base64
+
+import cv2
+import numpy as np
+
+from swiss_adt.video_processor import (
+    FrameDeduplicator,
+    perceptual_hash,
+    rank_window_clips,
+    select_diverse_frames,
+)
+
+
+def decode(encoded):
+    return cv2.imdecode(np.frombuffer(base64.b64decode(encoded), np.uint8), cv2.IMREAD_UNCHANGED)
+
+
+def test_near_duplicate_is_encoded_as_itself():
+    rng = np.random.default_rng(0)
+    frame = rng.integers(0, 256, (64, 64, 3), dtype=np.uint8)
+    other = frame.copy()
+    other[0, 0] = 255 - other[0, 0]
+    assert perceptual_hash(frame) == perceptual_hash(other)
+
+    deduplicator = FrameDeduplicator()
+    _, encoded = deduplicator.encode(frame)
+    _, encoded_other = deduplicator.encode(other)
+    assert np.array_equal(decode(encoded_other), other)
+    # the exact same frame is served from the cache
+    assert deduplicator.encode(frame.copy())[1] is encoded
+
+
+def test_dedup_drops_near_duplicates_within_a_job():
+    rng = np.random.default_rng(0)
+    frame = rng.integers(0, 256, (64, 64, 3), dtype=np.uint8)
+    other = frame.copy()
+    other[0, 0] = 255 - other[0, 0]
+    assert len(FrameDeduplicator().dedup([frame, other])) == 1
+
+
+def test_select_diverse_frames_without_candidates():
+    assert select_diverse_frames(np.zeros((0, 512), dtype=np.float32), 3) == []
+
+
+def test_rank_window_clips_picks_the_best_clips_in_the_window():
+    scores = [0.1, 0.9, 0.2, 0.8, 0.3]
+    # clips 1..3 overlap [3, 7], clips 1 and 3 score best; times are relative to the window start
+    assert rank_window_clips(scores, [3, 7], clip_len=2, top_k=2) == [0.5, 3.5]
+
+
+def test_rank_window_clips_without_scores_uses_the_window_midpoint():
+    assert rank_window_clips([], [4, 10]) == [3.0]
+    assert rank_window_clips([0.5, 0.7], [20, 30]) == [5.0]